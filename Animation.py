@@ -0,0 +1,310 @@
+import io
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, GifImagePlugin, TiffImagePlugin
+from Pipeline import run_command
+from Selection import execute_in_selection
+from WorkingBuffer import BufferPool
+
+
+# File extensions that can hold several frames and the writer used for them
+ANIMATED_FORMATS = {".gif": "GIF", ".png": "APNG", ".apng": "APNG", ".tif": "TIFF", ".tiff": "TIFF"}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class FrameSource:
+    """
+    A class reading the frames of a multi-frame file (animated GIF, APNG or multi-page TIFF)
+    one at a time. Frames are decoded only when they are requested and are not kept.
+
+    Attributes:
+    - path: The file path of the animation.
+    - format: The Pillow format of the file.
+    - loop: Number of times the animation is repeated, 0 for forever, or None if not given.
+    """
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as image:
+            self.format = image.format
+            self.loop = image.info.get("loop")
+
+    @staticmethod
+    def is_animated(image):
+        """
+        Checks if an opened file holds more than one frame. Unlike counting the frames,
+        this does not decode a whole GIF.
+
+        Args:
+        - image: A PIL image opened from a file.
+
+        Returns:
+        - True if the file has several frames.
+        """
+        return getattr(image, "is_animated", False)
+
+    def frames(self):
+        """
+        Yields the frames of the file in order.
+
+        Returns:
+        - A generator of (RGBA frame, duration in milliseconds or None) pairs.
+        """
+        with Image.open(self.path) as image:
+            index = 0
+            while True:
+                try:
+                    image.seek(index)
+                except EOFError:
+                    return
+                yield image.convert("RGBA"), image.info.get("duration")
+                index += 1
+
+
+def apply_steps(frame, steps, pool):
+    """
+    Executes the steps of an edit on one frame, in the same way IEPImage executed them.
+
+    Args:
+    - frame: A PIL image.
+    - steps: Sequence of (command, selection or None) pairs.
+    - pool: BufferPool providing the pixel arrays of commands working in place.
+
+    Returns:
+    - The edited frame.
+    """
+    for command, selection in steps:
+        if selection is not None and selection.fits(frame.size):
+            restricted = execute_in_selection(command, frame, selection)
+            if restricted is not None:
+                frame = restricted[0]
+                continue
+        frame, _ = run_command(command, frame, pool)
+    return frame
+
+
+def process_frames(frames, steps, workers, window=None, pool=None, encode=None):
+    """
+    Executes the steps of an edit on every frame on a pool of worker threads and yields the
+    results in their original order. At most window frames are decoded or being processed
+    at the same time, so frames stream from the reader to the writer.
+
+    Args:
+    - frames: Iterable of (frame, duration) pairs.
+    - steps: Sequence of (command, selection or None) pairs.
+    - workers: Number of worker threads.
+    - window: Maximum number of frames in flight, twice the number of workers if not given.
+    - pool: BufferPool providing the pixel arrays of commands working in place.
+    - encode: Function preparing an edited frame for the writer, also run on the workers.
+
+    Returns:
+    - A generator of (edited or encoded frame, duration) pairs.
+    """
+    pool = pool if pool is not None else BufferPool(0)
+    window = window or 2 * workers
+
+    def work(frame):
+        frame = apply_steps(frame, steps, pool)
+        return encode(frame) if encode is not None else frame
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="frames") as executor:
+        for frame, duration in frames:
+            pending.append((executor.submit(work, frame), duration))
+            if len(pending) >= window:
+                future, duration = pending.popleft()
+                yield future.result(), duration
+        while pending:
+            future, duration = pending.popleft()
+            yield future.result(), duration
+
+
+def encode_gif_frame(frame):
+    """
+    Reduces a frame to 256 colors for GIF. Pixels with alpha below 128 become transparent.
+
+    Args:
+    - frame: An RGBA PIL image.
+
+    Returns:
+    - The indexed image and the transparent index, or None if no pixel is transparent.
+    """
+    transparent = frame.getchannel("A").point(lambda value: 255 if value < 128 else 0)
+    if transparent.getbbox() is None:
+        return frame.convert("RGB").quantize(256), None
+    indexed = frame.convert("RGB").quantize(255)
+    palette = indexed.getpalette()[:255 * 3]
+    indexed.putpalette(palette + [0] * (768 - len(palette)))
+    indexed.paste(255, mask=transparent)
+    return indexed, 255
+
+
+def write_gif(path, frames, loop=None):
+    """
+    Writes frames to a GIF file as they arrive. Every frame has its own color table and
+    replaces the previous one entirely.
+
+    Args:
+    - path: The file path.
+    - frames: Iterable of (frame encoded by encode_gif_frame, duration in milliseconds or None) pairs.
+    - loop: Number of times the animation is repeated, 0 for forever, or None to play it once.
+
+    Returns:
+    - The number of frames written.
+    """
+    count = 0
+    with open(path, "wb") as file:
+        for (indexed, transparency), duration in frames:
+            params = {"include_color_table": True, "disposal": 1 if transparency is None else 2}
+            if duration:
+                params["duration"] = duration
+            if transparency is not None:
+                params["transparency"] = transparency
+            if count == 0:
+                info = {"duration": duration or 0}
+                if loop is not None:
+                    info["loop"] = loop
+                header, _ = GifImagePlugin.getheader(indexed.copy(), info=info)
+                file.write(b"".join(header))
+            file.write(b"".join(GifImagePlugin.getdata(indexed, **params)))
+            count += 1
+        file.write(b";")
+    return count
+
+
+def _write_png_chunk(file, kind, data):
+    file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+def encode_apng_frame(frame):
+    """
+    Compresses a frame with the PNG encoder of Pillow.
+
+    Args:
+    - frame: A PIL image.
+
+    Returns:
+    - The size of the frame and the list of its (chunk type, chunk data) pairs.
+    """
+    buffer = io.BytesIO()
+    frame.save(buffer, "PNG")
+    data = buffer.getvalue()
+    chunks = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, kind = struct.unpack(">I4s", data[position:position + 8])
+        chunks.append((kind, data[position + 8:position + 8 + length]))
+        position += length + 12
+    return frame.size, chunks
+
+
+def write_apng(path, frames, loop=None):
+    """
+    Writes frames to an animated PNG file as they arrive. The image data of each compressed
+    frame is stored as a frame of the animation. The number of frames is written once the
+    last one is known.
+
+    Args:
+    - path: The file path.
+    - frames: Iterable of (frame encoded by encode_apng_frame, duration in milliseconds or None)
+      pairs. All frames must have the same size and mode.
+    - loop: Number of times the animation is repeated, 0 or None for forever.
+
+    Returns:
+    - The number of frames written.
+    """
+    count = 0
+    sequence = 0
+    with open(path, "wb") as file:
+        file.write(PNG_SIGNATURE)
+        for (frame_size, chunks), duration in frames:
+            if count == 0:
+                size = frame_size
+                _write_png_chunk(file, b"IHDR", next(data for kind, data in chunks if kind == b"IHDR"))
+                control_position = file.tell()
+                _write_png_chunk(file, b"acTL", struct.pack(">II", 0, loop or 0))
+            elif frame_size != size:
+                raise ValueError("All frames of an animated PNG must have the same size")
+            # Frames are complete, so each one replaces the previous one (dispose none, blend source).
+            _write_png_chunk(file, b"fcTL", struct.pack(">IIIIIHHBB", sequence, size[0], size[1], 0, 0,
+                                                        int(round(duration or 0)), 1000, 0, 0))
+            sequence += 1
+            for kind, data in chunks:
+                if kind != b"IDAT":
+                    continue
+                if count == 0:
+                    _write_png_chunk(file, b"IDAT", data)
+                else:
+                    _write_png_chunk(file, b"fdAT", struct.pack(">I", sequence) + data)
+                    sequence += 1
+            count += 1
+        _write_png_chunk(file, b"IEND", b"")
+        if count:
+            file.seek(control_position)
+            _write_png_chunk(file, b"acTL", struct.pack(">II", count, loop or 0))
+    return count
+
+
+def write_tiff(path, frames):
+    """
+    Writes frames as the pages of a TIFF file as they arrive.
+
+    Args:
+    - path: The file path.
+    - frames: Iterable of (frame, duration) pairs. TIFF has no frame timing.
+
+    Returns:
+    - The number of pages written.
+    """
+    count = 0
+    with TiffImagePlugin.AppendingTiffWriter(path, new=True) as tiff:
+        for frame, _ in frames:
+            frame.save(tiff, format="TIFF")
+            tiff.newFrame()
+            count += 1
+    return count
+
+
+def export_animation(source, path, steps, workers, pool=None):
+    """
+    Applies the steps of an edit to every frame of an animation and saves the result with
+    the original frame timing, streaming the frames from the source file to the output.
+    Frames are edited and encoded on the workers, only writing is done in order.
+    The output is written to a temporary file first, so it may replace the source.
+
+    Args:
+    - source: The FrameSource of the animation.
+    - path: The output file path, its extension selects the format.
+    - steps: Sequence of (command, selection or None) pairs.
+    - workers: Number of worker threads.
+    - pool: BufferPool providing the pixel arrays of commands working in place.
+
+    Returns:
+    - Dictionary with the number of frames, the time in seconds and the frames per second.
+    """
+    kind = ANIMATED_FORMATS[os.path.splitext(path)[1].lower()]
+    encode = {"GIF": encode_gif_frame, "APNG": encode_apng_frame}.get(kind)
+    start = time.perf_counter()
+    frames = process_frames(source.frames(), steps, workers, pool=pool, encode=encode)
+    descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(descriptor)
+    try:
+        if kind == "GIF":
+            count = write_gif(temporary, frames, source.loop)
+        elif kind == "APNG":
+            count = write_apng(temporary, frames, source.loop)
+        else:
+            count = write_tiff(temporary, frames)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    elapsed = time.perf_counter() - start
+    fps = count / elapsed if elapsed > 0 else float("inf")
+    print(f"Saved {count} frames in {elapsed:.2f} s ({fps:.1f} frames/s)")
+    return {"frames": count, "seconds": elapsed, "fps": fps}
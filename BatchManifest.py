@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import PIL
+
+# Source files whose code decides the pixels of a batch output.
+ENGINE_FILES = ("Commands.py", "Pipeline.py", "WorkingBuffer.py", "BatchService.py", "LosslessJpeg.py")
+
+
+def get_file_hash(path):
+    """
+    Computes the hash of the content of a file.
+
+    Args:
+    - path: The file path.
+
+    Returns:
+    - A hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def serialize_chain(chain):
+    """
+    Serializes a command chain so that equal chains give equal strings.
+
+    Args:
+    - chain: List of {"name": command class name, "data": parameters} dictionaries.
+
+    Returns:
+    - A JSON string with sorted keys and without empty parameters.
+    """
+    entries = [{"name": entry["name"], "data": entry.get("data") or {}} for entry in chain]
+    return json.dumps(entries, sort_keys=True, separators=(",", ":"))
+
+
+def get_library_version():
+    """
+    Describes the code producing the outputs: the versions of Pillow and NumPy, a hash of the
+    source of the command engine, so editing a command also invalidates its outputs, and if
+    jpegtran transforms JPEGs losslessly.
+
+    Returns:
+    - A version string.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in ENGINE_FILES:
+        with open(os.path.join(directory, name), "rb") as file:
+            digest.update(file.read())
+    version = f"Pillow {PIL.__version__}, NumPy {np.__version__}, engine {digest.hexdigest()}"
+    return version + (", jpegtran" if shutil.which("jpegtran") is not None else "")
+
+
+class BatchManifest:
+    """
+    A class recording how every output of a batch run was made, so that a later run skips
+    the outputs that would come out the same, like a build system.
+
+    Every output is recorded with the content hash of its input, the serialized command chain
+    and the library version. The size and modification time of the input are recorded too,
+    so an input that was not touched is not read again to compute its hash. The size and
+    modification time of the output show if the output was changed or replaced since.
+
+    Attributes:
+    - path: The file path of the manifest.
+    - version: The library version of the current code.
+    - entries: Dictionary mapping output file names to their records.
+    """
+    FILE_NAME = ".imageedit-manifest.json"
+
+    def __init__(self, path, version=None):
+        self.path = path
+        self.version = version if version is not None else get_library_version()
+        self.entries = {}
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file).get("outputs", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"The batch manifest could not be read, every output is made again: {e}")
+        self._identities = {}
+
+    def get_input_identity(self, input_path, entry=None):
+        """
+        Returns the size and modification time of an input with its content hash, taken from
+        its record if the input was not touched since. The input is examined before the hash
+        is computed, so a change during the hashing shows at the next run.
+
+        Args:
+        - input_path: The file path of the input.
+        - entry: The record of the output made from the input, or None.
+
+        Returns:
+        - A tuple of the [size, modification time] list and the hex digest.
+        """
+        stat = os.stat(input_path)
+        input_stat = [stat.st_size, stat.st_mtime_ns]
+        if entry is not None and entry.get("input_stat") == input_stat and entry.get("input") == input_path:
+            return input_stat, entry["input_hash"]
+        identity = self._identities.get(input_path)
+        if identity is None or identity[0] != input_stat:
+            identity = input_stat, get_file_hash(input_path)
+            self._identities[input_path] = identity
+        return identity
+
+    def check(self, input_path, chain, output_path):
+        """
+        Decides if an output has to be made.
+
+        Args:
+        - input_path: The file path of the input.
+        - chain: The command chain.
+        - output_path: The file path of the output.
+
+        Returns:
+        - None if the existing output matches, otherwise the reason to make it.
+        """
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None:
+            return "new"
+        try:
+            stat = os.stat(output_path)
+        except FileNotFoundError:
+            return "output missing"
+        if entry.get("output_stat") != [stat.st_size, stat.st_mtime_ns]:
+            return "output modified"
+        if entry.get("input_hash") != self.get_input_identity(input_path, entry)[1]:
+            return "input changed"
+        if entry.get("commands") != serialize_chain(chain):
+            return "commands changed"
+        if entry.get("version") != self.version:
+            return "version changed"
+        return None
+
+    def record(self, input_path, chain, output_path, input_identity):
+        """
+        Records an output that was made.
+
+        Args:
+        - input_path: The file path of the input.
+        - chain: The command chain.
+        - output_path: The file path of the output.
+        - input_identity: The identity of the input returned by get_input_identity before the
+          output was made. An input changed while it was processed then differs from the
+          record at the next run.
+        """
+        input_stat, input_hash = input_identity
+        output_stat = os.stat(output_path)
+        self.entries[os.path.basename(output_path)] = {
+            "input": input_path,
+            "input_stat": input_stat,
+            "input_hash": input_hash,
+            "commands": serialize_chain(chain),
+            "version": self.version,
+            "output_stat": [output_stat.st_size, output_stat.st_mtime_ns],
+        }
+
+    def save(self):
+        """
+        Writes the manifest. The file is either the previous manifest or complete.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=directory)
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                json.dump({"outputs": self.entries}, file, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f"The batch manifest could not be saved: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
@@ -0,0 +1,625 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+import Commands
+from BatchManifest import BatchManifest
+from LosslessJpeg import save_lossless_jpeg
+from Pipeline import CommandChain
+from Settings import Settings
+from WorkingBuffer import BufferPool
+from custom_exceptions import QueueFullError
+
+
+# Bytes of unused pixel arrays every worker process keeps for its next jobs.
+WORKER_POOL_BUDGET = 64 * 1024 * 1024
+
+# Seconds of finished jobs the throughput is measured over.
+THROUGHPUT_WINDOW = 60
+
+# Command chains build_commands must reject, checked by the check action.
+INVALID_CHAINS = ([{"name": "GaussianBlur", "data": {"Radius": "abc"}}],
+                  [{"name": "GaussianBlur", "data": {"radius": "abc"}}],
+                  [{"name": "Crop", "data": {"left": "a"}}],
+                  [{"name": "Resize", "data": {"width": -3}}],
+                  [{"name": "Resize", "data": {"x": -3}}],
+                  [{"name": "Resize", "data": {"quality": 1.5}}],
+                  [{"name": "ColorBalance", "data": {"r": True}}],
+                  [{"name": "Transpose", "data": {"operation": "rotate_45"}}],
+                  [{"name": "Convolution", "data": {"kernel": [[1]], "scale": "a"}}],
+                  [{"name": "PaintStroke", "data": {"patches": [[[0, 0, 1, 1], "red"]]}}],
+                  [{"name": "Command"}],
+                  [{"name": "Blur"}])
+
+_worker_pool = None
+_started_queue = None
+
+
+def build_commands(chain):
+    """
+    Creates the commands of a command chain.
+
+    Args:
+    - chain: List of {"name": command class name, "data": parameters} dictionaries. The
+      parameters of numeric commands are checked against their PARAMETERS and assigned as
+      their data, the parameters of other commands are passed to their constructor.
+
+    Returns:
+    - The list of commands.
+
+    Raises:
+    - ValueError: If a command is unknown or its parameters are not valid.
+    """
+    if not isinstance(chain, list):
+        raise ValueError("The command chain must be a list")
+    commands = []
+    for entry in chain:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            raise ValueError(f"Not a command: {entry!r}")
+        name = entry["name"]
+        data = entry.get("data") or {}
+        command_class = getattr(Commands, name, None)
+        if (not isinstance(command_class, type) or not issubclass(command_class, Commands.Command)
+                or getattr(command_class, "__abstractmethods__", None)):
+            raise ValueError(f"Unknown command: {name}")
+        if not isinstance(data, dict):
+            raise ValueError(f"Invalid parameters of {name}: {data!r}")
+        try:
+            if issubclass(command_class, Commands.NumericCommand):
+                command_class.validate_data(data)
+                command = command_class()
+                command.assign_data(data)
+            else:
+                command = command_class(**data)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid parameters of {name}: {e}")
+        commands.append(command)
+    return commands
+
+
+def save_atomically(image, path):
+    """
+    Saves an image so that the file at the path is either the previous one or complete.
+    Transparency is dropped for formats that cannot store it.
+
+    Args:
+    - image: A PIL image.
+    - path: The file path to save to. Its extension selects the format.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    image_format = Image.registered_extensions().get(extension)
+    if image_format is None:
+        raise ValueError(f"Unknown image format: {extension or path}")
+    if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            image.save(file, format=image_format)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def _init_worker(started_queue):
+    global _started_queue
+    _started_queue = started_queue
+
+
+def run_job(input_path, chain, output_path, job_id=None):
+    """
+    Executes a command chain on an image file and saves the result. Runs in a worker process.
+    The image is converted to RGBA when it is opened, as in the editor, so the result is the
+    same as when the commands are applied there. A JPEG only cropped, flipped or rotated into
+    a JPEG is not decoded, if jpegtran is installed.
+
+    Args:
+    - input_path: The file path of the image.
+    - chain: The command chain, see build_commands.
+    - output_path: The file path of the result.
+    - job_id: The id of the job, reported to the service when the job starts, or None.
+
+    Returns:
+    - Dictionary with the wall clock times the job started and finished in the worker.
+    """
+    global _worker_pool
+    started = time.time()
+    if _started_queue is not None and job_id is not None:
+        _started_queue.put(job_id)
+    if _worker_pool is None:
+        _worker_pool = BufferPool(WORKER_POOL_BUDGET)
+    commands = build_commands(chain)
+    if (os.path.splitext(output_path)[1].lower() in (".jpg", ".jpeg")
+            and all(command.geometric for command in commands)
+            and save_lossless_jpeg(input_path, output_path, [(command, None) for command in commands])):
+        return {"started": started, "finished": time.time()}
+    with Image.open(input_path) as source:
+        image = _worker_pool.make_image(_worker_pool.acquire_copy(source))
+    image = CommandChain(commands, _worker_pool).execute(image)
+    save_atomically(image, output_path)
+    return {"started": started, "finished": time.time()}
+
+
+def summarize_latencies(values):
+    """
+    Summarizes durations.
+
+    Args:
+    - values: Sequence of durations in seconds.
+
+    Returns:
+    - Dictionary with the number of values and the median, 90th and 99th percentile and
+      maximum in milliseconds.
+    """
+    if not values:
+        return {"count": 0}
+    milliseconds = np.asarray(values) * 1000
+    return {"count": len(values), "p50": float(np.percentile(milliseconds, 50)),
+            "p90": float(np.percentile(milliseconds, 90)), "p99": float(np.percentile(milliseconds, 99)),
+            "max": float(milliseconds.max())}
+
+
+class BatchService:
+    """
+    A class executing batch jobs on a bounded pool of worker processes.
+
+    A job is an input path, a command chain and an output path. At most workers jobs run at
+    the same time and at most queue_size more wait for a worker. When both are taken, submit
+    rejects the job, or with the "block" policy waits up to block_timeout seconds for a place
+    first. This bounds the memory held by waiting jobs however fast they arrive.
+
+    Attributes:
+    - workers: Number of worker processes.
+    - queue_size: Number of jobs that may wait for a worker.
+    - when_full: "reject" or "block", what submit does when the queue is full.
+    - block_timeout: Seconds submit waits for a place with the "block" policy, None to wait
+      as long as it takes.
+    - jobs: Dictionary mapping the ids of the recent jobs to their state dictionaries.
+    - submitted: Number of accepted jobs.
+    - completed: Number of jobs finished successfully.
+    - failed: Number of jobs that raised an error.
+    - rejected: Number of jobs refused because the queue was full.
+    - running: Number of jobs a worker has started and not finished. The workers report the
+      jobs they start, as the executor already counts the jobs handed to its call queue as
+      running before a worker takes them.
+    """
+    def __init__(self, workers, queue_size, when_full="reject", block_timeout=30, history=1000):
+        if when_full not in ("reject", "block"):
+            raise ValueError(f"Unknown policy: {when_full}")
+        self.workers = workers
+        self.queue_size = queue_size
+        self.when_full = when_full
+        self.block_timeout = block_timeout
+        self.history = history
+        self.jobs = OrderedDict()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.running = 0
+        self.started_at = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        self._started = context.SimpleQueue()
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                             initializer=_init_worker, initargs=(self._started,))
+        self._places = threading.BoundedSemaphore(workers + queue_size)
+        self._futures = {}
+        self._latencies = deque(maxlen=history)
+        self._run_times = deque(maxlen=history)
+        self._finish_times = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._watcher = threading.Thread(target=self._watch_started, name="batch-started", daemon=True)
+        self._watcher.start()
+
+    def _watch_started(self):
+        while True:
+            job_id = self._started.get()
+            if job_id is None:
+                return
+            with self._lock:
+                job = self.jobs.get(job_id)
+                # A job may finish before its start is read.
+                if job is not None and job["state"] == "queued":
+                    job["state"] = "running"
+                    self.running += 1
+
+    def submit(self, input_path, chain, output_path):
+        """
+        Adds a job to the queue.
+
+        Args:
+        - input_path: The file path of the image.
+        - chain: The command chain, see build_commands.
+        - output_path: The file path of the result.
+
+        Returns:
+        - The id of the job.
+
+        Raises:
+        - ValueError: If the command chain is not valid.
+        - QueueFullError: If there is no place in the queue.
+        """
+        build_commands(chain)
+        if self.when_full == "block":
+            accepted = self._places.acquire(timeout=self.block_timeout)
+        else:
+            accepted = self._places.acquire(blocking=False)
+        if not accepted:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(f"The queue is full (size {self.queue_size})")
+        with self._lock:
+            job_id = next(self._ids)
+            self.jobs[job_id] = {"id": job_id, "state": "queued", "input": input_path, "output": output_path}
+            self.submitted += 1
+        submitted = time.perf_counter()
+        try:
+            future = self._executor.submit(run_job, input_path, chain, output_path, job_id)
+        except RuntimeError:
+            self._places.release()
+            with self._lock:
+                del self.jobs[job_id]
+            raise
+        self._futures[job_id] = future
+        future.add_done_callback(lambda done: self._finish(job_id, submitted, done))
+        return job_id
+
+    def _finish(self, job_id, submitted, future):
+        latency = time.perf_counter() - submitted
+        self._places.release()
+        with self._lock:
+            job = self.jobs[job_id]
+            job["seconds"] = latency
+            if job["state"] == "running":
+                self.running -= 1
+            try:
+                times = future.result()
+            except Exception as e:
+                job["state"] = "failed"
+                job["error"] = f"{type(e).__name__}: {e}"
+                self.failed += 1
+                print(f"Batch job {job_id} failed: {job['error']}")
+            else:
+                job["state"] = "done"
+                self.completed += 1
+                self._latencies.append(latency)
+                self._run_times.append(times["finished"] - times["started"])
+                self._finish_times.append(time.perf_counter())
+            self._futures.pop(job_id, None)
+            finished = [key for key, value in self.jobs.items() if value["state"] in ("done", "failed")]
+            for key in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[key]
+
+    def wait(self, job_id, timeout=None):
+        """
+        Waits until a job has finished.
+
+        Args:
+        - job_id: The id returned by submit.
+        - timeout: Maximum number of seconds to wait, None to wait until the job finishes.
+
+        Returns:
+        - The state dictionary of the job, or None if the job is not known.
+        """
+        future = self._futures.get(job_id)
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        return self.get_job(job_id)
+
+    def get_job(self, job_id):
+        """
+        Returns a copy of the state dictionary of a job, or None if the job is not known.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job)
+
+    def get_metrics(self):
+        """
+        Returns the counters of the service, the number of queued and running jobs, the
+        percentiles of the latency from submission to completion and of the time spent in
+        the workers, and the throughput over the last THROUGHPUT_WINDOW seconds.
+
+        Returns:
+        - A dictionary that can be serialized as JSON.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            while self._finish_times and self._finish_times[0] < now - THROUGHPUT_WINDOW:
+                self._finish_times.popleft()
+            window = min(THROUGHPUT_WINDOW, now - self.started_at)
+            return {"workers": self.workers, "queue_size": self.queue_size, "when_full": self.when_full,
+                    "queued": max(0, len(self._futures) - self.running), "running": self.running,
+                    "submitted": self.submitted, "completed": self.completed, "failed": self.failed,
+                    "rejected": self.rejected,
+                    "latency": summarize_latencies(self._latencies),
+                    "run": summarize_latencies(self._run_times),
+                    "throughput": len(self._finish_times) / window if window > 0 else 0.0,
+                    "uptime": now - self.started_at}
+
+    def shutdown(self):
+        """Waits for the accepted jobs and stops the worker processes."""
+        self._executor.shutdown(wait=True)
+        self._started.put(None)
+        self._watcher.join()
+
+
+class BatchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the batch service:
+    - POST /jobs with {"input": path, "commands": chain, "output": path} queues a job and
+      answers 202 with its id, 400 if the job is not valid and 503 if the queue is full.
+      With "wait": true the answer is sent when the job has finished.
+    - GET /jobs/<id> returns the state of a job.
+    - GET /metrics returns the metrics of the service.
+    """
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            input_path, chain, output_path = job["input"], job["commands"], job["output"]
+            if not isinstance(input_path, str) or not isinstance(output_path, str):
+                raise ValueError("The input and output must be paths")
+            job_id = self.server.service.submit(input_path, chain, output_path)
+        except QueueFullError as e:
+            self.send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json(400, {"error": f"Invalid job: {e}"})
+            return
+        if job.get("wait"):
+            self.send_json(200, self.server.service.wait(job_id))
+        else:
+            self.send_json(202, self.server.service.get_job(job_id))
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/metrics":
+            self.send_json(200, self.server.service.get_metrics())
+            return
+        parts = self.path.strip("/").split("/")
+        job = None
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.server.service.get_job(int(parts[1]))
+        if job is None:
+            self.send_json(404, {"error": "Not found"})
+        else:
+            self.send_json(200, job)
+
+    def send_json(self, status, body, headers=None):
+        """
+        Sends a JSON answer.
+
+        Args:
+        - status: The HTTP status code.
+        - body: The object sent as JSON.
+        - headers: Dictionary of additional headers, or None.
+        """
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Jobs are reported through the metrics instead of one line per request.
+        pass
+
+
+def serve(service, port):
+    """
+    Answers requests to the service on localhost until interrupted or terminated.
+
+    Args:
+    - service: The BatchService executing the jobs.
+    - port: The TCP port, 0 to pick a free one.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), BatchRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    # Stopping the service also stops its worker processes, which would otherwise keep waiting for jobs.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Batch service listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def request(port, path, body=None):
+    """
+    Sends a request to a running batch service.
+
+    Args:
+    - port: The TCP port of the service.
+    - path: The path of the request.
+    - body: Object sent as JSON with a POST request, or None for a GET request.
+
+    Returns:
+    - The HTTP status code and the decoded JSON answer.
+    """
+    data = json.dumps(body).encode() if body is not None else None
+    message = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(message) as answer:
+            return answer.status, json.loads(answer.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def run_incremental(input_directory, output_directory, chain, extension=None, workers=1, force=False):
+    """
+    Executes a command chain on every image of a directory, skipping the images whose
+    output in the manifest of the output directory was made from the same input content,
+    command chain and library version.
+
+    Args:
+    - input_directory: The directory of the images.
+    - output_directory: The directory of the results, which keeps the manifest.
+    - chain: The command chain, see build_commands.
+    - extension: Extension selecting the format of the results, the one of each input if None.
+    - workers: Number of worker processes.
+    - force: If True, every image is processed again.
+
+    Returns:
+    - Dictionary with the number of inputs, processed, skipped and failed images, and the
+      number of images for every reason to process or skip them.
+    """
+    input_directory = os.path.abspath(input_directory)
+    output_directory = os.path.abspath(output_directory)
+    if input_directory == output_directory:
+        raise ValueError("The results must be written to another directory")
+    build_commands(chain)
+    os.makedirs(output_directory, exist_ok=True)
+    manifest = BatchManifest(os.path.join(output_directory, BatchManifest.FILE_NAME))
+    known = Image.registered_extensions()
+    inputs = sorted(entry.path for entry in os.scandir(input_directory)
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in known)
+    reasons = Counter()
+    outputs = set()
+    jobs = {}
+    failed = 0
+    service = BatchService(workers, workers, "block", block_timeout=None, history=max(1000, len(inputs)))
+    try:
+        for input_path in inputs:
+            stem, input_extension = os.path.splitext(os.path.basename(input_path))
+            output_path = os.path.join(output_directory, stem + (extension or input_extension))
+            if output_path in outputs:
+                print(f"Skipped {input_path}: another image has the output {output_path}")
+                reasons["name conflict"] += 1
+                continue
+            outputs.add(output_path)
+            reason = "forced" if force else manifest.check(input_path, chain, output_path)
+            reasons[reason or "unchanged"] += 1
+            if reason is not None:
+                # The identity is taken before the job runs, the input may change meanwhile.
+                entry = manifest.entries.get(os.path.basename(output_path))
+                identity = manifest.get_input_identity(input_path, entry)
+                jobs[service.submit(input_path, chain, output_path)] = (input_path, output_path, identity)
+        for job_id, (input_path, output_path, identity) in jobs.items():
+            if service.wait(job_id)["state"] == "done":
+                manifest.record(input_path, chain, output_path, identity)
+            else:
+                failed += 1
+    finally:
+        service.shutdown()
+        manifest.save()
+    return {"inputs": len(inputs), "processed": len(jobs) - failed, "skipped": reasons["unchanged"],
+            "failed": failed, "reasons": dict(reasons)}
+
+
+def check_validation():
+    """
+    Checks that every chain of INVALID_CHAINS is rejected when it is submitted.
+
+    Returns:
+    - The list of the chains that were accepted.
+    """
+    accepted = []
+    for chain in INVALID_CHAINS:
+        try:
+            build_commands(chain)
+        except ValueError as e:
+            print(f"rejected {json.dumps(chain)}: {e}")
+        else:
+            print(f"ACCEPTED {json.dumps(chain)}")
+            accepted.append(chain)
+    return accepted
+
+
+def main():
+    """
+    Starts the batch service, sends a job or a metrics request to a running one, processes a
+    directory incrementally without the service, or checks that invalid jobs are rejected.
+    """
+    settings = Settings()
+    parser = argparse.ArgumentParser(description="Executes command chains on image files.")
+    parser.add_argument("--port", type=int, default=settings.batch_port)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Start the service")
+    serve_parser.add_argument("--workers", type=int, default=settings.batch_workers)
+    serve_parser.add_argument("--queue-size", type=int, default=settings.batch_queue_size)
+    serve_parser.add_argument("--when-full", choices=("reject", "block"), default=settings.batch_when_full)
+    submit_parser = subparsers.add_parser("submit", help="Send a job to the service")
+    submit_parser.add_argument("input")
+    submit_parser.add_argument("output")
+    submit_parser.add_argument("commands", help='JSON command chain, e.g. [{"name": "GaussianBlur", '
+                                                '"data": {"radius": 4}}]')
+    submit_parser.add_argument("--wait", action="store_true", help="Wait until the job has finished")
+    subparsers.add_parser("metrics", help="Show the metrics of the service")
+    run_parser = subparsers.add_parser("run", help="Process the changed images of a directory")
+    run_parser.add_argument("input_directory")
+    run_parser.add_argument("output_directory")
+    run_parser.add_argument("commands", help="JSON command chain")
+    run_parser.add_argument("--format", help="Extension of the results, e.g. .png")
+    run_parser.add_argument("--workers", type=int, default=settings.batch_workers)
+    run_parser.add_argument("--force", action="store_true", help="Process every image again")
+    subparsers.add_parser("check", help="Check that invalid command chains are rejected")
+    arguments = parser.parse_args()
+
+    if arguments.action == "serve":
+        serve(BatchService(arguments.workers, arguments.queue_size, arguments.when_full), arguments.port)
+        return
+    if arguments.action == "check":
+        if check_validation():
+            sys.exit(1)
+        return
+    if arguments.action == "run":
+        try:
+            report = run_incremental(arguments.input_directory, arguments.output_directory,
+                                     json.loads(arguments.commands), arguments.format, arguments.workers,
+                                     arguments.force)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"{report['inputs']} images: {report['processed']} processed, {report['skipped']} skipped, "
+              f"{report['failed']} failed")
+        for reason, count in sorted(report["reasons"].items()):
+            print(f"  {reason}: {count}")
+        if report["failed"]:
+            sys.exit(1)
+        return
+    if arguments.action == "submit":
+        status, answer = request(arguments.port, "/jobs",
+                                 {"input": os.path.abspath(arguments.input),
+                                  "output": os.path.abspath(arguments.output),
+                                  "commands": json.loads(arguments.commands), "wait": arguments.wait})
+    else:
+        status, answer = request(arguments.port, "/metrics")
+    print(json.dumps(answer, indent=2))
+    if status >= 400 or answer.get("state") == "failed":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
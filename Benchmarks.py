@@ -0,0 +1,403 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image
+from Commands import GaussianBlur, AdaptiveEqualization, Resize, ChangePixelSize, Convolution, Inversion, \
+    ColorBalance, HistogramEqualization, SimpleBlur, Sharpen
+from ImageClass import IEPImage
+from Pipeline import CommandChain
+from Animation import FrameSource, encode_apng_frame, export_animation, write_apng
+from DecodeCache import DecodeCache
+
+
+def make_test_image(width, height, seed=0):
+    """
+    Creates a reproducible RGBA test image with smooth gradients, hard edges and noise.
+
+    Args:
+    - width: Width of the image.
+    - height: Height of the image.
+    - seed: Seed of the noise.
+
+    Returns:
+    - A PIL image.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    red = (x * 255 // max(1, width - 1))
+    green = (y * 255 // max(1, height - 1))
+    blue = np.where(((x // 64) + (y // 64)) % 2 == 0, 230, 20)
+    data = np.stack([red, green, blue], axis=-1).astype(np.int16)
+    data += rng.integers(-20, 21, size=data.shape, dtype=np.int16)
+    data = np.clip(data, 0, 255).astype(np.uint8)
+    return Image.fromarray(data, "RGB").convert("RGBA")
+
+
+def timed(function, repeat=3):
+    """
+    Measures the best time of several calls of a function.
+
+    Args:
+    - function: A callable without arguments.
+    - repeat: Number of calls.
+
+    Returns:
+    - Tuple of the best time in seconds and the result of the last call.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def exact_gaussian(image, sigma):
+    """
+    Blurs an image with an untruncated Gaussian computed in the frequency domain,
+    extending the edges by four standard deviations. Used as the reference for the blur.
+
+    Args:
+    - image: A single band PIL image.
+    - sigma: Standard deviation of the Gaussian.
+
+    Returns:
+    - A float array with the blurred image.
+    """
+    pad = int(np.ceil(4 * sigma))
+    data = np.pad(np.asarray(image, dtype=np.float64), pad, mode="edge")
+    for axis in (0, 1):
+        length = data.shape[axis]
+        frequencies = np.fft.rfftfreq(length)
+        response = np.exp(-2 * (np.pi * sigma * frequencies) ** 2)
+        shape = [1, 1]
+        shape[axis] = -1
+        data = np.fft.irfft(np.fft.rfft(data, axis=axis) * response.reshape(shape), n=length, axis=axis)
+    return data[pad:-pad, pad:-pad]
+
+
+def benchmark_blur(size, radii):
+    """
+    Sweeps the blur radius, timing the blur command and comparing it with the exact Gaussian.
+    The error is measured on a separate image, away from the border where edge handling differs.
+
+    Args:
+    - size: Width and height of the image used for timing.
+    - radii: Radii to test.
+    """
+    image = make_test_image(*size)
+    print(f"Gaussian blur on {size[0]}x{size[1]} RGBA")
+    print(f"{'radius':>6} {'time [s]':>9} {'Mpx/s':>7} {'mean err':>9} {'max err':>8}")
+    for radius in radii:
+        command = GaussianBlur()
+        command.assign_data({"radius": radius})
+        blur_time, _ = timed(lambda: command.execute(image))
+
+        margin = int(np.ceil(3 * radius))
+        reference = make_test_image(2 * margin + 256, 2 * margin + 256).getchannel("G")
+        blurred = np.asarray(command.execute(reference), dtype=np.float64)
+        error = np.abs(blurred - exact_gaussian(reference, radius))[margin:-margin, margin:-margin]
+        megapixels = size[0] * size[1] / 1e6 / blur_time
+        print(f"{radius:>6} {blur_time:>9.3f} {megapixels:>7.1f} {error.mean():>9.3f} {error.max():>8.2f}")
+
+
+def benchmark_equalization(size):
+    """
+    Times the adaptive equalization command.
+
+    Args:
+    - size: Width and height of the image.
+    """
+    image = make_test_image(*size)
+    command = AdaptiveEqualization()
+    equalization_time, _ = timed(lambda: command.execute(image))
+    print(f"Adaptive equalization on {size[0]}x{size[1]} RGBA: {equalization_time:.3f} s")
+
+
+def psnr(image, reference):
+    """
+    Computes the peak signal to noise ratio of an image compared with a reference.
+
+    Args:
+    - image: A PIL image.
+    - reference: A PIL image of the same size and mode.
+
+    Returns:
+    - PSNR in decibels.
+    """
+    error = np.asarray(image, dtype=np.float64) - np.asarray(reference, dtype=np.float64)
+    mse = np.mean(error ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def benchmark_resize(size, targets):
+    """
+    Compares speed and quality of the resize modes with the previous one axis at a time resize.
+    Quality is the PSNR against a single step Lanczos resample.
+
+    Args:
+    - size: Width and height of the source image.
+    - targets: Sizes to resize to.
+    """
+    image = make_test_image(*size)
+    print(f"Resize of {size[0]}x{size[1]} RGBA")
+    print(f"{'target':>11} {'mode':>14} {'time [s]':>9} {'PSNR [dB]':>10}")
+    for target in targets:
+        reference = image.resize(target, resample=Image.LANCZOS)
+
+        def pixel_size():
+            command = ChangePixelSize()
+            command.assign_data({"x": target[0]})
+            resized = command.execute(image)
+            command.assign_data({"y": target[1]})
+            return command.execute(resized)
+
+        modes = [("two pass box", pixel_size)]
+        for name, quality in (("fast", Resize.FAST), ("balanced", Resize.BALANCED),
+                              ("high quality", Resize.HIGH_QUALITY)):
+            command = Resize()
+            command.assign_data({"x": target[0], "y": target[1], "quality": quality})
+            modes.append((name, lambda command=command: command.execute(image)))
+        for name, function in modes:
+            resize_time, resized = timed(function)
+            print(f"{target[0]:>5}x{target[1]:<5} {name:>14} {resize_time:>9.3f} {psnr(resized, reference):>10.2f}")
+
+
+def make_kernel(size, separable, seed=0):
+    """
+    Creates a square test kernel.
+
+    Args:
+    - size: Width and height of the kernel.
+    - separable: If True, the kernel is the product of a column and a row.
+    - seed: Seed of the random weights.
+
+    Returns:
+    - A 2-D array.
+    """
+    rng = np.random.default_rng(seed)
+    if separable:
+        return np.outer(rng.random(size), rng.random(size))
+    return rng.random((size, size)) - 0.3
+
+
+def benchmark_convolution(size, kernel_sizes, max_direct_cost=3e9):
+    """
+    Times every convolution method for dense and separable kernels of growing size, and shows
+    the method chosen by the cost model. The error of each method is the largest difference
+    from direct convolution, measured on a smaller image.
+
+    Args:
+    - size: Width and height of the image used for timing.
+    - kernel_sizes: Kernel widths to test.
+    - max_direct_cost: Direct convolutions with more kernel weights times pixels are not timed.
+    """
+    image = make_test_image(*size)
+    reference = make_test_image(300, 200, seed=1)
+    methods = (Convolution.DIRECT, Convolution.SEPARABLE, Convolution.FFT)
+    print(f"Convolution on {size[0]}x{size[1]} RGBA, time [s] and max error per method")
+    print(f"{'kernel':>16} " + " ".join(f"{method:>16}" for method in methods) + f" {'chosen':>10}")
+    for kernel_size in kernel_sizes:
+        for separable in (False, True):
+            kernel = make_kernel(kernel_size, separable)
+            direct = np.asarray(Convolution(kernel, method=Convolution.DIRECT).execute(reference), dtype=np.int16)
+            cells = []
+            for method in methods:
+                command = Convolution(kernel, method=method)
+                if method == Convolution.SEPARABLE and command.factors is None or \
+                        method == Convolution.DIRECT and kernel_size ** 2 * size[0] * size[1] > max_direct_cost:
+                    cells.append(f"{'-':>16}")
+                    continue
+                method_time, _ = timed(lambda: command.execute(image), repeat=1)
+                error = np.abs(np.asarray(command.execute(reference), dtype=np.int16) - direct).max()
+                cells.append(f"{method_time:>9.3f} ({error:>3})")
+            name = f"{kernel_size}x{kernel_size} {'separable' if separable else 'dense'}"
+            chosen = Convolution(kernel).choose_method(size)
+            print(f"{name:>16} " + " ".join(cells) + f" {chosen:>10}")
+
+
+def benchmark_allocations(size):
+    """
+    Executes commands working in place through IEPImage with and without their in-place
+    implementation and prints the allocations and time of every command. The state undone
+    before the last command stays in the history as a branch, so its pixel array is kept.
+
+    Args:
+    - size: Width and height of the image.
+    """
+    balance = ColorBalance()
+    balance.assign_data({"r": 0.9, "g": 1.1, "b": 1.0})
+    commands = [Inversion(), balance, Inversion()]
+    print(f"Allocations of commands on {size[0]}x{size[1]} RGBA (MB are traced NumPy and Python bytes)")
+    print(f"{'path':>9} {'command':>14} {'time [s]':>9} {'images':>7} {'blocks':>7} {'buffers':>8} {'reused':>7} "
+          f"{'MB':>7}")
+    tracemalloc.start()
+    for in_place in (False, True):
+        image = IEPImage()
+        image.assign_pil_image(make_test_image(*size), "")
+        for index, command in enumerate(commands):
+            if index == len(commands) - 1:
+                image.undo_image()
+            command.in_place = in_place
+            start = time.perf_counter()
+            image.execute_command(command)
+            elapsed = time.perf_counter() - start
+            name, counts = image.allocation_log[-1]
+            print(f"{'in place' if in_place else 'copy':>9} {name:>14} {elapsed:>9.3f} {counts['images']:>7} "
+                  f"{counts['blocks']:>7} {counts['buffers']:>8} {counts['reused']:>7} "
+                  f"{counts['peak_bytes'] / 1e6:>7.1f}")
+            command.in_place = True
+    tracemalloc.stop()
+
+
+def run_unfused(commands, image):
+    """
+    Executes commands the way they are executed one at a time without tracking the mode:
+    the image is converted to RGBA before and after every command.
+
+    Args:
+    - commands: The commands to execute.
+    - image: A PIL image.
+
+    Returns:
+    - The resulting RGBA image.
+    """
+    for command in commands:
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if not command.accepts("RGBA"):
+            image = image.convert(command.modes[0])
+        image = command.execute(image)
+    return image if image.mode == "RGBA" else image.convert("RGBA")
+
+
+def benchmark_modes(size):
+    """
+    Compares a chain of commands executed with the pixel mode tracked by CommandChain with
+    the same chain converting the image to RGBA around every command, and prints the time,
+    the number of conversions and the largest difference between the results.
+
+    Args:
+    - size: Width and height of the image.
+    """
+    balance = ColorBalance()
+    balance.assign_data({"r": 0.9, "g": 1.1, "b": 1.0})
+    blur = GaussianBlur()
+    blur.assign_data({"radius": 2})
+    commands = [HistogramEqualization(), SimpleBlur(), Sharpen(), blur, Inversion(), balance]
+    image = make_test_image(*size)
+    chain = CommandChain(commands)
+    print(f"Chain of {len(commands)} commands on {size[0]}x{size[1]} RGBA")
+    print(f"{'path':>9} {'time [s]':>9} {'conversions':>12} {'fused':>6}")
+    unfused_time, reference = timed(lambda: run_unfused(commands, image))
+    print(f"{'unfused':>9} {unfused_time:>9.3f} {chain.count_unfused_conversions(image.mode):>12} {0:>6}")
+    chain_time, result = timed(lambda: chain.execute(image))
+    print(f"{'tracked':>9} {chain_time:>9.3f} {chain.conversions:>12} {chain.fused:>6}")
+    difference = np.abs(np.asarray(result, dtype=np.int16) - np.asarray(reference, dtype=np.int16)).max()
+    print(f"Largest difference between the results: {difference}")
+
+
+def benchmark_animation(size, frame_count=120):
+    """
+    Edits every frame of an animated PNG with a growing number of worker threads and prints
+    the throughput in frames per second.
+
+    Args:
+    - size: Width and height of the frames.
+    - frame_count: Number of frames of the animation.
+    """
+    blur = GaussianBlur()
+    blur.assign_data({"radius": 2})
+    steps = [(blur, None), (Inversion(), None)]
+    base = make_test_image(*size)
+    frames = ((encode_apng_frame(base.rotate(index * 3)), 40) for index in range(frame_count))
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, "source.png")
+        write_apng(source_path, frames, loop=0)
+        print(f"Editing {frame_count} frames of {size[0]}x{size[1]}")
+        print(f"{'workers':>8} {'time [s]':>9} {'frames/s':>9}")
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            result = export_animation(FrameSource(source_path), os.path.join(directory, "output.png"), steps, workers)
+            print(f"{workers:>8} {result['seconds']:>9.2f} {result['fps']:>9.1f}")
+            workers *= 2
+
+
+def open_image(path, decode_cache):
+    """
+    Opens an image file as the editor does.
+
+    Args:
+    - path: The file path.
+    - decode_cache: The DecodeCache used, or None.
+
+    Returns:
+    - The opened PIL image.
+    """
+    image = IEPImage(decode_cache=decode_cache)
+    image.assign_image(path)
+    return image.pil_image
+
+
+def benchmark_reopen(size):
+    """
+    Opens large PNG and TIFF files without the decode cache, with an empty cache (waiting
+    until the entry is written) and again in a new session from the cache, and prints the
+    times and the largest difference between the pixels.
+
+    Args:
+    - size: Width and height of the image.
+    """
+    image = make_test_image(*size)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, "decoded")
+        print(f"Opening {size[0]}x{size[1]} files")
+        print(f"{'format':>7} {'decode [s]':>11} {'store [s]':>10} {'reopen [s]':>11} {'difference':>11}")
+        for extension in ("png", "tif"):
+            path = os.path.join(directory, "image." + extension)
+            image.save(path)
+            decode_time, decoded = timed(lambda: open_image(path, None))
+            cache = DecodeCache(cache_dir, 4 * 1024 * 1024 * 1024)
+            start = time.perf_counter()
+            open_image(path, cache)
+            cache.shutdown()
+            store_time = time.perf_counter() - start
+            cache = DecodeCache(cache_dir, 4 * 1024 * 1024 * 1024)
+            reopen_time, reopened = timed(lambda: open_image(path, cache))
+            difference = np.abs(np.asarray(reopened, dtype=np.int16) - np.asarray(decoded, dtype=np.int16)).max()
+            print(f"{extension:>7} {decode_time:>11.3f} {store_time:>10.3f} {reopen_time:>11.4f} {difference:>11}")
+            cache.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the image commands.")
+    parser.add_argument("benchmark", choices=["blur", "equalization", "resize", "convolution", "allocations",
+                                                     "modes", "animation", "reopen"])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    arguments = parser.parse_args()
+    size = (arguments.width, arguments.height)
+    if arguments.benchmark == "blur":
+        benchmark_blur(size, [1, 2, 5, 10, 20, 50, 100, 150, 200])
+    elif arguments.benchmark == "equalization":
+        benchmark_equalization(size)
+    elif arguments.benchmark == "resize":
+        benchmark_resize(size, [(size[0] // 2, size[1] // 2), (size[0] // 7, size[1] // 7), (640, 480)])
+    elif arguments.benchmark == "convolution":
+        benchmark_convolution(size, [3, 5, 7, 9, 15, 25, 41, 75])
+    elif arguments.benchmark == "allocations":
+        benchmark_allocations(size)
+    elif arguments.benchmark == "modes":
+        benchmark_modes(size)
+    elif arguments.benchmark == "animation":
+        benchmark_animation((size[0] // 4, size[1] // 4))
+    elif arguments.benchmark == "reopen":
+        benchmark_reopen(size)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,13 @@ class NumericalBox(ElementBase):
         super().__init__(screen, position, name)
 
         # Box data
-        self.value_in_string: str = "0"
+        self.value_in_string: str = str(starting_value)
         self.value = starting_value
         self.max_value = max_value
         self.min_value = min_value
         self.max_number_of_letters = 5
         self.active = False
+        self.edited_at = 0
 
         # Rectangle data
         self.width = width
@@ -63,16 +64,19 @@ class NumericalBox(ElementBase):
             else:
                 self.active = True
                 self.value_in_string = ""
+                self.edited_at = pygame.time.get_ticks()
         elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
             self.active = False
         elif self.active and event.type == pygame.KEYDOWN:
             # Check for backspace
             if event.key == pygame.K_BACKSPACE:
                 self.value_in_string = self.value_in_string[:-1]
+                self.edited_at = pygame.time.get_ticks()
             # Check for a number
             elif pygame.K_0 <= event.key <= pygame.K_9:
                 if len(self.value_in_string) < self.max_number_of_letters:
                     self.value_in_string += event.unicode
+                    self.edited_at = pygame.time.get_ticks()
             elif event.key == pygame.K_RETURN:
                 self.value = int(self.value_in_string)
                 self.active = False
@@ -80,6 +84,17 @@ class NumericalBox(ElementBase):
             else:
                 pass
 
+    def get_pending_value(self):
+        """
+        Returns the value being typed that was not confirmed yet.
+
+        Returns:
+        - The typed value, or None if the box is not being edited or is empty.
+        """
+        if self.active and self.value_in_string:
+            return int(self.value_in_string)
+        return None
+
 
 class Checkbox(ElementBase):
     def __init__(self, screen, position: tuple, name, width: int, height: int, value_name: str,
@@ -88,6 +103,8 @@ class Checkbox(ElementBase):
 
         # Box info
         self.value_name = value_name
+        self.checked = False
+        self.value = 0
         self.normal_color = color
         self.active_color = self.normal_color
 
@@ -100,20 +117,18 @@ class Checkbox(ElementBase):
         self.outline_color = outline_color
 
         # Text info
-        self.text_descr_color = (71, 71, 71)
+        self.text_descr_color = (255, 255, 255)
         self.descr_text = self.font.render(self.value_name, False, self.text_descr_color)
         self.descr_text_rect = self.descr_text.get_rect(center=(self.pos[0] + self.width / 2, self.pos[1] - 10))
 
     def check_events(self, event, mouse_pos,  *args, **kwargs):
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(mouse_pos):
-            if self.selected:
-                self.selected = False
-            else:
-                self.selected = True
+            self.checked = not self.checked
+            self.value = int(self.checked)
             self.change_color()
 
     def change_color(self):
-        if self.selected:
+        if self.checked:
             self.active_color = (0, 0, 0)
         else:
             self.active_color = self.normal_color
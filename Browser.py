@@ -0,0 +1,382 @@
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+import pygame
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from FramePacer import report_progress
+from InterfaceElement import ElementBase, TypeOfInteraction
+
+
+IMAGE_EXTENSIONS = (".png", ".apng", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def make_thumbnail(path, size):
+    """
+    Decodes a reduced version of an image file. JPEG files are decoded directly at a
+    fraction of their size (draft mode), other formats are reduced right after decoding.
+
+    Args:
+    - path: The file path of the image.
+    - size: Maximum width and height of the thumbnail.
+
+    Returns:
+    - An RGB or RGBA PIL image.
+    """
+    with Image.open(path) as image:
+        # Drafting asks the JPEG decoder for the smallest scale of at least twice the size.
+        image.draft("RGB", (size * 2, size * 2))
+        image.thumbnail((size, size), reducing_gap=None)
+        image = ImageOps.exif_transpose(image)
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        return image.convert("RGBA" if has_alpha else "RGB")
+
+
+class ThumbnailCache:
+    """
+    A class storing thumbnails on disk. A thumbnail is found again as long as the path,
+    size and modification time of its file do not change. Opaque thumbnails are stored as
+    JPEG and thumbnails with transparency as PNG.
+
+    Attributes:
+    - directory: The directory holding the thumbnails.
+    - size: Maximum width and height of the thumbnails.
+    - hits: Number of thumbnails read from the disk.
+    - misses: Number of thumbnails decoded from their files.
+    """
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, path):
+        """
+        Returns the key of the thumbnail of a file.
+
+        Args:
+        - path: The file path of the image.
+
+        Returns:
+        - A hex digest of the path, size and modification time of the file.
+        """
+        stat = os.stat(path)
+        identity = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, self.size)
+        return hashlib.blake2b(repr(identity).encode(), digest_size=16).hexdigest()
+
+    def get(self, path):
+        """
+        Returns the thumbnail of a file, decoding and storing it if it is not cached.
+        Safe to call from several threads.
+
+        Args:
+        - path: The file path of the image.
+
+        Returns:
+        - A PIL image, or None if the file cannot be read.
+        """
+        try:
+            key = self.get_key(path)
+            for extension in (".jpg", ".png"):
+                stored = os.path.join(self.directory, key + extension)
+                if os.path.exists(stored):
+                    with Image.open(stored) as image:
+                        image.load()
+                        self.hits += 1
+                        return image
+            image = make_thumbnail(path, self.size)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        self.misses += 1
+        self.put(key, image)
+        return image
+
+    def put(self, key, image):
+        """
+        Stores a thumbnail. The file appears complete or not at all.
+
+        Args:
+        - key: The key of the thumbnail.
+        - image: An RGB or RGBA PIL image.
+        """
+        extension = ".png" if image.mode == "RGBA" else ".jpg"
+        descriptor, temporary = tempfile.mkstemp(suffix=extension, dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                image.save(file, "PNG" if extension == ".png" else "JPEG", quality=90)
+            os.replace(temporary, os.path.join(self.directory, key + extension))
+        except OSError as e:
+            print(f"Thumbnail could not be stored: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+class ThumbnailLoader:
+    """
+    A class producing thumbnails on a pool of worker threads.
+
+    Only the thumbnails of the latest request are produced: files that scrolled out of view
+    before a worker reached them are skipped. Finished thumbnails are collected by poll on
+    the main thread.
+
+    Attributes:
+    - cache: The ThumbnailCache the thumbnails are read from and stored in.
+    - executor: Pool of worker threads.
+    """
+    def __init__(self, cache, workers):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        self._results = queue.Queue()
+        self._requested = set()
+        self._wanted = set()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def is_busy(self):
+        """
+        Checks if thumbnails are being produced.
+
+        Returns:
+        - True while work is pending.
+        """
+        return self._pending > 0
+
+    def shutdown(self):
+        """Stops the worker threads."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def request(self, paths):
+        """
+        Requests the thumbnails of files, in order, and drops the requests of other files
+        that were not started yet.
+
+        Args:
+        - paths: File paths of the images.
+        """
+        with self._lock:
+            self._wanted = set(paths)
+            for path in paths:
+                if path not in self._requested:
+                    self._requested.add(path)
+                    self._pending += 1
+                    self.executor.submit(self._load, path)
+
+    def _load(self, path):
+        with self._lock:
+            wanted = path in self._wanted
+        image = self.cache.get(path) if wanted else None
+        with self._lock:
+            self._pending -= 1
+            if not wanted:
+                self._requested.discard(path)
+                return
+        self._results.put((path, image))
+        report_progress(job="thumbnails")
+
+    def poll(self):
+        """
+        Returns the thumbnails finished since the last call.
+
+        Returns:
+        - List of (path, PIL image or None) pairs.
+        """
+        finished = []
+        while True:
+            try:
+                path, image = self._results.get_nowait()
+            except queue.Empty:
+                return finished
+            with self._lock:
+                self._requested.discard(path)
+            finished.append((path, image))
+
+
+class ThumbnailBrowser(ElementBase):
+    """
+    A class showing the images of a directory as a grid of thumbnails over the canvas.
+
+    The "Browse" button opens the browser at the directory of the active image. Clicking a
+    folder enters it, clicking a thumbnail opens the image. The mouse wheel scrolls and
+    Escape closes the browser. Thumbnails of the visible rows and of the next screen are
+    produced in the background.
+
+    Attributes:
+    - Inherits attributes from ElementBase.
+    - rect: The area covered by the open browser.
+    - button_rect: The area of the button opening and closing the browser.
+    - is_open: Indicates if the grid is shown.
+    - directory: The directory being shown.
+    - entries: List of (name, path, is directory) entries of the directory, folders first.
+    - scroll: Number of rows scrolled.
+    - loader: ThumbnailLoader producing the thumbnails.
+    - path: The path of the image chosen to be opened.
+    - start_directory: The directory the button opens, the one of the active image if known.
+    """
+    def __init__(self, screen, position: tuple, button_size, rect, cache_dir, thumbnail_size, workers,
+                 name="Browse", color: tuple = (100, 100, 100), max_surfaces=1000):
+        super().__init__(screen, position, name)
+        self.type_name = TypeOfInteraction.BROWSE
+        self.button_rect = pygame.Rect(position, button_size)
+        self.rect = pygame.Rect(rect)
+        self.color = color
+        self.text_color = (255, 255, 255)
+        self.thumbnail_size = thumbnail_size
+        self.cell_size = (thumbnail_size + 12, thumbnail_size + 30)
+        self.header_height = 24
+        self.is_open = False
+        self.directory = None
+        self.entries = []
+        self.scroll = 0
+        self.loader = ThumbnailLoader(ThumbnailCache(cache_dir, thumbnail_size), workers)
+        self.path = None
+        self.start_directory = None
+        self.max_surfaces = max_surfaces
+        self._surfaces = OrderedDict()
+        self._failed = set()
+
+    def is_busy(self):
+        """
+        Checks if thumbnails for the open browser are being produced.
+
+        Returns:
+        - True while work is pending.
+        """
+        return self.is_open and self.loader.is_busy()
+
+    def shutdown(self):
+        """Stops the worker threads."""
+        self.loader.shutdown()
+
+    def open(self, directory):
+        """
+        Shows the images of a directory.
+
+        Args:
+        - directory: The directory to show.
+        """
+        try:
+            with os.scandir(directory) as scan:
+                found = [(entry.name, entry.path, entry.is_dir()) for entry in scan if not entry.name.startswith(".")]
+        except OSError as e:
+            print(f"Directory could not be read: {e}")
+            return
+        folders = sorted(((name, path, True) for name, path, is_dir in found if is_dir), key=lambda e: e[0].lower())
+        images = sorted(((name, path, False) for name, path, is_dir in found
+                         if not is_dir and name.lower().endswith(IMAGE_EXTENSIONS)), key=lambda e: e[0].lower())
+        parent = os.path.dirname(os.path.abspath(directory))
+        self.directory = os.path.abspath(directory)
+        self.entries = ([("..", parent, True)] if parent != self.directory else []) + folders + images
+        self.scroll = 0
+        self.is_open = True
+
+    def close(self):
+        """Hides the browser and stops producing thumbnails."""
+        self.is_open = False
+        self.loader.request([])
+
+    def get_columns(self):
+        return max(1, self.rect.width // self.cell_size[0])
+
+    def get_visible_rows(self):
+        return max(1, (self.rect.height - self.header_height) // self.cell_size[1])
+
+    def get_cells(self):
+        """
+        Returns the entries visible in the grid.
+
+        Returns:
+        - List of (entry, rect) pairs.
+        """
+        columns = self.get_columns()
+        first = self.scroll * columns
+        visible = self.entries[first:first + columns * self.get_visible_rows()]
+        cells = []
+        for index, entry in enumerate(visible):
+            row, column = divmod(index, columns)
+            cells.append((entry, pygame.Rect(self.rect.x + column * self.cell_size[0],
+                                             self.rect.y + self.header_height + row * self.cell_size[1],
+                                             self.cell_size[0], self.cell_size[1])))
+        return cells
+
+    def update(self, directory):
+        """
+        Collects finished thumbnails and requests those of the visible rows and the next screen.
+
+        Args:
+        - directory: The directory opened by the button, used when the browser is opened.
+        """
+        self.start_directory = directory
+        for path, image in self.loader.poll():
+            if image is None:
+                self._failed.add(path)
+                continue
+            self._surfaces[path] = pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+            while len(self._surfaces) > self.max_surfaces:
+                self._surfaces.popitem(last=False)
+        if not self.is_open:
+            return
+        columns = self.get_columns()
+        first = self.scroll * columns
+        ahead = self.entries[first:first + 2 * columns * self.get_visible_rows()]
+        self.loader.request([path for _, path, is_dir in ahead
+                             if not is_dir and path not in self._surfaces and path not in self._failed])
+
+    def check_events(self, event, pos, *args, **kwargs):
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.button_rect.collidepoint(pos):
+            if self.is_open:
+                self.close()
+            else:
+                self.open(self.start_directory or os.getcwd())
+            return
+        if not self.is_open:
+            return
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.close()
+        elif event.type == pygame.MOUSEWHEEL and self.is_hovered(pos):
+            rows = -(-len(self.entries) // self.get_columns())
+            self.scroll = min(max(0, self.scroll - event.y), max(0, rows - self.get_visible_rows()))
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos):
+            for (name, path, is_dir), rect in self.get_cells():
+                if not rect.collidepoint(pos):
+                    continue
+                if is_dir:
+                    self.open(path)
+                else:
+                    self.path = path
+                    self.selected = True
+                    self.close()
+                return
+
+    def is_hovered(self, mouse_pos):
+        return self.is_open and self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        pygame.draw.rect(self.screen, self.color, self.button_rect)
+        text = self.font.render(self.name, False, self.text_color)
+        self.screen.blit(text, text.get_rect(center=self.button_rect.center))
+
+    def draw_overlay(self):
+        """
+        Draws the grid over the canvas if the browser is open.
+        """
+        if not self.is_open:
+            return
+        pygame.draw.rect(self.screen, self.color, self.rect)
+        header = self.font.render(self.directory, False, self.text_color)
+        self.screen.blit(header, (self.rect.x + 5, self.rect.y + 2),
+                         area=pygame.Rect(0, 0, self.rect.width - 10, self.header_height))
+        for (name, path, is_dir), rect in self.get_cells():
+            area = pygame.Rect(rect.x + 6, rect.y + 4, self.thumbnail_size, self.thumbnail_size)
+            surface = self._surfaces.get(path)
+            if surface is not None:
+                self._surfaces.move_to_end(path)
+                self.screen.blit(surface, surface.get_rect(center=area.center))
+            else:
+                pygame.draw.rect(self.screen, self.text_color, area, 1 if not is_dir else 3)
+            label = self.font.render(name, False, self.text_color)
+            self.screen.blit(label, (rect.x + 6, area.bottom + 2),
+                             area=pygame.Rect(0, 0, self.thumbnail_size, self.cell_size[1]))
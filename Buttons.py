@@ -1,6 +1,4 @@
-import tkinter as tk
 import pygame
-from tkinter import filedialog
 from InterfaceElement import ElementBase, TypeOfInteraction
 from custom_exceptions import NoFileSelectedError
 
@@ -37,15 +35,21 @@ class NormalButton(ElementBase):
 
 class LoadButton(ElementBase):
     """
-    A class representing a load button element.
+    A class representing a load button element. The file is chosen in a dialog shown by the
+    dialog service, the button is selected once the dialog is closed.
 
     Attributes:
     - Inherits attributes from ElementBase.
+    - dialogs: The DialogService showing the file dialog.
+    - waiting: Indicates if the dialog of the button is open.
     """
-    def __init__(self, screen, position: tuple, name="Load", path_to_image=None, button_image="Resources/button.png"):
+    def __init__(self, screen, position: tuple, dialogs, name="Load", path_to_image=None,
+                 button_image="Resources/button.png"):
         super().__init__(screen, position, name)
         self.path_to_image = path_to_image
         self.type_name = TypeOfInteraction.LOAD
+        self.dialogs = dialogs
+        self.waiting = False
 
         # Rect info
         self.image = pygame.image.load(button_image)
@@ -54,14 +58,21 @@ class LoadButton(ElementBase):
         self.rect.y = position[1]
 
     def check_events(self, event, pos, *args, **kwargs):
-        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos):
-            window = tk.Tk()
-            window.withdraw()
-            path_to_file = filedialog.askopenfilename(title="Select an image",
-                                                      filetypes=[
-                                                          ("Image files", "*.png *.jpg *.jpeg *.gif *.bmp *.tiff")])
-            self.path_to_image = path_to_file
-            self.selected = True
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos) and not self.waiting:
+            self.waiting = True
+            self.dialogs.ask_open(self.file_chosen, title="Select an image",
+                                  filetypes=[("Image files", "*.png *.apng *.jpg *.jpeg *.gif *.bmp *.tif *.tiff")])
+
+    def file_chosen(self, path):
+        """
+        Receives the path chosen in the dialog.
+
+        Args:
+        - path: The chosen file path, or "" if no file was chosen.
+        """
+        self.waiting = False
+        self.path_to_image = path
+        self.selected = True
 
     def draw(self):
         self.screen.blit(self.image, self.rect)
@@ -90,15 +101,20 @@ class LoadButton(ElementBase):
 
 class SaveButton(ElementBase):
     """
-    A class representing a save button element.
+    A class representing a save button element. The file is chosen in a dialog shown by the
+    dialog service, the button is selected once the dialog is closed.
 
     Attributes:
     - Inherits attributes from ElementBase.
+    - dialogs: The DialogService showing the file dialog.
+    - waiting: Indicates if the dialog of the button is open.
     """
-    def __init__(self, screen, position: tuple, name="Save", button_image="Resources/button.png"):
+    def __init__(self, screen, position: tuple, dialogs, name="Save", button_image="Resources/button.png"):
         super().__init__(screen, position, name)
         self.path_save_file: str = ""
         self.type_name = TypeOfInteraction.SAVE
+        self.dialogs = dialogs
+        self.waiting = False
 
         # Rect info
         self.image = pygame.image.load(button_image)
@@ -107,12 +123,22 @@ class SaveButton(ElementBase):
         self.rect.y = position[1]
 
     def check_events(self, event, pos, *args, **kwargs):
-        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos):
-            window = tk.Tk()
-            window.withdraw()
-            file_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png")])
-            self.path_save_file = file_path
-            self.selected = True
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos) and not self.waiting:
+            self.waiting = True
+            self.dialogs.ask_save(self.file_chosen, defaultextension=".png",
+                                  filetypes=[("PNG files", "*.png"), ("GIF files", "*.gif"),
+                                             ("TIFF files", "*.tif *.tiff")])
+
+    def file_chosen(self, path):
+        """
+        Receives the path chosen in the dialog.
+
+        Args:
+        - path: The chosen file path, or "" if no file was chosen.
+        """
+        self.waiting = False
+        self.path_save_file = path
+        self.selected = True
 
     def draw(self):
         self.screen.blit(self.image, self.rect)
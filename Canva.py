@@ -1,6 +1,10 @@
+import numpy as np
 import pygame
 from InterfaceElement import ElementBase
 from ImageClass import IEPImage
+from PIL import Image
+from Selection import Selection
+from WorkingBuffer import view_pixels
 
 
 class Canvas(ElementBase):
@@ -14,8 +18,18 @@ class Canvas(ElementBase):
     - height: The height of the canvas
     - color: The background color of the canvas
     - name: The name of the canvas
+    - tools: The ToolPanel choosing what dragging over the image does, or None to always select.
+    - shares_pixels: Indicates if the displayed surface is a view of the pixel array of the image.
+    - displayed_image: The PIL image the displayed surface is a view of, kept so that its
+      pixel array is not reused while the surface shows it, or None.
+    - surface_cache: Dictionary mapping images to their (surface, displayed_image) pairs.
+
+    With the select tool, dragging over the image selects a rectangle, or an ellipse while
+    Shift is held, that the following commands are restricted to. A click or Escape removes
+    the selection. With the brush and eraser tools, dragging paints a stroke and only the
+    changed part of the displayed surface is updated.
     """
-    def __init__(self, screen, position: tuple, width, height, color, name="Canvas"):
+    def __init__(self, screen, position: tuple, width, height, color, name="Canvas", tools=None):
         super().__init__(screen, position, name)
         self.width = width
         self.height = height
@@ -23,6 +37,15 @@ class Canvas(ElementBase):
         self.main_image = None
         self.image_data = None
         self.has_image = False
+        self.previewing = False
+        self.surface_cache = {}
+        self.selection_color = (255, 255, 255)
+        self.drag_start = None
+        self.drag_end = None
+        self.tools = tools
+        self.stroke = None
+        self.shares_pixels = False
+        self.displayed_image = None
         self.rect = pygame.Rect(self.pos[0], self.pos[1], self.width, self.height)
 
     def is_hovered(self, mouse_pos):
@@ -40,6 +63,151 @@ class Canvas(ElementBase):
         else:
             return False
 
+    def get_image_rect(self):
+        """
+        Returns the area of the screen the image is displayed in.
+
+        Returns:
+        - A Pygame rect.
+        """
+        width, height = self.get_display_size(self.main_image.pil_image.size)
+        return pygame.Rect(self.pos[0] + self.rect.width // 2 - width // 2,
+                           self.pos[1] + self.rect.height // 2 - height // 2, width, height)
+
+    def screen_to_image(self, pos):
+        """
+        Converts a position on the screen to image pixels.
+
+        Args:
+        - pos: The position on the screen.
+        """
+        image_rect = self.get_image_rect()
+        size = self.main_image.pil_image.size
+        return (round((pos[0] - image_rect.x) * size[0] / image_rect.width),
+                round((pos[1] - image_rect.y) * size[1] / image_rect.height))
+
+    def image_to_screen(self, point):
+        """
+        Converts image pixels to a position on the screen.
+
+        Args:
+        - point: The position in image pixels.
+        """
+        image_rect = self.get_image_rect()
+        size = self.main_image.pil_image.size
+        return (image_rect.x + round(point[0] * image_rect.width / size[0]),
+                image_rect.y + round(point[1] * image_rect.height / size[1]))
+
+    def check_events(self, event, mouse_pos, *args, **kwargs):
+        """
+        Handles selecting a part of the image.
+
+        Args:
+        - event: The Pygame event.
+        - mouse_pos: The position of the mouse.
+        """
+        if not self.has_image or self.main_image.pil_image is None:
+            return
+        if self.tools is not None and self.tools.tool != "select":
+            self.check_painting_events(event, mouse_pos)
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(mouse_pos):
+            self.drag_start = self.drag_end = self.screen_to_image(mouse_pos)
+        elif event.type == pygame.MOUSEMOTION and self.drag_start is not None:
+            self.drag_end = self.screen_to_image(mouse_pos)
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1 and self.drag_start is not None:
+            ellipse = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
+            self.main_image.set_selection(Selection.from_points(self.drag_start, self.screen_to_image(mouse_pos),
+                                                                self.main_image.pil_image.size, ellipse))
+            self.drag_start = self.drag_end = None
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.main_image.set_selection(None)
+
+    def check_painting_events(self, event, mouse_pos):
+        """
+        Handles painting brush strokes on the image.
+
+        Args:
+        - event: The Pygame event.
+        - mouse_pos: The position of the mouse.
+        """
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(mouse_pos):
+            self.stroke = self.main_image.begin_stroke(self.tools.color, self.tools.radius,
+                                                       self.tools.tool == "eraser")
+            self.paint_to(mouse_pos)
+        elif event.type == pygame.MOUSEMOTION and self.stroke is not None:
+            self.paint_to(mouse_pos)
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1 and self.stroke is not None:
+            self.main_image.end_stroke(self.stroke)
+            self.stroke = None
+
+    def paint_to(self, mouse_pos):
+        """
+        Continues the stroke to the position of the mouse and updates the changed part of the display.
+
+        Args:
+        - mouse_pos: The position of the mouse.
+        """
+        box = self.stroke.add_point(self.screen_to_image(mouse_pos))
+        self.update_region(self.stroke.image, box)
+
+    def update_region(self, pil_image, box):
+        """
+        Updates a part of the displayed surface without converting the whole image.
+
+        Args:
+        - pil_image: The PIL image being displayed.
+        - box: The (left, top, right, bottom) box of the changed pixels.
+        """
+        if box[2] <= box[0] or box[3] <= box[1] or self.previewing:
+            return
+        if self.shares_pixels:
+            # The pixels of the image must not change, so the surface gets its own copy.
+            self.image_data = self.image_data.copy()
+            self.shares_pixels = False
+            self.displayed_image = None
+            self.surface_cache[self.main_image] = (self.image_data, None)
+        display_size = self.image_data.get_size()
+        if display_size == pil_image.size:
+            target = box
+            region = pil_image.crop(box).convert("RGBA")
+        else:
+            # Display pixel x shows image pixel x * width // display width, as in pygame.transform.scale.
+            width, height = pil_image.size
+            target = (-(-box[0] * display_size[0] // width), -(-box[1] * display_size[1] // height),
+                      -(-box[2] * display_size[0] // width), -(-box[3] * display_size[1] // height))
+            if target[2] <= target[0] or target[3] <= target[1]:
+                return
+            columns = np.arange(target[0], target[2]) * width // display_size[0]
+            rows = np.arange(target[1], target[3]) * height // display_size[1]
+            source = pil_image.crop((columns[0], rows[0], columns[-1] + 1, rows[-1] + 1)).convert("RGBA")
+            region = Image.fromarray(np.asarray(source)[np.ix_(rows - rows[0], columns - columns[0])])
+        surface = pygame.image.frombuffer(region.tobytes(), region.size, "RGBA")
+        rect = pygame.Rect(target[0], target[1], region.width, region.height)
+        # Clearing first and taking the maximum copies the pixels, alpha included, without blending.
+        self.image_data.fill((0, 0, 0, 0), rect)
+        self.image_data.blit(surface, rect, special_flags=pygame.BLEND_RGBA_MAX)
+
+    def draw_selection(self):
+        """
+        Draws the outline of the selection, or of the selection being dragged.
+        """
+        if self.drag_start is not None:
+            start, end = self.drag_start, self.drag_end
+            ellipse = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
+        elif self.main_image.selection is not None:
+            start, end = self.main_image.selection.box[:2], self.main_image.selection.box[2:]
+            ellipse = self.main_image.selection.shape == "ellipse"
+        else:
+            return
+        start, end = self.image_to_screen(start), self.image_to_screen(end)
+        outline = pygame.Rect(min(start[0], end[0]), min(start[1], end[1]),
+                              abs(end[0] - start[0]) + 1, abs(end[1] - start[1]) + 1)
+        if ellipse:
+            pygame.draw.ellipse(self.screen, self.selection_color, outline, 1)
+        else:
+            pygame.draw.rect(self.screen, self.selection_color, outline, 1)
+
     def get_display_pixels(self):
         """
         Gets the pixel data from the canvas.
@@ -59,6 +227,7 @@ class Canvas(ElementBase):
             x_pos = self.pos[0] + (self.rect.width/2) - (self.image_data.get_width()//2)
             y_pos = self.pos[1] + (self.rect.height/2) - (self.image_data.get_height()//2)
             self.screen.blit(self.image_data, (x_pos, y_pos))
+            self.draw_selection()
 
     def add_image(self, image: IEPImage):
         """
@@ -67,13 +236,37 @@ class Canvas(ElementBase):
         Args:
         - image: An instance of IEPImage to be added to the canvas.
          """
+        if self.stroke is not None:
+            self.main_image.end_stroke(self.stroke)
+            self.stroke = None
         self.main_image = image
-        im = image.pil_image.convert("RGBA")
-        image_data = im.tobytes()
-        image_dimensions = im.size
-        self.image_data = pygame.image.fromstring(image_data, image_dimensions, "RGBA")
+        self.drag_start = self.drag_end = None
+        if image in self.surface_cache and not image.changed:
+            self.image_data, self.displayed_image = self.surface_cache[image]
+            self.shares_pixels = self.displayed_image is not None
+        else:
+            self.set_displayed_image(image.pil_image)
+            self.surface_cache[image] = (self.image_data, self.displayed_image)
+            image.disable_changed()
         self.has_image = True
-        self.fit_image_on_screen()
+        self.previewing = False
+
+    def remove_image(self, image=None):
+        """
+        Removes the image from the canvas.
+
+        Args:
+        - image: If given, only this image is removed, and only its cached surface is forgotten.
+        """
+        if image is not None:
+            self.surface_cache.pop(image, None)
+            if image is not self.main_image:
+                return
+        self.main_image = None
+        self.image_data = None
+        self.displayed_image = None
+        self.has_image = False
+        self.previewing = False
 
     def update(self):
         """
@@ -81,16 +274,71 @@ class Canvas(ElementBase):
         """
         if self.has_image:
             if self.main_image.changed:
-                im = self.main_image.pil_image.convert("RGBA")
-                image_data = im.tobytes()
-                image_dimensions = im.size
-                self.image_data = pygame.image.fromstring(image_data, image_dimensions, "RGBA")
+                self.set_displayed_image(self.main_image.pil_image)
+                self.surface_cache[self.main_image] = (self.image_data, self.displayed_image)
                 self.main_image.disable_changed()
-                self.fit_image_on_screen()
+                self.previewing = False
+
+    def set_displayed_image(self, pil_image):
+        """
+        Converts a PIL image to the surface displayed by the canvas. Views of pixel arrays
+        are displayed without copying them when they are not scaled, and RGB images are
+        displayed without converting them.
+
+        Args:
+        - pil_image: The PIL image to display.
+        """
+        pixels = view_pixels(pil_image)
+        if pixels is not None:
+            self.image_data = pygame.image.frombuffer(pixels, pil_image.size, "RGBA")
+        else:
+            im = pil_image if pil_image.mode in ("RGBA", "RGB") else pil_image.convert("RGBA")
+            # update_region draws into the surface, so it must own its pixels.
+            self.image_data = pygame.image.frombytes(im.tobytes(), im.size, im.mode)
+        self.shares_pixels = pixels is not None
+        self.displayed_image = pil_image if self.shares_pixels else None
+        self.fit_image_on_screen()
+
+    def show_preview(self, pil_image):
+        """
+        Temporarily displays a preview instead of the image.
+
+        Args:
+        - pil_image: The PIL image of the preview.
+        """
+        if self.has_image:
+            self.set_displayed_image(pil_image)
+            self.previewing = True
+
+    def clear_preview(self):
+        """
+        Displays the image again if a preview is shown.
+        """
+        if self.previewing:
+            if not self.main_image.changed:
+                self.set_displayed_image(self.main_image.pil_image)
+            self.previewing = False
+
+    def get_display_size(self, size):
+        """
+        Returns the size at which an image of a given size is displayed.
+
+        Args:
+        - size: The size of the image.
+
+        Returns:
+        - The size of the image on the screen.
+        """
+        if (size[1] > self.rect.height) or (size[0] > self.rect.width):
+            return self.rect.width, self.rect.height
+        return size
 
     def fit_image_on_screen(self):
         """
         Fits the image on the screen if size of the image is bigger than the screen.
         """
-        if (self.image_data.get_height() > self.rect.height) or (self.image_data.get_width() > self.rect.width):
-            self.image_data = pygame.transform.scale(self.image_data, (self.rect.width, self.rect.height))
+        display_size = self.get_display_size(self.image_data.get_size())
+        if display_size != self.image_data.get_size():
+            self.image_data = pygame.transform.scale(self.image_data, display_size)
+            self.shares_pixels = False
+            self.displayed_image = None
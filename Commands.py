@@ -1,8 +1,16 @@
+import hashlib
+import os
+import numpy as np
 import PIL.ImageEnhance
 from PIL import Image, ImageFilter
 from PIL import ImageOps
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from WorkingBuffer import apply_lut
+
+# Largest width or height accepted for an image, the limit of the JPEG format.
+MAX_IMAGE_SIDE = 65535
 
 
 class ElementType(Enum):
@@ -24,10 +32,24 @@ class Command(ABC):
     Attributes:
     - type: Represents the type of command.
     - save_needed: Indicates if saving the command is necessary.
+    - halo: Number of neighbouring pixels needed to compute a pixel, None if the whole image is needed.
+    - in_place: Indicates if the command is executed with execute_in_place, only possible for
+      subclasses of InPlaceCommand.
+    - modes: Pixel modes the command executes on without converting the image, the preferred
+      mode first, or None if it accepts any mode. Commands working in place always use RGBA.
+    - changes_size: Indicates if the result may have another size than the image. Such
+      commands cannot be restricted to a selection.
+    - geometric: Indicates if the command only moves or cuts pixels. Such commands always
+      process the whole image, even if a part of it is selected.
     """
     def __init__(self, save=True):
         self.type = None
         self.save_needed = save
+        self.halo = None
+        self.in_place = False
+        self.modes = ("RGBA", "RGB", "L")
+        self.changes_size = False
+        self.geometric = False
 
     @abstractmethod
     def execute(self, image):
@@ -39,6 +61,97 @@ class Command(ABC):
         """
         pass
 
+    def parameters(self):
+        """
+        Returns the parameters of the command in a hashable form.
+
+        Returns:
+        - A tuple of parameters.
+        """
+        return ()
+
+    def get_inverse(self):
+        """
+        Returns the command exactly reversing this one.
+
+        Returns:
+        - A command restoring the image from the result, or None if the command loses information.
+        """
+        return None
+
+    def get_halo(self):
+        """
+        Returns the number of neighbouring pixels needed to compute a pixel.
+
+        Returns:
+        - The halo in pixels, or None if the command needs the whole image.
+        """
+        return self.halo
+
+    def accepts(self, mode):
+        """
+        Checks if the command executes on images of a mode without converting them.
+
+        Args:
+        - mode: A PIL pixel mode.
+
+        Returns:
+        - True if no conversion is needed.
+        """
+        if self.in_place:
+            return mode == "RGBA"
+        return self.modes is None or mode in self.modes
+
+    def get_output_mode(self, mode):
+        """
+        Returns the pixel mode of the result of the command.
+
+        Args:
+        - mode: The pixel mode of the image the command executes on, one it accepts.
+
+        Returns:
+        - The pixel mode of the new image.
+        """
+        return "RGBA" if self.in_place else mode
+
+
+class InPlaceCommand(Command):
+    """
+    An abstract base class for commands able to modify RGBA pixels in place, which the
+    pipeline executes on pooled pixel arrays instead of creating images.
+
+    Attributes:
+    - Inherits attributes from the Command class.
+    - in_place: True, can be set to False to execute the command on copies instead.
+    """
+    def __init__(self, save=True):
+        super().__init__(save)
+        self.in_place = True
+
+    @abstractmethod
+    def execute_in_place(self, pixels):
+        """
+        Executes the command on RGBA pixels, modifying them in place.
+
+        Args:
+        - pixels: C-contiguous (height, width, 4) uint8 array.
+        """
+        pass
+
+    def execute_on_copy(self, image):
+        """
+        Executes the command on a copy of an image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new RGBA image.
+        """
+        pixels = np.array(image.convert("RGBA"))
+        self.execute_in_place(pixels)
+        return Image.fromarray(pixels, "RGBA")
+
 
 class NumericCommand(Command):
     """
@@ -48,7 +161,11 @@ class NumericCommand(Command):
     - Inherits attributes from the Command class.
     - type: Represents the type of command (numeric value).
     - data: Stores data related to the command.
+    - PARAMETERS: Dictionary mapping the names of the accepted data to their (type, minimum,
+      maximum). The type is int for whole numbers and float for any number.
     """
+    PARAMETERS = {}
+
     def __init__(self):
         super().__init__()
         self.type = ElementType.NUMERIC_VALUE
@@ -73,6 +190,50 @@ class NumericCommand(Command):
         """
         self.data = data
 
+    @classmethod
+    def validate_data(cls, data):
+        """
+        Checks data before it is assigned from outside the menu: like the numeric boxes,
+        only the parameters of the command are accepted, each a number in its range.
+
+        Args:
+        - data: The data to be checked.
+
+        Raises:
+        - ValueError: If a parameter is unknown, not a number of its type or out of its range.
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"The data must be a dictionary, not {data!r}")
+        for name, value in data.items():
+            if name not in cls.PARAMETERS:
+                raise ValueError(f"Unknown parameter {name!r}, expected one of {sorted(cls.PARAMETERS)}")
+            value_type, minimum, maximum = cls.PARAMETERS[name]
+            types = (int,) if value_type is int else (int, float)
+            if isinstance(value, bool) or not isinstance(value, types):
+                kind = "a whole number" if value_type is int else "a number"
+                raise ValueError(f"{name!r} must be {kind}, not {value!r}")
+            if not minimum <= value <= maximum:
+                raise ValueError(f"{name!r} must be between {minimum} and {maximum}, not {value!r}")
+
+    def parameters(self):
+        """
+        Returns the assigned data in a hashable form.
+
+        Returns:
+        - A sorted tuple of (name, value) pairs.
+        """
+        return tuple(sorted(self.data.items()))
+
+    def __copy__(self):
+        """
+        Returns a copy of the command with its own data, as the menu keeps filling the
+        dictionary it assigned.
+        """
+        duplicate = self.__class__.__new__(self.__class__)
+        duplicate.__dict__.update(self.__dict__)
+        duplicate.data = dict(self.data)
+        return duplicate
+
 
 class ChangePixelSize(NumericCommand):
     """
@@ -81,8 +242,12 @@ class ChangePixelSize(NumericCommand):
     Attributes:
     - Inherits attributes from the NumericCommand class.
     """
+    PARAMETERS = {"x": (int, 1, MAX_IMAGE_SIDE), "y": (int, 1, MAX_IMAGE_SIDE)}
+
     def __init__(self):
         super().__init__()
+        self.modes = None
+        self.changes_size = True
 
     def execute(self, image):
         """
@@ -100,6 +265,196 @@ class ChangePixelSize(NumericCommand):
         if "y" in self.data:
             new_image = image.resize((image.width, self.data["y"]), resample=Image.BOX)
             return new_image
+        return image
+
+
+class Resize(NumericCommand):
+    """
+    A class representing a command to resize both dimensions of an image in one step.
+
+    Large downscales are done in two steps: the image is first reduced by an integer factor
+    with a fast box average and only the remaining factor is resampled with the filter of
+    the chosen quality mode.
+
+    Attributes:
+    - Inherits attributes from the NumericCommand class.
+    - data: "x" and "y" are the new width and height, 0 or missing keeps the dimension
+      unless the aspect ratio is locked. "aspect lock" set to 1 keeps the aspect ratio and
+      fits the image inside the given dimensions. "quality" selects the mode from QUALITY_MODES.
+    """
+    FAST = 0
+    BALANCED = 1
+    HIGH_QUALITY = 2
+
+    PARAMETERS = {"x": (int, 0, MAX_IMAGE_SIDE), "y": (int, 0, MAX_IMAGE_SIDE), "aspect lock": (int, 0, 1),
+                  "quality": (int, FAST, HIGH_QUALITY)}
+
+    # Resampling filter and reducing gap of every quality mode
+    QUALITY_MODES = {FAST: (Image.BILINEAR, 1.0),
+                     BALANCED: (Image.BICUBIC, 2.0),
+                     HIGH_QUALITY: (Image.LANCZOS, 3.0)}
+
+    def __init__(self):
+        super().__init__()
+        self.modes = None
+        self.changes_size = True
+
+    def get_target_size(self, size):
+        """
+        Computes the size of the resized image.
+
+        Args:
+        - size: The current size of the image.
+
+        Returns:
+        - The new width and height.
+        """
+        width, height = size
+        new_width = self.data.get("x", 0)
+        new_height = self.data.get("y", 0)
+        if self.data.get("aspect lock", 0):
+            if new_width and new_height:
+                scale = min(new_width / width, new_height / height)
+            elif new_width:
+                scale = new_width / width
+            elif new_height:
+                scale = new_height / height
+            else:
+                scale = 1
+            return max(1, round(width * scale)), max(1, round(height * scale))
+        return new_width or width, new_height or height
+
+    def execute(self, image):
+        """
+        Executes the command to resize the image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new resized image, or the same image if its size does not change.
+        """
+        size = self.get_target_size(image.size)
+        if size == image.size:
+            return image
+        quality = min(max(self.data.get("quality", self.BALANCED), self.FAST), self.HIGH_QUALITY)
+        resample, reducing_gap = self.QUALITY_MODES[quality]
+        # Pillow ignores reducing_gap for images with alpha, so the reduction is done here
+        factor = (max(1, int(image.width / size[0] / reducing_gap)),
+                  max(1, int(image.height / size[1] / reducing_gap)))
+        if factor != (1, 1):
+            image = image.reduce(factor)
+        return image.resize(size, resample=resample)
+
+
+class Crop(NumericCommand):
+    """
+    A class representing a command to cut out a rectangle of an image. Pixels are copied,
+    never resampled.
+
+    Attributes:
+    - Inherits attributes from the NumericCommand class.
+    - data: "left" and "top" are the corner of the rectangle, "width" and "height" its size.
+      A width or height of 0 or missing extends the rectangle to the edge of the image. The
+      rectangle is limited to the image.
+    """
+    PARAMETERS = {name: (int, 0, MAX_IMAGE_SIDE) for name in ("left", "top", "width", "height")}
+
+    def __init__(self):
+        super().__init__()
+        self.modes = None
+        self.changes_size = True
+        self.geometric = True
+
+    def get_box(self, size):
+        """
+        Computes the rectangle cut out of an image.
+
+        Args:
+        - size: The size of the image.
+
+        Returns:
+        - The (left, top, right, bottom) box inside the image.
+        """
+        left = min(max(self.data.get("left", 0), 0), size[0] - 1)
+        top = min(max(self.data.get("top", 0), 0), size[1] - 1)
+        right = min(left + (self.data.get("width", 0) or size[0]), size[0])
+        bottom = min(top + (self.data.get("height", 0) or size[1]), size[1])
+        return left, top, right, bottom
+
+    def execute(self, image):
+        """
+        Executes the command to crop the image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - The cropped image, or the same image if the rectangle covers all of it.
+        """
+        box = self.get_box(image.size)
+        if box == (0, 0) + image.size:
+            return image
+        return image.crop(box)
+
+
+class Transpose(Command):
+    """
+    A class representing a command to flip an image or to rotate it by a multiple of 90
+    degrees. Pixels are only moved, never resampled, so the command is exactly reversed by
+    its inverse.
+
+    Attributes:
+    - Inherits attributes from the Command class.
+    - operation: One of OPERATIONS. The rotations turn the image counterclockwise.
+    """
+    OPERATIONS = {"flip_left_right": Image.Transpose.FLIP_LEFT_RIGHT,
+                  "flip_top_bottom": Image.Transpose.FLIP_TOP_BOTTOM,
+                  "rotate_90": Image.Transpose.ROTATE_90,
+                  "rotate_180": Image.Transpose.ROTATE_180,
+                  "rotate_270": Image.Transpose.ROTATE_270,
+                  "transpose": Image.Transpose.TRANSPOSE,
+                  "transverse": Image.Transpose.TRANSVERSE}
+    INVERSES = {"rotate_90": "rotate_270", "rotate_270": "rotate_90"}
+
+    def __init__(self, operation="rotate_90"):
+        super().__init__()
+        if operation not in self.OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+        self.operation = operation
+        self.modes = None
+        self.changes_size = operation in ("rotate_90", "rotate_270", "transpose", "transverse")
+        self.geometric = True
+
+    def parameters(self):
+        """
+        Returns the parameters of the command in a hashable form.
+
+        Returns:
+        - A tuple holding the operation.
+        """
+        return (self.operation,)
+
+    def get_inverse(self):
+        """
+        Returns the command exactly reversing this one.
+
+        Returns:
+        - A Transpose: the opposite rotation, or the same operation for flips and rotate_180.
+        """
+        return Transpose(self.INVERSES.get(self.operation, self.operation))
+
+    def execute(self, image):
+        """
+        Executes the command to flip or rotate the image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new image with the pixels moved.
+        """
+        return image.transpose(self.OPERATIONS[self.operation])
 
 
 class SimpleBlur(Command):
@@ -111,6 +466,7 @@ class SimpleBlur(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 2
 
     def execute(self, image):
         """
@@ -126,16 +482,32 @@ class SimpleBlur(Command):
         return new_image
 
 
-class GaussianBlur(Command):
+class GaussianBlur(NumericCommand):
     """
     A class representing a command to apply Gaussian blur to an image.
 
+    Pillow approximates the Gaussian with three extended box blur passes computed with
+    running sums, so the time per pixel is the same for every radius. Away from the image
+    border the result differs from the exact Gaussian by less than 3 levels of 255.
+
     Attributes:
-    - Inherits attributes from the Command class.
+    - Inherits attributes from the NumericCommand class.
+    - data: "radius" is the standard deviation of the blur in pixels (3 if not given).
     """
+    PARAMETERS = {"radius": (float, 0, 200)}
+
     def __init__(self):
         super().__init__()
 
+    def get_halo(self):
+        """
+        Returns the number of neighbouring pixels needed to compute a pixel.
+
+        Returns:
+        - Three times the radius, where the Gaussian becomes negligible, plus a margin.
+        """
+        return int(3 * self.data.get("radius", 3)) + 2
+
     def execute(self, image):
         """
         Executes the command to apply Gaussian blur to the image.
@@ -146,8 +518,10 @@ class GaussianBlur(Command):
         Returns:
         - A new image with the applied Gaussian blur effect.
         """
-        # Adjust Radius
-        new_image = image.filter(ImageFilter.GaussianBlur(radius=3))
+        radius = self.data.get("radius", 3)
+        if radius <= 0:
+            return image.copy()
+        new_image = image.filter(ImageFilter.GaussianBlur(radius=radius))
         return new_image
 
 
@@ -160,6 +534,7 @@ class Sharpen(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -184,6 +559,7 @@ class EdgeEnhance(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -209,6 +585,7 @@ class Emboss(Command):
 
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -233,6 +610,7 @@ class Contour(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -257,6 +635,7 @@ class Detail(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -281,6 +660,7 @@ class Smooth(Command):
     """
     def __init__(self):
         super().__init__()
+        self.halo = 1
 
     def execute(self, image):
         """
@@ -302,9 +682,13 @@ class Saturation(NumericCommand):
 
     Attributes:
     - Inherits attributes from the NumericCommand class.
+    - data: "Saturation level" is the factor of the saturation, 1 keeps the colors (if not given).
     """
+    PARAMETERS = {"Saturation level": (float, 0, 100)}
+
     def __init__(self):
         super().__init__()
+        self.halo = 0
 
     def execute(self, image):
         """
@@ -317,23 +701,24 @@ class Saturation(NumericCommand):
         - A new image with the adjusted saturation level.
         """
         converter = PIL.ImageEnhance.Color(image)
-        new_image = converter.enhance(self.data["Saturation level"])
+        new_image = converter.enhance(self.data.get("Saturation level", 1))
         return new_image
 
 
-class Inversion(Command):
+class Inversion(InPlaceCommand):
     """
     A class representing a command to invert colors in an image.
 
     Attributes:
-    - Inherits attributes from the Command class.
+    - Inherits attributes from the InPlaceCommand class.
     """
     def __init__(self):
         super().__init__()
+        self.halo = 0
 
     def execute(self, image):
         """
-        Executes the command to invert colors in the image.
+        Executes the command to invert colors in the image. Alpha is kept.
 
         Args:
         - image: The image object on which the command is to be executed.
@@ -341,9 +726,17 @@ class Inversion(Command):
         Returns:
         - A new image with inverted colors.
         """
-        new_image = image.convert("RGB")
-        new_image = ImageOps.invert(new_image)
-        return new_image
+        return self.execute_on_copy(image)
+
+    def execute_in_place(self, pixels):
+        """
+        Inverts the color bands of RGBA pixels in place. Alpha is kept.
+
+        Args:
+        - pixels: C-contiguous (height, width, 4) uint8 array.
+        """
+        color = pixels[:, :, :3]
+        np.bitwise_not(color, out=color)
 
 
 class HistogramEqualization(Command):
@@ -355,6 +748,19 @@ class HistogramEqualization(Command):
     """
     def __init__(self):
         super().__init__()
+        self.modes = None
+
+    def get_output_mode(self, mode):
+        """
+        Returns the pixel mode of the result of the command.
+
+        Args:
+        - mode: The pixel mode of the image the command executes on.
+
+        Returns:
+        - "L", as the equalized image is grayscale.
+        """
+        return "L"
 
     def execute(self, image):
         """
@@ -371,19 +777,172 @@ class HistogramEqualization(Command):
         return new_image
 
 
-class ColorBalance(NumericCommand):
+class AdaptiveEqualization(Command):
+    """
+    A class representing a command to perform contrast limited adaptive histogram equalization.
+
+    The luminance is equalized separately in a grid of tiles. Histograms are clipped to limit
+    the amplification of noise and the resulting mappings are blended bilinearly between tile
+    centers. Colors and transparency of the image are kept. Tiles are processed in parallel.
+
+    Attributes:
+    - Inherits attributes from the Command class.
+    - tiles: Number of tiles along each axis.
+    - clip_limit: Maximum height of a histogram bin relative to a uniform histogram.
+    """
+    def __init__(self, tiles=8, clip_limit=2.0):
+        super().__init__()
+        self.tiles = tiles
+        self.clip_limit = clip_limit
+        self.modes = None
+
+    def parameters(self):
+        """
+        Returns the parameters of the command in a hashable form.
+
+        Returns:
+        - A tuple of the tile grid and the clip limit.
+        """
+        return self.tiles, self.clip_limit
+
+    def get_output_mode(self, mode):
+        """
+        Returns the pixel mode of the result of the command.
+
+        Args:
+        - mode: The pixel mode of the image the command executes on.
+
+        Returns:
+        - "L" for grayscale images, otherwise "RGB" or "RGBA" depending on the alpha band.
+        """
+        if mode == "L":
+            return "L"
+        return "RGBA" if "A" in mode else "RGB"
+
+    def execute(self, image):
+        """
+        Executes the command to perform adaptive equalization on the image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new image with equalized luminance.
+        """
+        if image.mode == "L":
+            bands = (image,)
+        else:
+            bands = image.convert("YCbCr").split()
+        luminance = np.asarray(bands[0])
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            equalized = self.equalize(luminance, executor)
+        if image.mode == "L":
+            return Image.fromarray(equalized)
+        new_image = Image.merge("YCbCr", (Image.fromarray(equalized),) + bands[1:]).convert("RGB")
+        if "A" in image.getbands():
+            new_image.putalpha(image.getchannel("A"))
+        return new_image
+
+    def equalize(self, luminance, executor):
+        """
+        Equalizes a single band.
+
+        Args:
+        - luminance: A 2D uint8 array.
+        - executor: Executor processing the tiles.
+
+        Returns:
+        - A new 2D uint8 array.
+        """
+        height, width = luminance.shape
+        tile_height = -(-height // min(self.tiles, height))
+        tile_width = -(-width // min(self.tiles, width))
+        rows = -(-height // tile_height)
+        columns = -(-width // tile_width)
+
+        def histogram(index):
+            row, column = divmod(index, columns)
+            tile = luminance[row * tile_height:(row + 1) * tile_height,
+                             column * tile_width:(column + 1) * tile_width]
+            return np.bincount(tile.ravel(), minlength=256)
+
+        histograms = np.array(list(executor.map(histogram, range(rows * columns))), dtype=np.float64)
+        pixels = histograms.sum(axis=1, keepdims=True)
+        limit = np.maximum(self.clip_limit * pixels / 256, 1)
+        excess = np.maximum(histograms - limit, 0).sum(axis=1, keepdims=True)
+        histograms = np.minimum(histograms, limit) + excess / 256
+        mappings = (np.cumsum(histograms, axis=1) * (255 / pixels)).astype(np.float32)
+        mappings = mappings.reshape(rows, columns, 256)
+
+        result = np.empty_like(luminance)
+
+        def blend(spans):
+            (top, bottom, first_row, second_row, row_weights), (left, right, first_column, second_column,
+                                                                column_weights) = spans
+            values = luminance[top:bottom, left:right]
+            upper = self._blend_columns(values, mappings[first_row], first_column, second_column, column_weights)
+            if first_row != second_row:
+                lower = self._blend_columns(values, mappings[second_row], first_column, second_column,
+                                            column_weights)
+                upper += (lower - upper) * row_weights[:, None]
+            upper += 0.5
+            result[top:bottom, left:right] = upper
+
+        row_spans = self._interpolation_spans(height, tile_height, rows)
+        column_spans = self._interpolation_spans(width, tile_width, columns)
+        list(executor.map(blend, [(r, c) for r in row_spans for c in column_spans]))
+        return result
+
+    @staticmethod
+    def _blend_columns(values, mappings, first, second, weights):
+        blended = np.take(mappings[first], values)
+        if first != second:
+            blended += (np.take(mappings[second], values) - blended) * weights
+        return blended
+
+    @staticmethod
+    def _interpolation_spans(length, tile, count):
+        """
+        Splits an axis into spans between neighbouring tile centers.
+
+        Returns:
+        - A list of (start, stop, first tile, second tile, weights of the second tile).
+        """
+        centers = np.minimum((np.arange(count) + 0.5) * tile, length - 0.5)
+        edges = [0] + [int(np.ceil(center)) for center in centers] + [length]
+        spans = []
+        for index in range(count + 1):
+            start, stop = edges[index], edges[index + 1]
+            if start >= stop:
+                continue
+            first = max(index - 1, 0)
+            second = min(index, count - 1)
+            if first == second:
+                weights = np.zeros(stop - start, dtype=np.float32)
+            else:
+                positions = np.arange(start, stop) + 0.5
+                weights = ((positions - centers[first]) / (centers[second] - centers[first])).astype(np.float32)
+            spans.append((start, stop, first, second, weights))
+        return spans
+
+
+class ColorBalance(NumericCommand, InPlaceCommand):
     """
     A class representing a command to adjust color balance in an image.
 
     Attributes:
-    - Inherits attributes from the NumericCommand class.
+    - Inherits attributes from the NumericCommand and InPlaceCommand classes.
+    - data: "r", "g" and "b" are the factors of the color channels.
     """
+    PARAMETERS = {name: (float, 0, 100) for name in ("r", "g", "b")}
+
     def __init__(self):
         super().__init__()
+        self.halo = 0
 
     def execute(self, image):
         """
-        Executes the command to adjust color balance in the image.
+        Executes the command to adjust color balance in the image. Alpha is kept.
 
         Args:
         - image: The image object on which the command is to be executed.
@@ -391,13 +950,313 @@ class ColorBalance(NumericCommand):
         Returns:
         - A new image with adjusted color balance.
         """
-        new_image = image.convert("RGB")
-        r, g, b = new_image.split()
-        if "r" in self.data:
-            r = r.point(lambda i: i * self.data["r"])
-        if "g" in self.data:
-            g = g.point(lambda i: i * self.data["g"])
-        if "b" in self.data:
-            b = b.point(lambda i: i * self.data["b"])
-        new_image = Image.merge("RGB", (r, g, b))
+        return self.execute_on_copy(image)
+
+    def execute_in_place(self, pixels):
+        """
+        Scales the color bands of RGBA pixels in place.
+
+        Args:
+        - pixels: C-contiguous (height, width, 4) uint8 array.
+        """
+        values = np.arange(256)
+        for band, name in enumerate(("r", "g", "b")):
+            if name in self.data:
+                lut = np.clip(np.rint(values * self.data[name]), 0, 255).astype(np.uint8)
+                apply_lut(pixels[:, :, band], lut)
+
+
+class PaintStroke(InPlaceCommand):
+    """
+    A class representing a command pasting the regions painted by a brush stroke.
+    It is used to replay strokes recorded in the journal.
+
+    Attributes:
+    - Inherits attributes from the InPlaceCommand class.
+    - patches: List of ((left, top, right, bottom) box, painted region) pairs.
+    """
+    def __init__(self, patches=()):
+        super().__init__()
+        self.patches = list(patches)
+        for box, region in self.patches:
+            if len(box) != 4 or not isinstance(region, Image.Image):
+                raise ValueError("A patch must be a (left, top, right, bottom) box and an image")
+
+    def parameters(self):
+        """
+        Returns the parameters of the command in a hashable form.
+
+        Returns:
+        - A tuple of the box, mode and content hash of every painted region.
+        """
+        return tuple((box, region.mode, hashlib.blake2b(region.tobytes(), digest_size=16).hexdigest())
+                     for box, region in self.patches)
+
+    def execute(self, image):
+        """
+        Executes the command to paste the painted regions into the image.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new image with the painted regions.
+        """
+        new_image = image.copy()
+        for box, region in self.patches:
+            new_image.paste(region, box[:2])
         return new_image
+
+    def execute_in_place(self, pixels):
+        """
+        Pastes the painted regions into RGBA pixels in place.
+
+        Args:
+        - pixels: C-contiguous (height, width, 4) uint8 array.
+        """
+        for box, region in self.patches:
+            pixels[box[1]:box[3], box[0]:box[2]] = np.asarray(region.convert("RGBA"))
+
+
+def fast_fft_length(length):
+    """
+    Returns the smallest length of at least the given length with no prime factor above 5,
+    for which the FFT is fast.
+
+    Args:
+    - length: The minimum length.
+    """
+    best = 2 * length
+    power_of_five = 1
+    while power_of_five < best:
+        power_of_three = power_of_five
+        while power_of_three < best:
+            candidate = power_of_three
+            while candidate < length:
+                candidate *= 2
+            best = min(best, candidate)
+            power_of_three *= 3
+        power_of_five *= 5
+    return best
+
+
+class Convolution(Command):
+    """
+    A class representing a command to convolve an image with a kernel of any size.
+
+    Each output pixel is the sum of the kernel weights times the pixels around it, the weight
+    in row i and column j multiplying the pixel i - height // 2 rows below and j - width // 2
+    columns right of it, divided by the scale and increased by the offset. Pixels outside the
+    image repeat the nearest border pixel, and alpha is kept unchanged. Unlike ImageFilter.Kernel,
+    which flips the kernel vertically, the kernel is not flipped.
+
+    Three methods give the same result up to rounding:
+    - direct: one multiply-add over the image per kernel weight.
+    - separable: used for rank-1 kernels, which are the product of a column and a row,
+      as two one-dimensional passes costing height + width instead of height * width.
+    - fft: multiplication of the Fourier transforms, whose cost grows only with the size
+      of the image, used for large kernels.
+    The cheapest method is chosen with a cost model whose constants were measured with
+    Benchmarks.py convolution.
+
+    Attributes:
+    - Inherits attributes from the Command class.
+    - kernel: 2-D array of kernel weights. The center of the kernel is at (height // 2, width // 2).
+    - scale: Divisor of the weighted sum, the sum of the weights (or 1 if it is 0) if not given.
+    - offset: Value added after dividing by the scale.
+    - method: "direct", "separable" or "fft" to force a method, or None to choose by cost.
+    - factors: (column, row) vectors whose product is the kernel, or None if it is not separable.
+    """
+    DIRECT = "direct"
+    SEPARABLE = "separable"
+    FFT = "fft"
+    # Cost of one pass over the image per kernel weight, and of the transforms of one pixel
+    # per log2 of the transformed area, relative to each other.
+    TAP_COST = 1.0
+    FFT_COST = 1.7
+    SEPARABLE_TOLERANCE = 1e-7
+
+    def __init__(self, kernel=((0, 0, 0), (0, 1, 0), (0, 0, 0)), scale=None, offset=0, method=None):
+        super().__init__()
+        self.kernel = np.array(kernel, dtype=np.float64)
+        if self.kernel.ndim != 2 or self.kernel.size == 0:
+            raise ValueError("The kernel must be a non-empty 2-D array")
+        for name, value in (("scale", scale), ("offset", offset)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError(f"The {name} must be a number, not {value!r}")
+        if method not in (None, self.DIRECT, self.SEPARABLE, self.FFT):
+            raise ValueError(f"Unknown method: {method}")
+        total = self.kernel.sum()
+        self.scale = scale if scale is not None else (total if total != 0 else 1)
+        self.offset = offset
+        self.method = method
+        self.halo = max(self.kernel.shape) // 2
+        self.modes = None
+        self.factors = self.get_factors(self.kernel)
+
+    def parameters(self):
+        """
+        Returns the parameters of the command in a hashable form.
+
+        Returns:
+        - A tuple of the kernel shape, the kernel weights, the scale and the offset.
+        """
+        return self.kernel.shape, tuple(self.kernel.ravel().tolist()), self.scale, self.offset
+
+    @classmethod
+    def get_factors(cls, kernel):
+        """
+        Splits a rank-1 kernel into a column and a row vector.
+
+        Args:
+        - kernel: 2-D array of kernel weights.
+
+        Returns:
+        - Tuple of the column and row vectors, or None if the kernel is not separable.
+        """
+        u, s, vt = np.linalg.svd(kernel)
+        if s[0] == 0 or (len(s) > 1 and s[1] > cls.SEPARABLE_TOLERANCE * s[0]):
+            return None
+        return u[:, 0] * np.sqrt(s[0]), vt[0] * np.sqrt(s[0])
+
+    def estimate_costs(self, size):
+        """
+        Estimates the relative cost of every method for an image size.
+
+        Args:
+        - size: The (width, height) of the image.
+
+        Returns:
+        - Dictionary of method names and costs.
+        """
+        height, width = self.kernel.shape
+        pixels = size[0] * size[1]
+        area = fast_fft_length(size[0] + width - 1) * fast_fft_length(size[1] + height - 1)
+        costs = {self.DIRECT: self.TAP_COST * height * width * pixels,
+                 self.FFT: self.FFT_COST * area * np.log2(area)}
+        if self.factors is not None:
+            costs[self.SEPARABLE] = self.TAP_COST * (height + width) * pixels
+        return costs
+
+    def choose_method(self, size):
+        """
+        Returns the method used for an image size.
+
+        Args:
+        - size: The (width, height) of the image.
+        """
+        if self.method is not None:
+            return self.method
+        costs = self.estimate_costs(size)
+        return min(costs, key=costs.get)
+
+    def execute(self, image):
+        """
+        Executes the command to convolve the image with the kernel.
+
+        Args:
+        - image: The image object on which the command is to be executed.
+
+        Returns:
+        - A new convolved image.
+        """
+        alpha = image.getchannel("A") if image.mode in ("RGBA", "LA") else None
+        color = image.convert("RGB" if image.mode in ("RGBA", "P", "CMYK", "YCbCr") else
+                              "L" if image.mode == "LA" else image.mode)
+        pixels = np.asarray(color, dtype=np.float32)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        method = self.choose_method(image.size)
+        convolve = {self.DIRECT: self.convolve_direct, self.SEPARABLE: self.convolve_separable,
+                    self.FFT: self.convolve_fft}[method]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            channels = list(executor.map(convolve, [pixels[:, :, index] for index in range(pixels.shape[2])]))
+        result = np.stack(channels, axis=2) / self.scale + self.offset
+        result = np.clip(np.rint(result), 0, 255).astype(np.uint8)
+        new_image = Image.fromarray(result[:, :, 0] if result.shape[2] == 1 else result, color.mode)
+        if alpha is not None:
+            new_image = new_image.convert(image.mode)
+            new_image.putalpha(alpha)
+        return new_image
+
+    def pad(self, channel, height, width):
+        """
+        Repeats the border pixels of a channel around it for a kernel of the given size.
+
+        Args:
+        - channel: 2-D array of one channel.
+        - height: The height of the kernel.
+        - width: The width of the kernel.
+        """
+        return np.pad(channel, ((height // 2, height - 1 - height // 2), (width // 2, width - 1 - width // 2)),
+                      mode="edge")
+
+    def convolve_direct(self, channel):
+        """
+        Computes the weighted sum of one channel with one pass per kernel weight.
+
+        Args:
+        - channel: 2-D float32 array of one channel.
+
+        Returns:
+        - 2-D array of weighted sums.
+        """
+        kernel_height, kernel_width = self.kernel.shape
+        height, width = channel.shape
+        padded = self.pad(channel, kernel_height, kernel_width)
+        result = np.zeros((height, width), dtype=np.float32)
+        product = np.empty_like(result)
+        for y in range(kernel_height):
+            for x in range(kernel_width):
+                weight = self.kernel[y, x]
+                if weight != 0:
+                    np.multiply(padded[y:y + height, x:x + width], np.float32(weight), out=product)
+                    result += product
+        return result
+
+    def convolve_separable(self, channel):
+        """
+        Computes the weighted sum of one channel with a vertical and a horizontal pass.
+
+        Args:
+        - channel: 2-D float32 array of one channel.
+
+        Returns:
+        - 2-D array of weighted sums.
+        """
+        column, row = self.factors
+        height, width = channel.shape
+        padded = self.pad(channel, len(column), len(row))
+        vertical = np.zeros((height, padded.shape[1]), dtype=np.float32)
+        product = np.empty_like(vertical)
+        for y, weight in enumerate(column):
+            if weight != 0:
+                np.multiply(padded[y:y + height], np.float32(weight), out=product)
+                vertical += product
+        result = np.zeros((height, width), dtype=np.float32)
+        product = product[:, :width]
+        for x, weight in enumerate(row):
+            if weight != 0:
+                np.multiply(vertical[:, x:x + width], np.float32(weight), out=product)
+                result += product
+        return result
+
+    def convolve_fft(self, channel):
+        """
+        Computes the weighted sum of one channel by multiplying Fourier transforms.
+
+        Args:
+        - channel: 2-D float32 array of one channel.
+
+        Returns:
+        - 2-D array of weighted sums.
+        """
+        kernel_height, kernel_width = self.kernel.shape
+        height, width = channel.shape
+        padded = self.pad(channel, kernel_height, kernel_width)
+        shape = (fast_fft_length(padded.shape[0]), fast_fft_length(padded.shape[1]))
+        # The weighted sum is a convolution with the flipped kernel. Outputs that need only
+        # padded pixels are not affected by the wrap-around of the circular convolution.
+        spectrum = np.fft.rfft2(padded, shape) * np.fft.rfft2(self.kernel[::-1, ::-1], shape)
+        result = np.fft.irfft2(spectrum, shape)
+        return result[kernel_height - 1:kernel_height - 1 + height, kernel_width - 1:kernel_width - 1 + width]
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from WorkingBuffer import view_pixels
+
+
+class DecodeCache:
+    """
+    A class keeping the decoded RGBA pixels of recently opened files on disk, so reopening
+    them needs no decoding.
+
+    Entries are stored in the NumPy format: a short header followed by the raw pixels, which
+    are mapped into memory instead of being read. The system loads the pixels only when they
+    are used, so a cached file of any size opens at once. An entry is found again as long as
+    the path, size and modification time of its file do not change. When the entries take
+    more than the quota, the least recently used ones are removed.
+
+    Attributes:
+    - directory: The directory holding the entries.
+    - quota: Bytes of disk space the entries may take together.
+    - min_pixels: Images with fewer pixels decode quickly and are not stored.
+    - hits: Number of files mapped from the cache.
+    - misses: Number of files that were not cached.
+    """
+    EXTENSION = ".npy"
+
+    def __init__(self, directory, quota, min_pixels=0):
+        self.directory = directory
+        self.quota = quota
+        self.min_pixels = min_pixels
+        self.hits = 0
+        self.misses = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode-cache")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, path):
+        """
+        Returns the key of the entry of a file.
+
+        Args:
+        - path: The file path of the image.
+
+        Returns:
+        - A hex digest of the path, size and modification time of the file.
+        """
+        stat = os.stat(path)
+        identity = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        return hashlib.blake2b(repr(identity).encode(), digest_size=16).hexdigest()
+
+    def get(self, path):
+        """
+        Returns the cached pixels of a file without decoding it.
+
+        Args:
+        - path: The file path of the image.
+
+        Returns:
+        - A read-only RGBA PIL image sharing the memory mapped from the entry, or None if
+          the file is not cached.
+        """
+        try:
+            stored = os.path.join(self.directory, self.get_key(path) + self.EXTENSION)
+            pixels = np.load(stored, mmap_mode="r")
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if pixels.ndim != 3 or pixels.shape[2] != 4 or pixels.dtype != np.uint8:
+            self.misses += 1
+            return None
+        try:
+            # The modification time of an entry tells when it was last used.
+            os.utime(stored)
+        except OSError:
+            pass
+        self.hits += 1
+        return Image.frombuffer("RGBA", (pixels.shape[1], pixels.shape[0]), pixels, "raw", "RGBA", 0, 1)
+
+    def put(self, path, image):
+        """
+        Stores the decoded pixels of a file in the background. The entry appears complete or
+        not at all.
+
+        Args:
+        - path: The file path of the image.
+        - image: The decoded RGBA PIL image, which must not change afterwards.
+        """
+        size = image.width * image.height * 4
+        if image.width * image.height < self.min_pixels or size > self.quota:
+            return
+        try:
+            key = self.get_key(path)
+        except OSError:
+            return
+        self._executor.submit(self._write, key, image)
+
+    def _write(self, key, image):
+        pixels = view_pixels(image)
+        if pixels is None:
+            pixels = np.asarray(image.convert("RGBA"))
+        descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                np.save(file, pixels)
+            os.replace(temporary, os.path.join(self.directory, key + self.EXTENSION))
+        except OSError as e:
+            print(f"Decoded image could not be cached: {e}")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the entries fit into the quota.
+        """
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(self.EXTENSION):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.quota:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Some systems cannot remove a file that is mapped by an open document.
+                    continue
+                total -= size
+
+    def usage(self):
+        """
+        Returns the bytes of disk space taken by the entries.
+        """
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith(self.EXTENSION))
+
+    def shutdown(self):
+        """Waits until the pending entries are written."""
+        self._executor.shutdown(wait=True)
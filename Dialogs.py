@@ -0,0 +1,164 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+from FramePacer import report_progress
+
+
+def serve_dialogs(requests, results):
+    """
+    Shows the requested file dialogs one at a time. Runs in the helper process, which owns
+    the only Tk interpreter of the application.
+
+    Args:
+    - requests: Queue of (request id, "open" or "save", dialog options) tuples, None to stop.
+    - results: Queue receiving (request id, chosen path or "") pairs.
+    """
+    import tkinter as tk
+    from tkinter import filedialog
+    root = tk.Tk()
+    root.withdraw()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, kind, options = request
+        try:
+            if kind == "open":
+                path = filedialog.askopenfilename(parent=root, **options)
+            else:
+                path = filedialog.asksaveasfilename(parent=root, **options)
+        except tk.TclError as e:
+            print(f"File dialog failed: {e}")
+            path = ""
+        results.put((request_id, path or ""))
+    root.destroy()
+
+
+class DialogService:
+    """
+    A class showing file dialogs in a helper process, so the main loop keeps running and
+    redrawing while a dialog is open.
+
+    The helper process is started by the first request. Requests return at once. A thread
+    waits for the chosen paths and wakes the main loop, which calls poll to run the callbacks
+    of finished requests. If the helper process stops, pending requests finish with an empty
+    path and the next request starts a new one.
+
+    Attributes:
+    - process: The helper process, or None before start.
+    - pending: Dictionary mapping the ids of unfinished requests to their (callback, helper
+      process) pairs.
+    - listeners: Callables receiving every chosen path after the callback of its request.
+    """
+    def __init__(self):
+        self._context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.pending = {}
+        self.listeners = []
+        self._requests = None
+        self._results = None
+        self._finished = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the helper process and the thread forwarding its results, or restarts them
+        if the helper process stopped.
+        """
+        if self.process is not None and self.process.is_alive():
+            return
+        self._requests = self._context.Queue()
+        self._results = self._context.Queue()
+        self.process = self._context.Process(target=serve_dialogs, args=(self._requests, self._results),
+                                             name="dialogs", daemon=True)
+        self.process.start()
+        threading.Thread(target=self._forward_results, args=(self.process, self._results),
+                         name="dialog-results", daemon=True).start()
+
+    def shutdown(self):
+        """Closes the helper process."""
+        if self.process is not None and self.process.is_alive():
+            self._requests.put(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def is_busy(self):
+        """
+        Checks if a dialog is open or its result was not handled yet.
+
+        Returns:
+        - True while a request is pending.
+        """
+        return bool(self.pending)
+
+    def ask_open(self, callback, **options):
+        """
+        Requests a dialog choosing a file to open.
+
+        Args:
+        - callback: Called by poll with the chosen path, or "" if no file was chosen.
+        - options: Options of tkinter.filedialog.askopenfilename.
+
+        Returns:
+        - The id of the request.
+        """
+        return self._request("open", callback, options)
+
+    def ask_save(self, callback, **options):
+        """
+        Requests a dialog choosing a file to save to.
+
+        Args:
+        - callback: Called by poll with the chosen path, or "" if no file was chosen.
+        - options: Options of tkinter.filedialog.asksaveasfilename.
+
+        Returns:
+        - The id of the request.
+        """
+        return self._request("save", callback, options)
+
+    def _request(self, kind, callback, options):
+        self.start()
+        request_id = next(self._ids)
+        with self._lock:
+            self.pending[request_id] = (callback, self.process)
+        self._requests.put((request_id, kind, options))
+        return request_id
+
+    def _forward_results(self, process, results):
+        while True:
+            try:
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # The helper stopped, for example because no display is available.
+                with self._lock:
+                    lost = [request_id for request_id, (_, owner) in self.pending.items() if owner is process]
+                for request_id in lost:
+                    self._finished.put((request_id, ""))
+                if lost:
+                    print("The file dialog process stopped.")
+                    report_progress(job="dialog")
+                return
+            self._finished.put(result)
+            report_progress(job="dialog")
+
+    def poll(self):
+        """
+        Runs the callbacks of the requests finished since the last call. Never blocks.
+        """
+        while True:
+            try:
+                request_id, path = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                request = self.pending.pop(request_id, None)
+            if request is not None:
+                request[0](path)
+                for listener in self.listeners:
+                    listener(path)
@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import pygame
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ImageClass import IEPImage
+from Journal import recover_journal
+from InterfaceElement import ElementBase, TypeOfInteraction
+from ResultCache import ResultCache
+from WorkingBuffer import BufferPool
+
+
+class DocumentManager:
+    """
+    A class managing several open images sharing one memory budget.
+
+    When the loaded documents use more memory than the budget, the least recently used
+    inactive documents are moved with their history to compressed files on a background
+    thread. They are restored from these files when activated again.
+
+    Attributes:
+    - documents: List of open documents (instances of IEPImage).
+    - active: The active document or None.
+    - budget: Number of bytes the loaded documents may use together.
+    - storage_dir: Directory holding the unloaded documents.
+    - result_cache: Result cache shared by all documents.
+    - buffer_pool: BufferPool providing the pixel arrays of all documents.
+    - frame_workers: Number of worker threads editing the frames of animations.
+    - listeners: Callables registered as listeners of every opened document.
+    - journal_writer: JournalWriter recording the documents for crash recovery, or None.
+    - decode_cache: DecodeCache shared by all documents, or None.
+    """
+    def __init__(self, budget, cache_budget, storage_dir=None, journal_writer=None, pool_budget=256 * 1024 * 1024,
+                 frame_workers=None, decode_cache=None):
+        self.documents = []
+        self.active = None
+        self.budget = budget
+        self.storage_dir = storage_dir or tempfile.mkdtemp(prefix="imageedit-")
+        os.makedirs(self.storage_dir, exist_ok=True)
+        self.result_cache = ResultCache(cache_budget)
+        self.buffer_pool = BufferPool(pool_budget)
+        self.frame_workers = frame_workers
+        self.listeners = []
+        self.journal_writer = journal_writer
+        self.decode_cache = decode_cache
+        self._recently_used = OrderedDict()
+        self._evictions = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eviction")
+
+    def open(self, path):
+        """
+        Opens an image as a new active document.
+
+        Args:
+        - path: The file path of the image.
+
+        Returns:
+        - The new document.
+        """
+        document = self._create_document()
+        document.assign_image(path)
+        self.documents.append(document)
+        self.activate(document)
+        return document
+
+    def recover(self):
+        """
+        Reopens the documents of sessions that did not close cleanly from their journals.
+
+        Returns:
+        - List of recovered documents.
+        """
+        if self.journal_writer is None:
+            return []
+        recovered = []
+        for path in self.journal_writer.find_unfinished():
+            state = recover_journal(path)
+            if state is not None:
+                source_path, checkpoint, commands = state
+                document = self._create_document()
+                document.assign_pil_image(checkpoint, source_path)
+                for command, selection in commands:
+                    document.set_selection(selection)
+                    document.execute_command(command)
+                document.set_selection(None)
+                self.documents.append(document)
+                self.activate(document)
+                recovered.append(document)
+            os.remove(path)
+        return recovered
+
+    def _create_document(self):
+        document = IEPImage(result_cache=self.result_cache, buffer_pool=self.buffer_pool,
+                            frame_workers=self.frame_workers, decode_cache=self.decode_cache)
+        for listener in self.listeners:
+            document.add_listener(listener)
+        if self.journal_writer is not None:
+            document.journal = self.journal_writer.create_journal()
+        return document
+
+    def activate(self, document):
+        """
+        Makes a document active, restoring its data if it was unloaded.
+
+        Args:
+        - document: An open document.
+        """
+        eviction = self._evictions.pop(document, None)
+        if eviction is not None and not eviction.cancel():
+            eviction.result()
+        if not document.is_loaded():
+            document.reload()
+        self.active = document
+        self._recently_used[document] = None
+        self._recently_used.move_to_end(document)
+        self.enforce_budget()
+
+    def close(self, document):
+        """
+        Closes a document and activates the most recently used remaining one.
+
+        Args:
+        - document: An open document.
+        """
+        eviction = self._evictions.pop(document, None)
+        if eviction is not None:
+            eviction.result()
+        document.discard()
+        self.documents.remove(document)
+        self._recently_used.pop(document, None)
+        if document is self.active:
+            self.active = None
+            if self._recently_used:
+                self.activate(next(reversed(self._recently_used)))
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by the loaded documents.
+        """
+        return sum(document.memory_usage() for document in self.documents if document not in self._evictions)
+
+    def enforce_budget(self):
+        """
+        Unloads the least recently used inactive documents until the budget is respected.
+        """
+        for document, eviction in list(self._evictions.items()):
+            if eviction.done():
+                eviction.result()
+                del self._evictions[document]
+        usage = self.memory_usage()
+        for document in self._recently_used:
+            if usage <= self.budget:
+                break
+            if document is self.active or document in self._evictions or not document.is_loaded():
+                continue
+            usage -= document.memory_usage()
+            path = os.path.join(self.storage_dir, f"{id(document)}.bin")
+            self._evictions[document] = self._executor.submit(document.unload, path)
+
+    def shutdown(self):
+        """
+        Waits for pending evictions and cache entries, closes the documents and removes their
+        stored data.
+        """
+        self._executor.shutdown(wait=True)
+        for document in self.documents:
+            document.discard()
+        if self.journal_writer is not None:
+            self.journal_writer.shutdown()
+        if self.decode_cache is not None:
+            self.decode_cache.shutdown()
+        shutil.rmtree(self.storage_dir, ignore_errors=True)
+
+
+class DocumentTabs(ElementBase):
+    """
+    A class representing the row of tabs of open documents.
+    Left click activates a document, right click closes it.
+
+    Attributes:
+    - Inherits attributes from ElementBase.
+    - manager: The DocumentManager whose documents are shown.
+    - document: The document that was clicked.
+    - action: "activate" or "close".
+    """
+    def __init__(self, screen, position: tuple, width, height, manager, name="Documents",
+                 color: tuple = (100, 100, 100), active_color: tuple = (142, 165, 163)):
+        super().__init__(screen, position, name)
+        self.type_name = TypeOfInteraction.DOCUMENT
+        self.manager = manager
+        self.document = None
+        self.action = None
+        self.rect = pygame.Rect(position[0], position[1], width, height)
+        self.color = color
+        self.active_color = active_color
+        self.text_color = (255, 255, 255)
+        self.max_tab_width = 180
+
+    def get_tab_rects(self):
+        """
+        Returns the rectangles of the tabs.
+
+        Returns:
+        - List of (document, rect) pairs.
+        """
+        if not self.manager.documents:
+            return []
+        width = min(self.max_tab_width, self.rect.width // len(self.manager.documents))
+        return [(document, pygame.Rect(self.rect.x + i * width, self.rect.y, width - 2, self.rect.height))
+                for i, document in enumerate(self.manager.documents)]
+
+    def check_events(self, event, pos, *args, **kwargs):
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3) and self.is_hovered(pos):
+            for document, rect in self.get_tab_rects():
+                if rect.collidepoint(pos):
+                    self.document = document
+                    self.action = "activate" if event.button == 1 else "close"
+                    self.selected = True
+
+    def is_hovered(self, mouse_pos):
+        return self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        for document, rect in self.get_tab_rects():
+            color = self.active_color if document is self.manager.active else self.color
+            pygame.draw.rect(self.screen, color, rect)
+            text = self.font.render(document.get_name(), False, self.text_color)
+            self.screen.blit(text, text.get_rect(midleft=(rect.x + 5, rect.centery)),
+                             area=pygame.Rect(0, 0, rect.width - 10, rect.height))
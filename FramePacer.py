@@ -0,0 +1,85 @@
+import pygame
+
+
+JOB_PROGRESS = pygame.event.custom_type()
+
+
+def report_progress(**attributes):
+    """
+    Posts a progress event so that a sleeping main loop wakes up and redraws.
+    Safe to call from background threads.
+
+    Args:
+    - attributes: Additional data attached to the event.
+    """
+    try:
+        pygame.event.post(pygame.event.Event(JOB_PROGRESS, attributes))
+    except pygame.error:
+        pass
+
+
+class FramePacer:
+    """
+    A class that decides how long the main loop sleeps between frames.
+
+    While the user interacts with the application or something reports that it is busy,
+    frames are produced at the active rate. Otherwise the loop blocks on the event queue
+    and only wakes up at the idle rate or when a new event arrives.
+
+    Attributes:
+    - clock: The Pygame clock limiting the active frame rate.
+    - active_fps: Frame rate used during interaction and background work.
+    - idle_fps: Frame rate used when nothing happens.
+    - idle_delay: Time in milliseconds after the last event before entering idle mode.
+    - busy_sources: Callables returning True while something animates or runs in the background.
+    - last_activity: Time in milliseconds of the last registered activity.
+    """
+    def __init__(self, active_fps, idle_fps, idle_delay):
+        self.clock = pygame.time.Clock()
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.idle_delay = idle_delay
+        self.busy_sources = []
+        self.last_activity = pygame.time.get_ticks()
+
+    def add_busy_source(self, source):
+        """
+        Registers a source of background activity.
+
+        Args:
+        - source: A callable returning True while the source needs the active frame rate.
+        """
+        self.busy_sources.append(source)
+
+    def notify_activity(self):
+        """Keeps the loop at the active frame rate for at least idle_delay milliseconds."""
+        self.last_activity = pygame.time.get_ticks()
+
+    def is_active(self):
+        """
+        Checks if the loop should run at the active frame rate.
+
+        Returns:
+        - True if there was recent activity or any busy source reports work, False otherwise.
+        """
+        if pygame.time.get_ticks() - self.last_activity < self.idle_delay:
+            return True
+        return any(source() for source in self.busy_sources)
+
+    def get_events(self):
+        """
+        Waits for the next frame and returns the events that arrived in the meantime.
+
+        Returns:
+        - A list of Pygame events.
+        """
+        if self.is_active():
+            self.clock.tick(self.active_fps)
+            events = pygame.event.get()
+        else:
+            event = pygame.event.wait(max(1, 1000 // self.idle_fps))
+            events = [] if event.type == pygame.NOEVENT else [event] + pygame.event.get()
+            self.clock.tick()
+        if events:
+            self.notify_activity()
+        return events
@@ -0,0 +1,117 @@
+import numpy as np
+import pygame
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from FramePacer import report_progress
+from InterfaceElement import ElementBase
+
+
+def compute_statistics(image, sample_size=None):
+    """
+    Computes histograms and statistics of every band of an image.
+
+    Args:
+    - image: A PIL image.
+    - sample_size: If given, statistics are estimated from a strided sample of at most
+      sample_size x sample_size pixels.
+
+    Returns:
+    - Dictionary mapping band names to dictionaries with "histogram", "mean", "std", "min" and "max".
+    """
+    if sample_size is not None and (image.width > sample_size or image.height > sample_size):
+        image = image.resize((min(image.width, sample_size), min(image.height, sample_size)),
+                             resample=Image.NEAREST)
+    counts = np.array(image.histogram(), dtype=np.float64).reshape(-1, 256)
+    levels = np.arange(256)
+    statistics = {}
+    for band, histogram in zip(image.getbands(), counts):
+        total = histogram.sum()
+        mean = (histogram * levels).sum() / total
+        used = np.flatnonzero(histogram)
+        statistics[band] = {"histogram": histogram,
+                            "mean": mean,
+                            "std": np.sqrt((histogram * (levels - mean) ** 2).sum() / total),
+                            "min": int(used[0]),
+                            "max": int(used[-1])}
+    return statistics
+
+
+class HistogramPanel(ElementBase):
+    """
+    A class displaying the histogram and statistics of the image.
+
+    Statistics are cached in the history state of the image. For a new state, an estimate
+    from a strided sample is computed immediately and the exact statistics are computed
+    on a background thread. Undo and redo reuse the cached statistics.
+
+    Attributes:
+    - rect: The area of the panel.
+    - sample_size: Maximum width and height of the sample used for the estimate.
+    - executor: Worker thread computing the exact statistics.
+    """
+    BAND_COLORS = {"R": (230, 80, 80), "G": (80, 200, 80), "B": (90, 120, 240), "L": (230, 230, 230)}
+
+    def __init__(self, screen, position: tuple, width, height, name="Histogram", sample_size=256):
+        super().__init__(screen, position, name)
+        self.rect = pygame.Rect(position[0], position[1], width, height)
+        self.sample_size = sample_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="histogram")
+        self.statistics = None
+        self._pending = None
+        self.color = (100, 100, 100)
+        self.text_color = (255, 255, 255)
+
+    def is_busy(self):
+        """
+        Checks if exact statistics are being computed.
+
+        Returns:
+        - True while the worker is computing.
+        """
+        return self._pending is not None and not self._pending.done()
+
+    def shutdown(self):
+        """Stops the worker thread."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def update(self, image):
+        """
+        Picks the statistics of the current state of the image, computing them if needed.
+
+        Args:
+        - image: An instance of IEPImage.
+        """
+        if image.pil_image is None:
+            self.statistics = None
+            return
+        cached = image.get_statistics()
+        if "estimate" not in cached:
+            cached["estimate"] = compute_statistics(image.pil_image, self.sample_size)
+            self._pending = self.executor.submit(self._compute_exact, cached, image.pil_image)
+        self.statistics = cached.get("exact", cached["estimate"])
+
+    @staticmethod
+    def _compute_exact(cached, pil_image):
+        cached["exact"] = compute_statistics(pil_image)
+        report_progress(job="histogram")
+
+    def is_hovered(self, mouse_pos):
+        return self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        pygame.draw.rect(self.screen, self.color, self.rect)
+        if self.statistics is None:
+            return
+        plot = pygame.Rect(self.rect.x + 5, self.rect.y + 5, self.rect.width - 10, self.rect.height - 75)
+        bands = [band for band in self.statistics if band in self.BAND_COLORS]
+        peak = max(self.statistics[band]["histogram"].max() for band in bands) or 1
+        for band in bands:
+            histogram = self.statistics[band]["histogram"]
+            points = [(plot.x + level * (plot.width - 1) / 255,
+                       plot.bottom - 1 - histogram[level] / peak * (plot.height - 1)) for level in range(256)]
+            pygame.draw.lines(self.screen, self.BAND_COLORS[band], False, points)
+        for line, band in enumerate(bands):
+            band_statistics = self.statistics[band]
+            text = self.font.render(f"{band} {band_statistics['mean']:.0f} +- {band_statistics['std']:.0f}",
+                                    False, self.BAND_COLORS[band])
+            self.screen.blit(text, (self.rect.x + 5, plot.bottom + 5 + line * 17))
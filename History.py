@@ -0,0 +1,631 @@
+import queue
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pygame
+from PIL import Image
+from FramePacer import report_progress
+from InterfaceElement import ElementBase, TypeOfInteraction
+from WorkingBuffer import copy_into
+
+
+def get_tile_boxes(size, tile_size):
+    """
+    Returns the tiles covering an image.
+
+    Args:
+    - size: The (width, height) of the image.
+    - tile_size: Width and height of the tiles.
+
+    Returns:
+    - Dictionary mapping (column, row) tiles to their (left, top, right, bottom) boxes.
+    """
+    return {(column, row): (column * tile_size, row * tile_size,
+                            min(size[0], (column + 1) * tile_size), min(size[1], (row + 1) * tile_size))
+            for row in range(-(-size[1] // tile_size)) for column in range(-(-size[0] // tile_size))}
+
+
+def get_tiles_in(box, tile_size):
+    """
+    Returns the tiles overlapping a box.
+
+    Args:
+    - box: The (left, top, right, bottom) box.
+    - tile_size: Width and height of the tiles.
+
+    Returns:
+    - List of (column, row) tiles.
+    """
+    return [(column, row) for row in range(box[1] // tile_size, -(-box[3] // tile_size))
+            for column in range(box[0] // tile_size, -(-box[2] // tile_size))]
+
+
+class Tile:
+    """
+    A class holding the pixels of one tile, shared by every TileGrid the tile belongs to.
+
+    Attributes:
+    - pixels: A PIL image, or a (mode, size, zlib compressed bytes) tuple while the image is
+      unloaded. Decompressed again when the tile is first used.
+    """
+    __slots__ = ("pixels",)
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+    def get_image(self):
+        """Returns the pixels of the tile as a PIL image."""
+        if isinstance(self.pixels, tuple):
+            mode, size, data = self.pixels
+            self.pixels = Image.frombytes(mode, size, zlib.decompress(data))
+        return self.pixels
+
+    def compress(self):
+        """Compresses the pixels of the tile."""
+        if not isinstance(self.pixels, tuple):
+            self.pixels = (self.pixels.mode, self.pixels.size, zlib.compress(self.pixels.tobytes(), 1))
+
+    def memory_usage(self):
+        """Returns the number of bytes used by the pixels."""
+        if isinstance(self.pixels, tuple):
+            return len(self.pixels[2])
+        return self.pixels.width * self.pixels.height * len(self.pixels.getbands())
+
+
+class TileGrid:
+    """
+    A class storing the pixels of an image as a grid of tiles. A grid derived from another
+    one by changing some regions refers to the unchanged tiles of the other grid, so states
+    differing in a few strokes share most of their pixels.
+
+    Attributes:
+    - size: The (width, height) of the image.
+    - mode: The pixel mode of the image.
+    - tile_size: Width and height of the tiles.
+    - tiles: Dictionary mapping (column, row) tiles to Tile objects.
+    """
+    def __init__(self, size, mode, tile_size, tiles):
+        self.size = size
+        self.mode = mode
+        self.tile_size = tile_size
+        self.tiles = tiles
+
+    @classmethod
+    def from_image(cls, image, tile_size):
+        """
+        Splits an image into tiles.
+
+        Args:
+        - image: A PIL image.
+        - tile_size: Width and height of the tiles.
+
+        Returns:
+        - The TileGrid.
+        """
+        tiles = {tile: Tile(image.crop(box)) for tile, box in get_tile_boxes(image.size, tile_size).items()}
+        return cls(image.size, image.mode, tile_size, tiles)
+
+    def derive(self, image, boxes):
+        """
+        Creates the grid of an image differing from this one only inside some boxes.
+
+        Args:
+        - image: The changed PIL image, of the same size and mode.
+        - boxes: The (left, top, right, bottom) boxes of the changed regions.
+
+        Returns:
+        - A TileGrid sharing the tiles outside the boxes with this grid.
+        """
+        tiles = dict(self.tiles)
+        tile_boxes = get_tile_boxes(self.size, self.tile_size)
+        for box in boxes:
+            for tile in get_tiles_in(box, self.tile_size):
+                if tile in tile_boxes and tiles[tile] is self.tiles[tile]:
+                    tiles[tile] = Tile(image.crop(tile_boxes[tile]))
+        return TileGrid(self.size, self.mode, self.tile_size, tiles)
+
+    def to_image(self, pool=None):
+        """
+        Assembles the tiles into one image.
+
+        Args:
+        - pool: BufferPool providing the pixel array of an RGBA image, or None.
+
+        Returns:
+        - A PIL image, read-only if it was made from a pixel array of the pool.
+        """
+        boxes = get_tile_boxes(self.size, self.tile_size)
+        if pool is None or self.mode != "RGBA":
+            target = Image.new(self.mode, self.size)
+            for tile, holder in self.tiles.items():
+                target.paste(holder.get_image(), boxes[tile][:2])
+            return target
+        pixels = pool.acquire(self.size)
+        for tile, holder in self.tiles.items():
+            copy_into(pixels, holder.get_image(), boxes[tile][:2])
+        return pool.make_image(pixels)
+
+    def compress(self):
+        """Compresses the tiles of the grid."""
+        for holder in self.tiles.values():
+            holder.compress()
+
+
+class DerivedState:
+    """
+    A class describing a state without pixels, restored by an exactly reversible command from
+    the state after it. The state before a flip or rotation is kept this way, so the history
+    holds the pixels of only one of the two states.
+
+    Attributes:
+    - source: Index in the nodes of the tree of the child state the image is computed from.
+    - command: The command computing the image of the state from the image of the child.
+    """
+    __slots__ = ("source", "command")
+
+    def __init__(self, source, command):
+        self.source = source
+        self.command = command
+
+
+class HistoryNode:
+    """
+    A class representing a state of the image in the history tree.
+
+    Attributes:
+    - parent: The state the change was made on, or None for the opened image.
+    - children: States created from this one, oldest first.
+    - state: The pixels of the state: a PIL image, a (mode, zlib compressed bytes) tuple
+      while the image is unloaded, a TileGrid for states reached by changing regions, or a
+      DerivedState for states restored from a child.
+    - size: The size of the image.
+    - name: Short description of the change leading to the state.
+    - stats: Statistics of the image cached for the state.
+    - layers: State of the layer stack, or None.
+    - steps: The (command, selection) steps leading from the opened image to the state, or
+      None if the state cannot be repeated on other frames.
+    - thumbnail: A small PIL image of the state, or None until it is made.
+    - last_child: The child visited last, followed by redo.
+    """
+    def __init__(self, parent, state, size, name, layers=None, steps=()):
+        self.parent = parent
+        self.children = []
+        self.state = state
+        self.size = size
+        self.name = name
+        self.stats = {}
+        self.layers = layers
+        self.steps = steps
+        self.thumbnail = None
+        self.last_child = None
+
+
+class HistoryTree:
+    """
+    A class keeping every state of an image, including the branches left by undoing and
+    making another change. Any state can be restored in one step.
+
+    States created by whole image commands keep their image. States created by changing
+    regions, such as strokes and commands restricted to a selection, are stored as tile
+    grids sharing the unchanged tiles with the state they were made on. The state before an
+    exactly reversible change, such as a flip or rotation, gives up its pixels and is restored
+    from the state after it. Restoring a state returns its image, assembles its tiles once or
+    reverses the changes after it, however far it is from the current one.
+
+    Attributes:
+    - root: The state of the opened image, or None.
+    - current: The current state, or None.
+    - nodes: All states in the order of creation.
+    - tile_size: Width and height of the tiles of the grids.
+    """
+    def __init__(self, tile_size=256):
+        self.root = None
+        self.current = None
+        self.nodes = []
+        self.tile_size = tile_size
+
+    def add(self, image, name, boxes=None, layers=None, steps=(), inverse=None):
+        """
+        Adds a state as a child of the current state and makes it current.
+
+        Args:
+        - image: The PIL image of the state.
+        - name: Short description of the change.
+        - boxes: The (left, top, right, bottom) boxes of the changed regions, or None if
+          the whole image may have changed.
+        - layers: State of the layer stack, or None.
+        - steps: The steps leading to the state, or None.
+        - inverse: Command computing the image of the current state exactly from the new
+          image, or None. The current state then keeps no pixels.
+
+        Returns:
+        - The new HistoryNode.
+        """
+        parent = self.current
+        state = image
+        if boxes is not None and parent is not None and parent.size == image.size:
+            grid = self.get_grid(parent)
+            if grid.mode == image.mode:
+                state = grid.derive(image, boxes)
+        node = HistoryNode(parent, state, image.size, name, layers, steps)
+        if parent is None:
+            self.root = node
+        else:
+            parent.children.append(node)
+            parent.last_child = node
+        self.nodes.append(node)
+        self.current = node
+        if inverse is not None and parent is not None:
+            parent.state = DerivedState(len(self.nodes) - 1, inverse)
+        return node
+
+    def get_grid(self, node):
+        """
+        Returns the tiles of a state, splitting its image into tiles the first time. The
+        state then keeps only the tiles.
+
+        Args:
+        - node: A HistoryNode.
+
+        Returns:
+        - The TileGrid of the state.
+        """
+        if not isinstance(node.state, TileGrid):
+            node.state = TileGrid.from_image(self.get_image(node), self.tile_size)
+        return node.state
+
+    def get_image(self, node, pool=None):
+        """
+        Returns the image of a state, decompressing it if it was unloaded. The image may be
+        shared with the history and must not be modified in place.
+
+        Args:
+        - node: A HistoryNode.
+        - pool: BufferPool providing the pixel array the tiles are assembled in, or None.
+
+        Returns:
+        - A PIL image.
+        """
+        state = node.state
+        if isinstance(state, DerivedState):
+            # The children a state is derived from come later in the tree, so the chain ends.
+            commands = []
+            while isinstance(state, DerivedState):
+                commands.append(state.command)
+                node = self.nodes[state.source]
+                state = node.state
+            image = self.get_image(node, pool)
+            for command in reversed(commands):
+                image = command.execute(image)
+            return image
+        if isinstance(state, TileGrid):
+            return state.to_image(pool)
+        if isinstance(state, tuple):
+            mode, pixels = state
+            state = Image.frombytes(mode, node.size, zlib.decompress(pixels))
+            node.state = state
+        return state
+
+    def move_to(self, node):
+        """
+        Makes a state current. Redo from the states above it then leads back to it.
+
+        Args:
+        - node: A HistoryNode of the tree.
+        """
+        self.current = node
+        while node.parent is not None:
+            node.parent.last_child = node
+            node = node.parent
+
+    def memory_usage(self, image=None):
+        """
+        Estimates the memory used by the states. Shared tiles are counted once.
+
+        Args:
+        - image: The current image, not counted again if a state holds it.
+
+        Returns:
+        - Number of bytes.
+        """
+        usage = 0
+        seen = set()
+        for node in self.nodes:
+            state = node.state
+            if isinstance(state, tuple):
+                usage += len(state[1])
+            elif isinstance(state, TileGrid):
+                for holder in state.tiles.values():
+                    if id(holder) not in seen:
+                        seen.add(id(holder))
+                        usage += holder.memory_usage()
+            elif isinstance(state, Image.Image) and state is not image:
+                usage += state.width * state.height * len(state.getbands())
+        return usage
+
+    def compress(self):
+        """
+        Compresses the pixels of every state.
+
+        Returns:
+        - The list of the compressed states in the order of nodes.
+        """
+        states = []
+        for node in self.nodes:
+            if isinstance(node.state, TileGrid):
+                node.state.compress()
+            elif isinstance(node.state, Image.Image):
+                node.state = (node.state.mode, zlib.compress(node.state.tobytes(), 1))
+            states.append(node.state)
+        return states
+
+    def release(self):
+        """
+        Frees the pixels of every state.
+
+        Returns:
+        - The list of the states in the order of nodes.
+        """
+        states = [node.state for node in self.nodes]
+        for node in self.nodes:
+            node.state = None
+        return states
+
+    def restore(self, states):
+        """
+        Gives the states back their pixels returned by release.
+
+        Args:
+        - states: The list of the states in the order of nodes.
+        """
+        for node, state in zip(self.nodes, states):
+            node.state = state
+
+
+def make_history_thumbnail(image, size):
+    """
+    Reduces an image to a thumbnail for the history panel.
+
+    Args:
+    - image: A PIL image, which is not modified.
+    - size: Maximum width and height of the thumbnail.
+
+    Returns:
+    - An RGB PIL image.
+    """
+    factor = max(1, min(image.width, image.height) // (2 * size))
+    thumbnail = image.reduce(factor) if factor > 1 else image.copy()
+    thumbnail.thumbnail((size, size), reducing_gap=None)
+    return thumbnail.convert("RGB")
+
+
+class HistoryPanel(ElementBase):
+    """
+    A class showing the history tree of the image over the canvas.
+
+    Every state is a cell with its thumbnail. The states of one branch form a row, and a
+    branch starts in a new row below the state it was made from. Clicking a cell restores
+    that state. The mouse wheel scrolls and Escape closes the panel. The thumbnail of every
+    state is made in the background while the state is current, and kept with the state.
+
+    Attributes:
+    - Inherits attributes from ElementBase.
+    - rect: The area covered by the open panel.
+    - button_rect: The area of the button opening and closing the panel.
+    - is_open: Indicates if the tree is shown.
+    - history: The HistoryTree of the image, or None.
+    - node: The state chosen to be restored.
+    - scroll: Number of (columns, rows) scrolled.
+    """
+    def __init__(self, screen, position: tuple, button_size, rect, thumbnail_size=96, name="History",
+                 color: tuple = (100, 100, 100), current_color: tuple = (142, 165, 163), max_surfaces=500):
+        super().__init__(screen, position, name)
+        self.type_name = TypeOfInteraction.HISTORY
+        self.button_rect = pygame.Rect(position, button_size)
+        self.rect = pygame.Rect(rect)
+        self.color = color
+        self.current_color = current_color
+        self.text_color = (255, 255, 255)
+        self.thumbnail_size = thumbnail_size
+        self.cell_size = (thumbnail_size + 24, thumbnail_size + 30)
+        self.header_height = 24
+        self.is_open = False
+        self.history = None
+        self.node = None
+        self.scroll = (0, 0)
+        self.max_surfaces = max_surfaces
+        self._surfaces = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._finished = queue.Queue()
+        self._pending = set()
+        self._shown = None
+
+    def is_busy(self):
+        """
+        Checks if thumbnails are being made.
+
+        Returns:
+        - True while work is pending.
+        """
+        return bool(self._pending)
+
+    def shutdown(self):
+        """Stops the worker thread."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _make_thumbnail(self, node, image):
+        self._finished.put((node, make_history_thumbnail(image, self.thumbnail_size)))
+        report_progress(job="history")
+
+    def update(self, image):
+        """
+        Picks the history of the image and makes the thumbnail of its current state.
+
+        Args:
+        - image: An instance of IEPImage.
+        """
+        while True:
+            try:
+                node, thumbnail = self._finished.get_nowait()
+            except queue.Empty:
+                break
+            node.thumbnail = thumbnail
+            self._pending.discard(node)
+        self.history = image.history if image.pil_image is not None else None
+        if self.history is None:
+            return
+        current = self.history.current
+        if current.thumbnail is None and current not in self._pending:
+            self._pending.add(current)
+            self._executor.submit(self._make_thumbnail, current, image.pil_image)
+        if self.is_open and current is not self._shown:
+            self.show(current)
+
+    def open(self):
+        """Shows the history tree."""
+        self.is_open = True
+        self._shown = None
+
+    def close(self):
+        """Hides the history tree."""
+        self.is_open = False
+
+    def get_layout(self):
+        """
+        Places the states of the tree in columns by their depth and in rows by their branch.
+
+        Returns:
+        - Dictionary mapping every HistoryNode to its (column, row) cell.
+        """
+        if self.history is None or self.history.root is None:
+            return {}
+        cells = {}
+        rows = 0
+        stack = [(self.history.root, 0, 0)]
+        while stack:
+            node, column, row = stack.pop()
+            if row is None:
+                rows += 1
+                row = rows
+            cells[node] = (column, row)
+            # The first child continues the row of the branch, the others start new rows.
+            for child in reversed(node.children[1:]):
+                stack.append((child, column + 1, None))
+            if node.children:
+                stack.append((node.children[0], column + 1, row))
+        return cells
+
+    def get_grid_size(self):
+        return (max(1, self.rect.width // self.cell_size[0]),
+                max(1, (self.rect.height - self.header_height) // self.cell_size[1]))
+
+    def show(self, node):
+        """
+        Scrolls the panel so that a state is visible.
+
+        Args:
+        - node: A HistoryNode of the tree.
+        """
+        self._shown = node
+        column, row = self.get_layout().get(node, (0, 0))
+        columns, rows = self.get_grid_size()
+        scroll_column, scroll_row = self.scroll
+        if not scroll_column <= column < scroll_column + columns:
+            scroll_column = max(0, column - columns // 2)
+        if not scroll_row <= row < scroll_row + rows:
+            scroll_row = max(0, row - rows // 2)
+        self.scroll = (scroll_column, scroll_row)
+
+    def get_cells(self):
+        """
+        Returns the states visible in the panel.
+
+        Returns:
+        - List of (node, rect) pairs.
+        """
+        columns, rows = self.get_grid_size()
+        cells = []
+        for node, (column, row) in self.get_layout().items():
+            column -= self.scroll[0]
+            row -= self.scroll[1]
+            if 0 <= column < columns and 0 <= row < rows:
+                cells.append((node, pygame.Rect(self.rect.x + column * self.cell_size[0],
+                                                self.rect.y + self.header_height + row * self.cell_size[1],
+                                                self.cell_size[0], self.cell_size[1])))
+        return cells
+
+    def check_events(self, event, pos, *args, **kwargs):
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.button_rect.collidepoint(pos):
+            if self.is_open:
+                self.close()
+            else:
+                self.open()
+            return
+        if not self.is_open:
+            return
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            self.close()
+        elif event.type == pygame.MOUSEWHEEL and self.is_hovered(pos):
+            self.scroll = (max(0, self.scroll[0] - event.x), max(0, self.scroll[1] - event.y))
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.is_hovered(pos):
+            for node, rect in self.get_cells():
+                if rect.collidepoint(pos):
+                    self.node = node
+                    self.selected = True
+                    return
+
+    def is_hovered(self, mouse_pos):
+        return self.is_open and self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        pygame.draw.rect(self.screen, self.color, self.button_rect)
+        text = self.font.render(self.name, False, self.text_color)
+        self.screen.blit(text, text.get_rect(center=self.button_rect.center))
+
+    def draw_overlay(self):
+        """
+        Draws the history tree over the canvas if the panel is open.
+        """
+        if not self.is_open:
+            return
+        pygame.draw.rect(self.screen, self.color, self.rect)
+        count = len(self.history.nodes) if self.history is not None else 0
+        self.screen.blit(self.font.render(f"History: {count} states", False, self.text_color),
+                         (self.rect.x + 5, self.rect.y + 2))
+        cells = self.get_cells()
+        rects = dict(cells)
+        for node, rect in cells:
+            parent = rects.get(node.parent)
+            if parent is None:
+                continue
+            # A branch goes down from the middle of the state it was made from.
+            start = (parent.right - 12, parent.centery) if parent.y == rect.y else (parent.centerx, parent.bottom - 2)
+            corner = (start[0], rect.centery)
+            pygame.draw.lines(self.screen, self.text_color, False, [start, corner, (rect.x + 12, rect.centery)])
+        current = self.history.current if self.history is not None else None
+        for node, rect in cells:
+            area = pygame.Rect(rect.x + 12, rect.y + 4, self.thumbnail_size, self.thumbnail_size)
+            if node is current:
+                pygame.draw.rect(self.screen, self.current_color, area.inflate(8, 8))
+            surface = self._get_surface(node)
+            if surface is not None:
+                self.screen.blit(surface, surface.get_rect(center=area.center))
+            else:
+                pygame.draw.rect(self.screen, self.text_color, area, 1)
+            label = self.font.render(node.name, False, self.text_color)
+            self.screen.blit(label, (area.x, area.bottom + 4),
+                             area=pygame.Rect(0, 0, self.thumbnail_size, self.cell_size[1]))
+
+    def _get_surface(self, node):
+        if node.thumbnail is None:
+            return None
+        surface = self._surfaces.get(node)
+        if surface is None:
+            thumbnail = node.thumbnail
+            surface = pygame.image.frombuffer(thumbnail.tobytes(), thumbnail.size, thumbnail.mode)
+            self._surfaces[node] = surface
+            while len(self._surfaces) > self.max_surfaces:
+                self._surfaces.popitem(last=False)
+        else:
+            self._surfaces.move_to_end(node)
+        return surface
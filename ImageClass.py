@@ -1,5 +1,38 @@
+import copy
+import os
+import pickle
+import time
+from collections import deque
+import numpy as np
 from PIL import Image
 from custom_exceptions import NoImageError
+from ResultCache import ResultCache, content_hash
+from Layers import LayerStack
+from History import HistoryTree
+from Selection import execute_in_selection
+from Painting import BrushStroke
+from Commands import PaintStroke
+from Pipeline import run_command
+from Animation import ANIMATED_FORMATS, FrameSource, export_animation
+from LosslessJpeg import save_lossless_jpeg
+from WorkingBuffer import AllocationMonitor, BufferPool
+
+
+def get_file_identity(path):
+    """
+    Returns the size and modification time of a file, which change when the file is written.
+
+    Args:
+    - path: The file path.
+
+    Returns:
+    - A (size, modification time) tuple, or None if the file cannot be read.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
 
 
 class IEPImage:
@@ -10,102 +43,504 @@ class IEPImage:
     - path_file: The file path of the image.
     - pil_image: The PIL image object.
     - changed: Indicates if the image has been modified.
-    - changes_history: History of changes made to the image.
-    - size_history: History of image sizes.
-    - history_index: Index to track the history of changes made to the image.
+    - history: HistoryTree keeping every state of the image, with the branches left by undo.
+    - result_cache: Cache of command results keyed by the content of their input.
+    - listeners: Callables notified before the image is changed.
+    - storage_path: File holding the pixel data and history while the image is unloaded.
+    - journal: SessionJournal recording the changes of the image, or None.
+    - layers: LayerStack holding the commands as adjustment layers, or None when commands
+      are applied destructively.
+    - selection: Selection restricting the commands, or None to process the whole image.
+    - buffer_pool: BufferPool providing the pixel arrays commands working in place write into.
+      The image is a read-only view of such an array after decoding a file and after these
+      commands.
+    - allocation_log: The last (command name, allocation counts) pairs of executed commands. The
+      counts include the time the command took in seconds.
+    - animation: FrameSource of the file if it has several frames, or None. Only the first
+      frame is edited on screen, the other frames are edited when the image is saved.
+    - frame_workers: Number of worker threads editing the frames of an animation.
+    - decode_cache: DecodeCache keeping the decoded pixels of opened files, or None.
     """
-    def __init__(self):
+    def __init__(self, cache_budget=256 * 1024 * 1024, result_cache=None, buffer_pool=None, frame_workers=None,
+                 decode_cache=None):
         self.path_file = ""
         self.pil_image = None
         self.changed = False
-        self.changes_history = []
-        self.size_history = []
-        self.history_index = -1
+        self.history = HistoryTree()
+        self.result_cache = result_cache if result_cache is not None else ResultCache(cache_budget)
+        self.listeners = []
+        self.storage_path = None
+        self.journal = None
+        self.layers = None
+        self.selection = None
+        self.buffer_pool = buffer_pool if buffer_pool is not None else BufferPool(cache_budget)
+        self.allocation_log = deque(maxlen=100)
+        self.animation = None
+        self.frame_workers = frame_workers or os.cpu_count() or 1
+        self.decode_cache = decode_cache
+        self._content_hash = None
+        self._source_stat = None
+
+    def add_listener(self, listener):
+        """
+        Registers a callable notified before every change of the image.
+
+        Args:
+        - listener: A callable without arguments.
+        """
+        self.listeners.append(listener)
+
+    def notify_listeners(self):
+        """Notifies the listeners that the image is about to change."""
+        for listener in self.listeners:
+            listener()
 
     def assign_image(self, path):
         """
-        Assigns an image to the object.
+        Assigns an image to the object. Of a file with several frames the first frame is shown.
+        Files found in the decode cache are mapped from it instead of being decoded, other
+        files with a single frame are added to it.
 
         Args:
         - path: The file path of the image to be assigned.
         """
+        if self.decode_cache is not None:
+            cached = self.decode_cache.get(path)
+            if cached is not None:
+                self._assign(cached, path)
+                self.animation = None
+                self._source_stat = get_file_identity(path)
+                return
+        with Image.open(path) as pil_image:
+            self.assign_pil_image(pil_image, path)
+            self.animation = FrameSource(path) if FrameSource.is_animated(pil_image) else None
+        self._source_stat = get_file_identity(path)
+        if self.decode_cache is not None and self.animation is None:
+            self.decode_cache.put(path, self.pil_image)
+
+    def assign_pil_image(self, pil_image, path):
+        """
+        Assigns an already decoded image to the object.
+
+        Args:
+        - pil_image: The PIL image, converted to RGBA while it is copied into a pixel array.
+        - path: The file path the image comes from.
+        """
+        self._assign(self.buffer_pool.make_image(self.buffer_pool.acquire_copy(pil_image)), path)
+
+    def _assign(self, pil_image, path):
+        self.notify_listeners()
         self.path_file = path
-        self.pil_image = Image.open(path)
-        self.pil_image = self.pil_image.convert("RGBA")
-        self.changes_history.append(self.pil_image.getdata())
-        self.size_history.append(self.pil_image.size)
-        self.history_index += 1
+        self.pil_image = pil_image
+        self.selection = None
+        self._content_hash = None
+        self._source_stat = None
+        if self.journal is not None:
+            self.journal.record_open(path, self.pil_image)
+        self.history.add(self.pil_image, "Open")
 
     def create_new_image(self, new_data):
         """
-        Creates a new image based on the data.
+        Creates a new image based on the data, copied into a pixel array of the pool.
 
         Args:
-        - new_data: The new data to create the image.
+        - new_data: Array of shape (height, width) or (height, width, channels) with 1, 3 or 4 channels.
+        """
+        if new_data.ndim == 2:
+            new_data = new_data[:, :, None]
+        pixels = self.buffer_pool.acquire((new_data.shape[1], new_data.shape[0]))
+        if new_data.shape[2] == 4:
+            np.copyto(pixels, new_data, casting="unsafe")
+        else:
+            np.copyto(pixels[:, :, :3], new_data[:, :, :3], casting="unsafe")
+            pixels[:, :, 3] = 255
+        self.pil_image = self.buffer_pool.make_image(pixels)
+        self._content_hash = None
+
+    def get_content_hash(self):
         """
-        self.pil_image.close()
-        self.pil_image = Image.fromarray(new_data.astype('uint8'))
+        Returns the content hash of the current image, computing it once per state.
+
+        Returns:
+        - A hex digest of the current image.
+        """
+        if self._content_hash is None or self._content_hash[0] is not self.pil_image:
+            self._content_hash = (self.pil_image, content_hash(self.pil_image))
+        return self._content_hash[1]
+
+    def known_content_hash(self, pil_image):
+        """
+        Returns the content hash of an image if it was already computed for the current state.
+
+        Args:
+        - pil_image: A PIL image.
+
+        Returns:
+        - The hex digest, or None if it is not known.
+        """
+        known = self._content_hash
+        if known is not None and known[0] is pil_image:
+            return known[1]
+        return None
+
+    def remember_content_hash(self, pil_image, digest):
+        """
+        Stores a content hash computed elsewhere, if it belongs to the current image.
+
+        Args:
+        - pil_image: The PIL image the hash was computed for.
+        - digest: The content hash of pil_image.
+        """
+        if pil_image is self.pil_image:
+            self._content_hash = (pil_image, digest)
 
     def save_image(self, path):
         """
-        Saves the current image to a file.
+        Saves the current image to a file. An animation saved as GIF, PNG or TIFF is saved with
+        all its frames, each edited with the steps leading to the current state. A JPEG only
+        cropped, flipped or rotated is saved as JPEG without being encoded again, if jpegtran
+        is installed.
 
         Args:
         - path: The file path to save the image.
         """
-        self.pil_image.save(path)
+        if self.animation is not None and os.path.splitext(path)[1].lower() in ANIMATED_FORMATS:
+            steps = self.history.current.steps
+            if steps is not None:
+                export_animation(self.animation, path, steps, self.frame_workers, self.buffer_pool)
+                return
+            print("The edits cannot be repeated on the other frames, only the current frame is saved.")
+        if os.path.splitext(path)[1].lower() in (".jpg", ".jpeg"):
+            steps = self.history.current.steps
+            # The steps lead from the file as it was opened, not from a recovered checkpoint.
+            if (self.layers is None and steps is not None and self._source_stat is not None
+                    and get_file_identity(self.path_file) == self._source_stat
+                    and save_lossless_jpeg(self.path_file, path, steps)):
+                return
+        image = self.pil_image
+        image_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+        # Results of the commands are RGBA, which JPEG cannot store.
+        if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        image.save(path)
 
     def execute_command(self, command):
         """
-        Executes a command on the image.
+        Executes a command on the image. Results of commands already executed on
+        identical content with the same parameters are taken from the result cache.
+        Commands returning the image unchanged do not create a history entry.
+        In layer mode the command is added as a layer, or replaces the selected layer.
+        Otherwise, if a part of the image is selected, the command processes only that part.
+        Commands working in place modify a pixel array of the pool instead of creating images.
+        The image is converted only if the command does not accept its mode. The allocations
+        and conversions made by the command and the time it took are added to allocation_log.
 
         Args:
         - command: The command to be executed on the image.
         """
         if self.pil_image is None:
             raise NoImageError("No image is being used!")
+        start = time.perf_counter()
+        with AllocationMonitor(self.buffer_pool) as monitor:
+            conversions = self._execute_command(command)
+        report = monitor.report()
+        report["conversions"] = conversions
+        report["seconds"] = time.perf_counter() - start
+        self.allocation_log.append((type(command).__name__, report))
+
+    def _execute_command(self, command):
+        conversions = 0
+        if self.layers is not None and command.save_needed:
+            if self.layers.selected is None:
+                self.change_layers(self.layers.add, command)
+            else:
+                self.change_layers(self.layers.replace, self.layers.selected, command)
+            return conversions
+        self.notify_listeners()
         self.changed = True
-        self.pil_image = command.execute(self.pil_image)
+        if self.selection is not None and self.layers is None and not command.geometric:
+            restricted = execute_in_selection(command, self.pil_image, self.selection)
+            if restricted is not None:
+                self.pil_image, delta = restricted
+                self._content_hash = None
+                if command.save_needed:
+                    self.save_current_image_data(delta, (command, self.selection))
+                if self.journal is not None:
+                    self.journal.record_command(command, self.pil_image, self.selection)
+                return conversions
+        key = self.result_cache.make_key(self.get_content_hash(), command)
+        new_image = self.result_cache.get(key)
+        if new_image is None:
+            new_image, conversions = run_command(command, self.pil_image, self.buffer_pool)
+            if new_image is self.pil_image:
+                return conversions
+            self.result_cache.put(key, new_image)
+        self.pil_image = new_image
+        self._content_hash = None
+        if command.geometric:
+            # The selected region no longer covers the same pixels.
+            self.selection = None
+        self.check_selection()
         if command.save_needed:
-            self.save_current_image_data()
+            self.save_current_image_data(step=(command, None), inverse=command.get_inverse())
+        if self.journal is not None:
+            self.journal.record_command(command, self.pil_image)
+        return conversions
+
+    def begin_stroke(self, color, radius, erase=False):
+        """
+        Starts a brush stroke. In layer mode the stroke paints the image below the layers.
+
+        Args:
+        - color: The (r, g, b) color of the brush.
+        - radius: The radius of the brush in image pixels.
+        - erase: If True, the stroke erases instead of painting.
+
+        Returns:
+        - A BrushStroke to add points to and pass to end_stroke.
+        """
+        if self.pil_image is None:
+            raise NoImageError("No image is being used!")
+        self.notify_listeners()
+        source = self.layers.base if self.layers is not None else self.pil_image
+        return BrushStroke(source, color, radius, erase)
+
+    def end_stroke(self, stroke):
+        """
+        Applies a finished brush stroke and stores it in the history as one state, sharing the
+        tiles the stroke did not touch with the previous state.
+
+        Args:
+        - stroke: The BrushStroke returned by begin_stroke.
+        """
+        delta = stroke.finish()
+        if delta is None:
+            return
+        self.notify_listeners()
+        if self.layers is not None:
+            self.change_layers(self.layers.update_base, stroke.image, [box for box, _, _ in delta.patches])
+            return
+        self.pil_image = stroke.image
+        self._content_hash = None
+        command = PaintStroke([(box, after) for box, _, after in delta.patches])
+        self.save_current_image_data(delta, (command, None))
+        if self.journal is not None:
+            self.journal.record_command(command, self.pil_image)
+
+    def set_selection(self, selection):
+        """
+        Restricts the following commands to a part of the image.
+
+        Args:
+        - selection: A Selection, or None to process the whole image.
+        """
+        self.selection = selection
+
+    def check_selection(self):
+        """
+        Removes the selection if it no longer fits inside the image.
+        """
+        if self.selection is not None and not self.selection.fits(self.pil_image.size):
+            self.selection = None
 
     def disable_changed(self):
         """Disables the 'changed' flag."""
         self.changed = False
 
-    def save_current_image_data(self):
+    def save_current_image_data(self, delta=None, step=None, name=None, inverse=None):
+        """
+        Saves the current image data to the history as a new state following the current one.
+        States left by undo stay in the history as another branch.
+
+        Args:
+        - delta: The RegionDelta leading to the current image. Only the tiles it changed are
+          stored, the others are shared with the previous state.
+        - step: The (command, selection) pair leading to the current image, or None if the
+          change cannot be repeated on other frames.
+        - name: Short description of the change, the name of the command of the step if not given.
+        - inverse: Command restoring the previous image exactly from the current one, or None.
+          The previous state then keeps no pixels.
+        """
+        steps = self.history.current.steps
+        if step is not None:
+            # The menus reuse their commands, so the step keeps the values it was executed with.
+            step = copy.copy(step[0]), step[1]
+        if name is None:
+            name = type(step[0]).__name__ if step is not None else "Change"
+        self.history.add(self.pil_image, name,
+                         boxes=None if delta is None else [box for box, _, _ in delta.patches],
+                         layers=self.layers.snapshot() if self.layers is not None else None,
+                         steps=None if steps is None or step is None else steps + (step,),
+                         inverse=inverse)
+
+    def enable_layers(self, tile_size=256):
+        """
+        Starts keeping the following commands as adjustment layers above the current image.
+
+        Args:
+        - tile_size: Width and height of the tiles the composite is cached in.
+        """
+        if self.pil_image is None or self.layers is not None:
+            return
+        if self.animation is not None:
+            print("Layers are not available for images with several frames.")
+            return
+        self.layers = LayerStack(self.pil_image, tile_size, self.result_cache.budget)
+        self.history.current.layers = self.layers.snapshot()
+
+    def flatten_layers(self):
+        """
+        Applies the layers permanently and returns to destructive editing.
+        """
+        if self.layers is None:
+            return
+        self.notify_listeners()
+        self.layers = None
+        self.changed = True
+        self.save_current_image_data(name="Flatten")
+        if self.journal is not None:
+            self.journal.record_checkpoint(self.pil_image)
+
+    def change_layers(self, operation, *args):
+        """
+        Changes the layer stack and recomputes the composite.
+
+        Args:
+        - operation: A method of the layer stack.
+        - args: Arguments of the method.
+        """
+        self.notify_listeners()
+        operation(*args)
+        self.pil_image = self.layers.composite()
+        self._content_hash = None
+        self.changed = True
+        self.save_current_image_data(name="Layers")
+        if self.journal is not None:
+            self.journal.record_checkpoint(self.pil_image)
+
+    def restore_layers(self):
         """
-        Saves the current image data to the history.
+        Restores the layer stack of the current history state.
         """
-        self.history_index += 1
-        if len(self.changes_history) > self.history_index:
-            self.changes_history = self.changes_history[:self.history_index+1]
-            pixel_data = self.pil_image.getdata()
-            self.changes_history.append(pixel_data)
-            self.size_history.append(self.pil_image.size)
+        snapshot = self.history.current.layers
+        if snapshot is None:
+            self.layers = None
+        elif self.layers is None:
+            self.layers = LayerStack(snapshot[0], cache_budget=self.result_cache.budget)
+            self.layers.restore(snapshot)
         else:
-            pixel_data = self.pil_image.getdata()
-            self.changes_history.append(pixel_data)
-            self.size_history.append(self.pil_image.size)
+            self.layers.restore(snapshot)
+
+    def get_statistics(self):
+        """
+        Returns the statistics cached for the current history state.
+
+        Returns:
+        - A dictionary filled with "estimate" and "exact" statistics once they are computed.
+        """
+        return self.history.current.stats
 
     def undo_image(self):
         """
         Undo the last image change.
         """
-        if self.history_index != 0:
-            self.history_index -= 1
-            new_image = Image.new('RGBA', self.size_history[self.history_index])
-            new_image.putdata(self.changes_history[self.history_index])
-            self.changed = True
-            self.pil_image = new_image
+        if self.history.current is not None and self.history.current.parent is not None:
+            self.jump_to(self.history.current.parent)
 
     def redo_image(self):
         """
-        Redo the last image change.
+        Redo the last undone change, following the branch visited last.
         """
-        if (self.history_index + 1) < len(self.changes_history):
-            self.history_index += 1
-            new_image = Image.new('RGBA', self.size_history[self.history_index])
-            new_image.putdata(self.changes_history[self.history_index])
-            self.changed = True
-            self.pil_image = new_image
+        if self.history.current is not None and self.history.current.last_child is not None:
+            self.jump_to(self.history.current.last_child)
+
+    def jump_to(self, node):
+        """
+        Restores any state of the history in one step, without going through the states
+        between it and the current one.
+
+        Args:
+        - node: A HistoryNode of the history of the image.
+        """
+        if node is self.history.current:
+            return
+        self.notify_listeners()
+        self.pil_image = self.history.get_image(node, self.buffer_pool)
+        self.history.move_to(node)
+        self.changed = True
+        self._content_hash = None
+        self.check_selection()
+        self.restore_layers()
+        if self.journal is not None:
+            self.journal.record_checkpoint(self.pil_image)
+
+    def get_name(self):
+        """
+        Returns the file name of the image.
+        """
+        return os.path.basename(self.path_file)
+
+    def is_loaded(self):
+        """
+        Checks if the pixel data of the image is in memory.
+        """
+        return self.storage_path is None
+
+    def memory_usage(self):
+        """
+        Estimates the memory used by the pixel data of the image, its history and the tiles
+        cached by its layers, which unloading frees too.
+
+        Returns:
+        - Number of bytes.
+        """
+        if not self.is_loaded() or self.pil_image is None:
+            return 0
+        usage = self.pil_image.width * self.pil_image.height * len(self.pil_image.getbands())
+        if self.layers is not None:
+            usage += self.layers.cache.size
+        return usage + self.history.memory_usage(self.pil_image)
+
+    def unload(self, path):
+        """
+        Moves the pixel data of the history states to a compressed file and frees them.
+        States are decompressed only when they are needed after reloading.
+
+        Args:
+        - path: The file to store the data in.
+        """
+        self.history.compress()
+        with open(path, "wb") as file:
+            # Pickled together, tiles shared between states stay shared after reloading.
+            pickle.dump(self.history.release(), file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pil_image = None
+        self._content_hash = None
+        if self.layers is not None:
+            self.layers.cache.clear()
+        self.storage_path = path
+
+    def reload(self):
+        """
+        Restores the pixel data stored by unload.
+        """
+        with open(self.storage_path, "rb") as file:
+            self.history.restore(pickle.load(file))
+        self.pil_image = self.history.get_image(self.history.current, self.buffer_pool)
+        os.remove(self.storage_path)
+        self.storage_path = None
+        self.changed = True
+
+    def discard(self):
+        """
+        Frees the image and removes its stored data.
+        """
+        if self.storage_path is not None and os.path.exists(self.storage_path):
+            os.remove(self.storage_path)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.pil_image = None
+        self.history = HistoryTree()
+        self.layers = None
+        self.animation = None
+        self.storage_path = None
@@ -1,11 +1,23 @@
+import os
 import pygame
 import sys
 from Settings import Settings
+from FramePacer import FramePacer
+from Preview import PreviewSpeculator, LivePreview
+from Histogram import HistogramPanel
+from Documents import DocumentManager, DocumentTabs
+from Layers import LayerPanel
+from Browser import ThumbnailBrowser
+from History import HistoryPanel
+from Dialogs import DialogService
+from DecodeCache import DecodeCache
+from Painting import ToolPanel
+from Journal import JournalWriter
 from Buttons import LoadButton, NormalButton, SaveButton, UndoButton, RedoButton
 from Canva import Canvas
 from Menu import CommandMenu, Section
 from Commands import *
-from Boxes import NumericalBox
+from Boxes import NumericalBox, Checkbox
 from ImageClass import IEPImage
 from InterfaceElement import TypeOfInteraction
 from custom_exceptions import *
@@ -16,46 +28,110 @@ class ImageEdit:
     The ImageEdit class manages an image editing application using Pygame and Pillow.
 
     Attributes:
-    - settings (Settings): Holds the application's settings.
+    - settings (Settings): Holds the application's settings, the default settings if none are given.
     - screen (pygame.Surface): Pygame window for the application.
-    - clock (pygame.time.Clock): Manages the application's fps.
+    - pacer (FramePacer): Manages the application's fps and idle sleeping.
     - buttons (list): Stores various buttons for user interactions.
+    - tool_panel (ToolPanel): Chooses the tool used on the canvas and the brush settings.
     - canvas (Canvas): Manages the drawing canvas within the application.
     - pil_image (Image): Placeholder for the loaded PIL image.
-    - image (IEPImage): Manages the image editing functionalities.
+    - documents (DocumentManager): Manages the open images.
+    - image (IEPImage): The active image, or an empty image if no image is open.
     - menus (dict): Stores different menus for the application.
     - current_menu: Current menu in use.
+    - speculator (PreviewSpeculator): Precomputes previews of the commands in the current menu.
+    - live_preview (LivePreview): Previews values typed into numerical boxes.
+    - histogram (HistogramPanel): Shows the histogram and statistics of the image.
+    - layer_panel (LayerPanel): Shows and edits the adjustment layers of the image.
+    - browser (ThumbnailBrowser): Shows the images of a directory as thumbnails over the canvas.
+    - history_panel (HistoryPanel): Shows the history tree of the image over the canvas.
+    - dialogs (DialogService): Shows the file dialogs without blocking the main loop.
+    - pointer (tuple): Position of the mouse pointer given by the last mouse event.
     """
-    def __init__(self):
+    def __init__(self, settings=None):
         pygame.init()
-        self.settings = Settings()
+        self.settings = settings if settings is not None else Settings()
         self.screen = pygame.display.set_mode((self.settings.screen_width, self.settings.screen_height))
-        self.clock = pygame.time.Clock()
+        self.pacer = FramePacer(self.settings.active_fps, self.settings.idle_fps, self.settings.idle_delay)
         pygame.display.set_caption("ImageEdit")
         self.icon = pygame.image.load("Resources/icon.png")
         pygame.display.set_icon(self.icon)
         self.buttons = []
-        self.canvas = Canvas(self.screen, self.settings.canvas_pos, 1100, 900, (100, 100, 100))
+        self.tool_panel = ToolPanel(self.screen, (1310, 830), 180, 90)
+        self.canvas = Canvas(self.screen, self.settings.canvas_pos, 1100, 900, (100, 100, 100), tools=self.tool_panel)
         self.pil_image: Image = None
-        self.image = IEPImage()
+        self.documents = DocumentManager(self.settings.document_memory_budget, self.settings.result_cache_budget,
+                                         journal_writer=JournalWriter(self.settings.journal_dir,
+                                                                      self.settings.journal_checkpoint_interval),
+                                         pool_budget=self.settings.buffer_pool_budget,
+                                         frame_workers=self.settings.animation_workers,
+                                         decode_cache=self.create_decode_cache())
+        self.image = IEPImage(result_cache=self.documents.result_cache, buffer_pool=self.documents.buffer_pool)
         self.menus = {}
         self.current_menu = None
+        self.speculator = PreviewSpeculator(self.settings.preview_workers, self.settings.preview_size)
+        self.documents.listeners.append(self.speculator.cancel)
+        self.pacer.add_busy_source(self.speculator.is_busy)
+        self.live_preview = LivePreview(self.settings.live_preview_delay, self.settings.live_preview_settle_delay)
+        self.documents.listeners.append(self.live_preview.cancel)
+        self.pacer.add_busy_source(self.live_preview.is_busy)
+        self.histogram = HistogramPanel(self.screen, (5, 705), 190, 220)
+        self.pacer.add_busy_source(self.histogram.is_busy)
+        self.layer_panel = LayerPanel(self.screen, (5, 85), 140, 130)
+        self.browser = ThumbnailBrowser(self.screen, (5, 225), (60, 25), (200, 25, 1100, 900),
+                                        self.settings.thumbnail_dir, self.settings.thumbnail_size,
+                                        self.settings.thumbnail_workers)
+        self.pacer.add_busy_source(self.browser.is_busy)
+        self.history_panel = HistoryPanel(self.screen, (5, 255), (60, 25), (200, 25, 1100, 900))
+        self.pacer.add_busy_source(self.history_panel.is_busy)
+        self.dialogs = DialogService()
+        self.pointer = pygame.mouse.get_pos()
 
-    def run_app(self):
+    def create_decode_cache(self):
+        """
+        Creates the cache of decoded files described by the settings.
+
+        Returns:
+        - The DecodeCache, or None if it is disabled.
+        """
+        if self.settings.decode_cache_quota <= 0:
+            return None
+        return DecodeCache(self.settings.decode_cache_dir, self.settings.decode_cache_quota,
+                           self.settings.decode_cache_min_pixels)
+
+    def run_app(self, recorder=None):
         """
         Runs the main application loop handling events, updates, and rendering.
+        Documents of a previous session that did not close cleanly are recovered first.
+
+        Args:
+        - recorder: A ScriptRecorder receiving the events of every frame, or None.
         """
+        if self.documents.recover():
+            self.show_active_document()
         while True:
-            self.check_events()
-            self.update()
-            self.render()
+            events = self.pacer.get_events()
+            if recorder is not None:
+                recorder.record(events)
+            self.run_frame(events)
+
+    def run_frame(self, events):
+        """
+        Handles the events of one frame, updates the application and renders it.
+
+        Args:
+        - events: A list of Pygame events.
+        """
+        self.check_events(events)
+        self.update()
+        self.render()
 
     def load_elements(self):
         """
          Loads various UI elements like buttons and menus required for the application.
         """
-        self.buttons.append(LoadButton(self.screen, (70, 225), button_image="Resources/load_button.png"))
-        self.buttons.append(SaveButton(self.screen, (70, 625), button_image="Resources/save_button.png"))
+        self.buttons.append(LoadButton(self.screen, (70, 225), self.dialogs, button_image="Resources/load_button.png"))
+        self.buttons.append(SaveButton(self.screen, (70, 625), self.dialogs, button_image="Resources/save_button.png"))
 
         # Resize
         self.buttons.append(NormalButton(self.screen, (70, 325), "Resize",
@@ -65,8 +141,34 @@ class ImageEdit:
                                                  [NumericalBox(self.screen, (1310, 160), 70,
                                                                30, "x", 100, 1),
                                                   NumericalBox(self.screen, (1410, 160), 70, 30,
-                                                               "y", 1100, 900)],
-                                                 ElementType.NUMERIC_VALUE), ChangePixelSize())
+                                                               "y", 1100, 900),
+                                                  Checkbox(self.screen, (1330, 230), "aspect lock", 30, 30,
+                                                           "aspect lock"),
+                                                  NumericalBox(self.screen, (1410, 230), 70, 30,
+                                                               "quality", 2, 0, starting_value=Resize.BALANCED)],
+                                                 ElementType.NUMERIC_VALUE, submit_all=True), Resize())
+        self.menus["Resize"].add_element(Section(self.screen, (1400, 300), "Crop",
+                                                 [NumericalBox(self.screen, (1310, 335), 70, 30,
+                                                               "left", 10000, 0),
+                                                  NumericalBox(self.screen, (1410, 335), 70, 30,
+                                                               "top", 10000, 0),
+                                                  NumericalBox(self.screen, (1310, 405), 70, 30,
+                                                               "width", 10000, 0),
+                                                  NumericalBox(self.screen, (1410, 405), 70, 30,
+                                                               "height", 10000, 0)],
+                                                 ElementType.NUMERIC_VALUE, submit_all=True), Crop())
+        self.menus["Resize"].add_element(Section(self.screen, (1350, 475), "Rotate left",
+                                                 [NormalButton(self.screen, (1320, 490), "Rotate left")],
+                                                 ElementType.TOGGLE_VALUE), Transpose("rotate_90"))
+        self.menus["Resize"].add_element(Section(self.screen, (1450, 475), "Rotate right",
+                                                 [NormalButton(self.screen, (1420, 490), "Rotate right")],
+                                                 ElementType.TOGGLE_VALUE), Transpose("rotate_270"))
+        self.menus["Resize"].add_element(Section(self.screen, (1350, 575), "Flip horizontal",
+                                                 [NormalButton(self.screen, (1320, 590), "Flip horizontal")],
+                                                 ElementType.TOGGLE_VALUE), Transpose("flip_left_right"))
+        self.menus["Resize"].add_element(Section(self.screen, (1450, 575), "Flip vertical",
+                                                 [NormalButton(self.screen, (1420, 590), "Flip vertical")],
+                                                 ElementType.TOGGLE_VALUE), Transpose("flip_top_bottom"))
 
         # Filters
         self.buttons.append(NormalButton(self.screen, (70, 425), "Filters",
@@ -90,6 +192,10 @@ class ImageEdit:
         self.menus["Filters"].add_element(Section(self.screen, (1400, 625), "Smooth",
                                                   [NormalButton(self.screen, (1369, 640), "Smooth")],
                                                   ElementType.TOGGLE_VALUE), Smooth())
+        self.menus["Filters"].add_element(Section(self.screen, (1400, 725), "Gaussian blur",
+                                                  [NumericalBox(self.screen, (1365, 760), 70,
+                                                                30, "radius", 200, 0)],
+                                                  ElementType.NUMERIC_VALUE), GaussianBlur())
 
         # Color interactions
         self.buttons.append(NormalButton(self.screen, (70, 525), "Color",
@@ -114,36 +220,124 @@ class ImageEdit:
                                                  NumericalBox(self.screen, (1365, 525), 70,
                                                               30, "b", 100, 0)],
                                                 ElementType.NUMERIC_VALUE), ColorBalance())
+        self.menus["Color"].add_element(Section(self.screen, (1400, 625), "Adaptive equalization",
+                                                [NormalButton(self.screen, (1369, 640),
+                                                              "Adaptive equalization")], ElementType.TOGGLE_VALUE),
+                                        AdaptiveEqualization())
+
+        # Layers, tools, the image browser and the history
+        self.buttons.append(self.layer_panel)
+        self.buttons.append(self.tool_panel)
+        self.buttons.append(self.browser)
+        self.buttons.append(self.history_panel)
+
+        # Open documents
+        self.buttons.append(DocumentTabs(self.screen, (200, 2), 1100, 21, self.documents))
 
         # Undo/Redo buttons
         self.buttons.append(UndoButton(self.screen, (148, 25), "Undo", button_image="Resources/undo_button.png"))
         self.buttons.append(RedoButton(self.screen, (1300, 25), "Redo", button_image="Resources/redo_button.png"))
 
-    def check_events(self):
+    def check_events(self, events):
         """
         Handles Pygame events
+
+        Args:
+        - events: A list of Pygame events to handle.
         """
-        for event in pygame.event.get():
+        # Paths chosen in file dialogs select their buttons, which are handled with the events.
+        self.dialogs.poll()
+        for event in events:
             if event.type == pygame.QUIT:
-                sys.exit()
-            pos = pygame.mouse.get_pos()
+                self.quit()
+            # Events carry the pointer position, so recorded events replay without a real mouse.
+            if hasattr(event, "pos"):
+                self.pointer = event.pos
+            pos = self.pointer
+            was_browsing = self.browser.is_open
+            if not (self.browser.is_open or self.history_panel.is_open):
+                self.canvas.check_events(event, pos)
             for button in self.buttons:
                 button.check_events(event, pos)
                 try:
                     if button.get_selection():
                         if button.type_name == TypeOfInteraction.LOAD:
-                            self.image.assign_image(button.load_image())
-                            self.canvas.add_image(self.image)
+                            self.documents.open(button.load_image())
+                            self.show_active_document()
+                        elif button.type_name == TypeOfInteraction.BROWSE:
+                            self.documents.open(button.path)
+                            self.show_active_document()
                         elif button.type_name == TypeOfInteraction.SAVE:
                             button.save_image(self.image)
                         elif button.type_name == TypeOfInteraction.UNDO_REDO:
                             button.do_action(self.image)
                         elif button.type_name == TypeOfInteraction.DEFAULT:
                             self.current_menu = self.menus[button.name]
+                        elif button.type_name == TypeOfInteraction.DOCUMENT:
+                            if button.action == "close":
+                                self.canvas.remove_image(button.document)
+                                self.documents.close(button.document)
+                            else:
+                                self.documents.activate(button.document)
+                            self.show_active_document()
+                        elif button.type_name == TypeOfInteraction.LAYERS:
+                            self.change_layers(button.action)
+                        elif button.type_name == TypeOfInteraction.HISTORY:
+                            self.image.jump_to(button.node)
                 except NoFileSelectedError as e:
                     print(e)
-                if self.current_menu is not None:
-                    self.current_menu.check_events(event, pos)
+            if self.current_menu is not None:
+                self.current_menu.check_events(event, pos)
+            # The browser and the history share the space over the canvas; the one opened last stays.
+            if self.browser.is_open and self.history_panel.is_open:
+                (self.browser if was_browsing else self.history_panel).close()
+
+    def change_layers(self, action):
+        """
+        Applies a change requested in the layer panel to the active image.
+
+        Args:
+        - action: Tuple of the name of the change and its arguments.
+        """
+        name, *args = action
+        if name == "enable":
+            self.image.enable_layers()
+        elif name == "flatten":
+            self.image.flatten_layers()
+        elif name == "select":
+            self.image.layers.selected = args[0]
+        else:
+            self.image.change_layers(getattr(self.image.layers, name), *args)
+
+    def show_active_document(self):
+        """
+        Displays the active document on the canvas.
+        """
+        if self.documents.active is None:
+            self.image = IEPImage(result_cache=self.documents.result_cache, buffer_pool=self.documents.buffer_pool)
+            self.canvas.remove_image()
+        else:
+            self.image = self.documents.active
+            self.canvas.add_image(self.image)
+
+    def quit(self):
+        """
+        Stops background workers, removes temporary data and exits the application.
+        """
+        self.shutdown()
+        sys.exit()
+
+    def shutdown(self):
+        """
+        Stops background workers and removes temporary data.
+        """
+        self.speculator.shutdown()
+        self.live_preview.shutdown()
+        self.histogram.shutdown()
+        self.browser.shutdown()
+        self.history_panel.shutdown()
+        self.dialogs.shutdown()
+        self.documents.shutdown()
 
     def render(self):
         """
@@ -155,8 +349,11 @@ class ImageEdit:
         if self.current_menu is not None:
             self.current_menu.draw()
         self.canvas.draw()
+        self.browser.draw_overlay()
+        self.history_panel.draw_overlay()
+        self.histogram.draw()
+        self.speculator.draw(self.screen, self.pointer)
         pygame.display.update()
-        self.clock.tick(60)
 
     def update(self):
         """
@@ -167,4 +364,11 @@ class ImageEdit:
                 self.current_menu.update(self.image)
             except NoImageError as e:
                 print(e)
+        self.speculator.update(self.current_menu, self.image, self.pointer)
+        self.live_preview.update(self.current_menu, self.image, self.canvas)
+        self.histogram.update(self.image)
+        self.layer_panel.update(self.image)
+        self.browser.update(os.path.dirname(self.image.path_file) if self.image.path_file else None)
+        self.history_panel.update(self.image)
+        self.documents.enforce_budget()
         self.canvas.update()
@@ -12,12 +12,20 @@ class TypeOfInteraction(Enum):
     - SAVE: Interaction type for saving (value: 3)
     - INSTANT_ACTION: Interaction type for instant action (value: 4)
     - UNDO_REDO: Interaction type for undo/redo (value: 5)
+    - DOCUMENT: Interaction type for switching and closing documents (value: 6)
+    - LAYERS: Interaction type for changing the layer stack (value: 7)
+    - BROWSE: Interaction type for opening an image from the thumbnail browser (value: 8)
+    - HISTORY: Interaction type for restoring a state from the history panel (value: 9)
     """
     DEFAULT = 1
     LOAD = 2
     SAVE = 3
     INSTANT_ACTION = 4
     UNDO_REDO = 5
+    DOCUMENT = 6
+    LAYERS = 7
+    BROWSE = 8
+    HISTORY = 9
 
 
 class ElementBase:
@@ -0,0 +1,308 @@
+import copy
+import glob
+import os
+import pickle
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from PIL import Image
+from Commands import Inversion, Transpose
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+RECORD_HEADER = struct.Struct("<II")
+
+
+def read_records(path):
+    """
+    Reads the records of a journal, stopping at the first incomplete or damaged record.
+
+    Args:
+    - path: The file path of the journal.
+
+    Returns:
+    - List of record dictionaries.
+    """
+    records = []
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            records.append(pickle.loads(payload))
+    return records
+
+
+def recover_journal(path):
+    """
+    Rebuilds the last state of a document from its journal by loading the last
+    checkpoint and replaying the commands recorded after it.
+
+    Args:
+    - path: The file path of the journal.
+
+    Returns:
+    - Tuple of the source file path, the last checkpoint image and the list of
+      (command, selection) pairs to replay, or None if the journal does not contain a checkpoint.
+    """
+    source_path = ""
+    checkpoint = None
+    commands = []
+    for record in read_records(path):
+        if record["type"] == "open":
+            source_path = record["path"]
+        elif record["type"] == "checkpoint":
+            mode, size, pixels = record["pixels"]
+            checkpoint = Image.frombytes(mode, size, zlib.decompress(pixels))
+            commands = []
+        elif record["type"] == "command":
+            commands.append((record["command"], record.get("selection")))
+    if checkpoint is None:
+        return None
+    return source_path, checkpoint, commands
+
+
+def lock_file(file):
+    """
+    Takes an exclusive lock of an open file where the platform supports it.
+
+    Args:
+    - file: An open file object.
+
+    Returns:
+    - False if another process holds the lock, True otherwise.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class SessionJournal:
+    """
+    A class representing the append-only journal of one document.
+
+    Applied commands are recorded with their parameters, and compressed checkpoints of the
+    image are written every checkpoint_interval commands and after undo and redo. All writes
+    happen on the thread of the JournalWriter, so recording only enqueues a record.
+
+    Attributes:
+    - writer: The JournalWriter writing the records.
+    - path: The file path of the journal.
+    - checkpoint_interval: Number of commands between checkpoints.
+    - commands_since_checkpoint: Number of commands recorded after the last checkpoint.
+    - checkpoint_sequence: Number of the latest requested checkpoint.
+    - followed_checkpoints: Numbers of the checkpoints followed by a command record. Recovery
+      replays such commands on their checkpoint, so it is written even once superseded.
+    """
+    def __init__(self, writer, path, checkpoint_interval):
+        self.writer = writer
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.commands_since_checkpoint = 0
+        self.checkpoint_sequence = 0
+        self.followed_checkpoints = set()
+
+    def record_open(self, source_path, image):
+        """
+        Records the opened file and its first checkpoint.
+
+        Args:
+        - source_path: The file path of the opened image.
+        - image: The PIL image after opening.
+        """
+        self.writer.submit(self, {"type": "open", "path": source_path})
+        self.record_checkpoint(image)
+
+    def record_command(self, command, image, selection=None):
+        """
+        Records an applied command.
+
+        Args:
+        - command: The executed command.
+        - image: The PIL image after the command.
+        - selection: The Selection the command was restricted to, or None.
+        """
+        # Marked before the next checkpoint is requested, so the writer sees it when it skips.
+        self.followed_checkpoints.add(self.checkpoint_sequence)
+        self.writer.submit(self, {"type": "command", "command": copy.copy(command), "selection": selection})
+        self.commands_since_checkpoint += 1
+        if self.commands_since_checkpoint >= self.checkpoint_interval:
+            self.record_checkpoint(image)
+
+    def record_checkpoint(self, image):
+        """
+        Records a checkpoint of the image. Pixel data is compressed on the writer thread
+        and checkpoints superseded before being written are skipped, unless commands were
+        recorded after them.
+
+        Args:
+        - image: The PIL image to store. It must not be modified in place afterwards.
+        """
+        self.commands_since_checkpoint = 0
+        self.checkpoint_sequence += 1
+        self.writer.submit(self, {"type": "checkpoint", "image": image, "sequence": self.checkpoint_sequence})
+
+    def close(self):
+        """Ends the journal after a clean close of the document and removes its file."""
+        self.writer.submit(self, None)
+
+
+class JournalWriter:
+    """
+    A class writing the journals of all documents on a background thread.
+
+    Attributes:
+    - directory: Directory holding the journal files.
+    - checkpoint_interval: Number of commands between checkpoints of new journals.
+    """
+    def __init__(self, directory, checkpoint_interval):
+        self.directory = directory
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = queue.Queue()
+        self._files = {}
+        self._counter = 0
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+
+    def create_journal(self):
+        """
+        Creates a journal for a new document.
+
+        Returns:
+        - A new SessionJournal.
+        """
+        self._counter += 1
+        path = os.path.join(self.directory, f"{os.getpid()}-{self._counter}.journal")
+        return SessionJournal(self, path, self.checkpoint_interval)
+
+    def find_unfinished(self):
+        """
+        Finds journals left behind by sessions that did not close cleanly.
+
+        Returns:
+        - List of file paths of journals not used by a running session.
+        """
+        own = {journal.path for journal in self._files}
+        unfinished = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.journal"))):
+            if path in own:
+                continue
+            with open(path, "rb") as file:
+                if lock_file(file):
+                    unfinished.append(path)
+        return unfinished
+
+    def submit(self, journal, record):
+        """
+        Enqueues a record to be written.
+
+        Args:
+        - journal: The SessionJournal the record belongs to.
+        - record: The record dictionary, or None to close the journal.
+        """
+        self._queue.put((journal, record))
+
+    def shutdown(self):
+        """Writes the pending records and stops the writer thread."""
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            journal, record = self._queue.get()
+            if journal is None:
+                break
+            self._handle(journal, record)
+
+    def _handle(self, journal, record):
+        if record is None:
+            file = self._files.pop(journal, None)
+            if file is not None:
+                file.close()
+            if os.path.exists(journal.path):
+                os.remove(journal.path)
+            return
+        if record["type"] == "checkpoint":
+            sequence = record["sequence"]
+            followed = sequence in journal.followed_checkpoints
+            journal.followed_checkpoints.discard(sequence)
+            if sequence < journal.checkpoint_sequence and not followed:
+                return
+            image = record.pop("image")
+            record["pixels"] = (image.mode, image.size, zlib.compress(image.tobytes(), 1))
+        self._write(journal, record)
+
+    def _write(self, journal, record):
+        file = self._files.get(journal)
+        if file is None:
+            file = open(journal.path, "ab")
+            lock_file(file)
+            self._files[journal] = file
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def check_recovery(directory):
+    """
+    Checks that a journal recovers the last state when the writer falls behind: a command,
+    a checkpoint after an undo, a command and a checkpoint are queued, and the session
+    crashes before the last checkpoint is written.
+
+    Args:
+    - directory: An empty directory for the journal.
+
+    Returns:
+    - True if the recovered image is the image after the second command.
+    """
+    writer = JournalWriter(directory, checkpoint_interval=100)
+    # The records are queued while the writer thread is stopped and written afterwards.
+    writer.shutdown()
+    journal = writer.create_journal()
+    image = Image.frombytes("RGBA", (3, 2), bytes(range(24)))
+    journal.record_open("", image)
+    first, second = Inversion(), Transpose("flip_left_right")
+    journal.record_command(first, first.execute(image))
+    journal.record_checkpoint(image)
+    expected = second.execute(image)
+    journal.record_command(second, expected)
+    journal.record_checkpoint(expected)
+    # The session crashes before the last checkpoint is written.
+    pending = []
+    while not writer._queue.empty():
+        pending.append(writer._queue.get())
+    for queued_journal, record in pending[:-1]:
+        writer._handle(queued_journal, record)
+    recovered = recover_journal(journal.path)
+    for file in writer._files.values():
+        file.close()
+    if recovered is None:
+        return False
+    _, checkpoint, commands = recovered
+    for command, _ in commands:
+        checkpoint = command.execute(checkpoint)
+    return checkpoint.tobytes() == expected.tobytes()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as temporary:
+        passed = check_recovery(temporary)
+    print("recovery check passed" if passed else "recovery check FAILED")
+    sys.exit(0 if passed else 1)
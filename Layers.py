@@ -0,0 +1,422 @@
+import copy
+import hashlib
+import itertools
+import pygame
+from PIL import Image
+from InterfaceElement import ElementBase, TypeOfInteraction
+from ResultCache import ResultCache
+
+
+_versions = itertools.count(1)
+
+
+def digest(*parts):
+    """
+    Computes a short digest identifying a combination of values.
+
+    Args:
+    - parts: Values with a stable representation.
+
+    Returns:
+    - A hex digest.
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+class AdjustmentLayer:
+    """
+    A class representing a layer applying a command to the layers below it.
+
+    Attributes:
+    - command: The command of the layer.
+    - enabled: Indicates if the layer is applied.
+    """
+    def __init__(self, command, enabled=True):
+        self.command = command
+        self.enabled = enabled
+
+    def get_name(self):
+        """Returns the name of the layer."""
+        return type(self.command).__name__
+
+    def signature(self):
+        """Returns a hashable description of what the layer does."""
+        return type(self.command).__name__, self.command.parameters()
+
+
+class _BaseLevel:
+    """The pixels of the base image split into tiles."""
+    def __init__(self, stack):
+        self.stack = stack
+        self.size = stack.base.size
+        self.signatures = {tile: digest("base", stack.base_version, stack.tile_versions.get(tile, 0), tile)
+                           for tile in stack.get_tiles(self.size)}
+
+    def get_region(self, box):
+        return self.stack.base.crop(box)
+
+    def get_tile(self, tile):
+        return self.get_region(self.stack.get_tile_box(tile, self.size))
+
+
+class _LocalLevel:
+    """The result of a command computing every pixel from a small neighbourhood, cached per tile."""
+    def __init__(self, stack, layer, halo, below):
+        self.stack = stack
+        self.layer = layer
+        self.halo = halo
+        self.below = below
+        self.size = below.size
+        signature = layer.signature()
+        self.signatures = {}
+        for tile in stack.get_tiles(self.size):
+            box = stack.expand_box(stack.get_tile_box(tile, self.size), halo, self.size)
+            inputs = [below.signatures[neighbour] for neighbour in stack.get_tiles_in(box, self.size)]
+            self.signatures[tile] = digest(signature, inputs)
+
+    def get_tile(self, tile):
+        signature = self.signatures[tile]
+        result = self.stack.cache.get(signature)
+        if result is None:
+            box = self.stack.get_tile_box(tile, self.size)
+            region_box = self.stack.expand_box(box, self.halo, self.size)
+            region = self.layer.command.execute(self.below.get_region(region_box))
+            result = region.crop((box[0] - region_box[0], box[1] - region_box[1],
+                                  box[2] - region_box[0], box[3] - region_box[1]))
+            self.stack.cache.put(signature, result)
+        return result
+
+    def get_region(self, box):
+        return self.stack.assemble(self, box)
+
+
+class _GlobalLevel:
+    """The result of a command needing the whole image, cut into cached tiles."""
+    def __init__(self, stack, layer, below):
+        self.stack = stack
+        self.layer = layer
+        self.below = below
+        self.signature = digest(layer.signature(), sorted(below.signatures.items()))
+        self.size = stack.global_sizes.get(self.signature)
+        if self.size is None:
+            self._compute()
+        self.signatures = {tile: digest(self.signature, tile) for tile in stack.get_tiles(self.size)}
+
+    def _compute(self):
+        result = self.layer.command.execute(self.below.get_region((0, 0) + self.below.size))
+        self.size = result.size
+        self.stack.global_sizes[self.signature] = self.size
+        for tile in self.stack.get_tiles(self.size):
+            self.stack.cache.put(digest(self.signature, tile), result.crop(self.stack.get_tile_box(tile, self.size)))
+        return result
+
+    def get_tile(self, tile):
+        result = self.stack.cache.get(self.signatures[tile])
+        if result is None:
+            self._compute()
+            result = self.stack.cache.get(self.signatures[tile])
+        return result
+
+    def get_region(self, box):
+        return self.stack.assemble(self, box)
+
+
+class LayerStack:
+    """
+    A class representing a base image with a stack of adjustment layers.
+
+    The composite is computed per tile and the result of every layer is cached per tile under
+    a signature derived from the layer and the signatures of the input tiles it depends on.
+    Editing a layer therefore recomputes only tiles of that layer and the layers above it whose
+    inputs actually changed. Commands needing the whole image are computed at once and cut
+    into tiles.
+
+    Attributes:
+    - base: The PIL image below all layers.
+    - base_version: Version of the base image.
+    - tile_versions: Versions of tiles of the base image changed by painting. Versions are
+      never reused, so tiles of states left by undo are never mistaken for new ones.
+    - layers: List of AdjustmentLayer objects, the last one is on top.
+    - selected: Index of the selected layer or None.
+    - tile_size: Width and height of the tiles.
+    - cache: Cache of tile results.
+    - global_sizes: Output sizes of commands needing the whole image, by signature.
+    """
+    def __init__(self, base, tile_size=256, cache_budget=256 * 1024 * 1024):
+        self.base = base
+        self.base_version = next(_versions)
+        self.tile_versions = {}
+        self.layers = []
+        self.selected = None
+        self.tile_size = tile_size
+        self.cache = ResultCache(cache_budget, copies=False)
+        self.global_sizes = {}
+
+    def add(self, command):
+        """
+        Adds a layer on top of the stack. The layer keeps a copy of the command, as the
+        menu assigns the next values to the same command.
+
+        Args:
+        - command: The command of the new layer.
+        """
+        self.layers.append(AdjustmentLayer(copy.copy(command)))
+
+    def replace(self, index, command):
+        """
+        Changes the command of a layer.
+
+        Args:
+        - index: Index of the layer.
+        - command: The new command, copied like in add.
+        """
+        self.layers[index] = AdjustmentLayer(copy.copy(command), self.layers[index].enabled)
+
+    def remove(self, index):
+        """
+        Removes a layer.
+
+        Args:
+        - index: Index of the layer.
+        """
+        del self.layers[index]
+        self.selected = None
+
+    def move(self, index, new_index):
+        """
+        Moves a layer to another position in the stack.
+
+        Args:
+        - index: Current index of the layer.
+        - new_index: New index of the layer.
+        """
+        if 0 <= new_index < len(self.layers):
+            self.layers.insert(new_index, self.layers.pop(index))
+            if self.selected == index:
+                self.selected = new_index
+
+    def set_enabled(self, index, enabled):
+        """
+        Enables or disables a layer.
+
+        Args:
+        - index: Index of the layer.
+        - enabled: True to apply the layer.
+        """
+        self.layers[index] = AdjustmentLayer(self.layers[index].command, enabled)
+
+    def update_base(self, base, boxes):
+        """
+        Replaces the base image with a version changed only inside some boxes.
+        Only tiles overlapping the boxes are recomputed.
+
+        Args:
+        - base: The new PIL image of the same size.
+        - boxes: List of (left, top, right, bottom) boxes of the changed pixels.
+        """
+        self.base = base
+        for box in boxes:
+            for tile in self.get_tiles_in(box, base.size):
+                self.tile_versions[tile] = next(_versions)
+
+    def snapshot(self):
+        """
+        Returns the state of the stack for the history.
+
+        Returns:
+        - Tuple of the base image, its version, the versions of its tiles and the layers.
+        """
+        return self.base, self.base_version, dict(self.tile_versions), tuple(self.layers)
+
+    def restore(self, snapshot):
+        """
+        Restores a state returned by snapshot.
+
+        Args:
+        - snapshot: The state of the stack.
+        """
+        self.base, self.base_version, tile_versions, layers = snapshot
+        self.tile_versions = dict(tile_versions)
+        self.layers = list(layers)
+        self.selected = None
+
+    def composite(self):
+        """
+        Computes the image with all enabled layers applied.
+
+        Returns:
+        - A new PIL image.
+        """
+        level = _BaseLevel(self)
+        for layer in self.layers:
+            if not layer.enabled:
+                continue
+            halo = layer.command.get_halo()
+            if halo is None or halo > self.tile_size:
+                level = _GlobalLevel(self, layer, level)
+            else:
+                level = _LocalLevel(self, layer, halo, level)
+        return level.get_region((0, 0) + level.size)
+
+    def get_tiles(self, size):
+        """
+        Returns the tiles covering an image.
+
+        Args:
+        - size: The size of the image.
+
+        Returns:
+        - List of (column, row) tiles.
+        """
+        columns = -(-size[0] // self.tile_size)
+        rows = -(-size[1] // self.tile_size)
+        return [(column, row) for row in range(rows) for column in range(columns)]
+
+    def get_tiles_in(self, box, size):
+        """
+        Returns the tiles overlapping a box.
+
+        Args:
+        - box: The (left, top, right, bottom) box.
+        - size: The size of the image.
+        """
+        columns = range(box[0] // self.tile_size, -(-box[2] // self.tile_size))
+        rows = range(box[1] // self.tile_size, -(-box[3] // self.tile_size))
+        return [(column, row) for row in rows for column in columns]
+
+    def get_tile_box(self, tile, size):
+        """
+        Returns the (left, top, right, bottom) box of a tile.
+
+        Args:
+        - tile: The (column, row) tile.
+        - size: The size of the image.
+        """
+        left = tile[0] * self.tile_size
+        top = tile[1] * self.tile_size
+        return left, top, min(left + self.tile_size, size[0]), min(top + self.tile_size, size[1])
+
+    @staticmethod
+    def expand_box(box, halo, size):
+        """
+        Expands a box by a halo, clipped to the image.
+        """
+        return max(0, box[0] - halo), max(0, box[1] - halo), min(size[0], box[2] + halo), min(size[1], box[3] + halo)
+
+    def assemble(self, level, box):
+        """
+        Assembles a region of a level from its tiles.
+
+        Args:
+        - level: The level providing tiles.
+        - box: The (left, top, right, bottom) box of the region.
+
+        Returns:
+        - A new PIL image.
+        """
+        tiles = self.get_tiles_in(box, level.size)
+        if len(tiles) == 1:
+            tile_box = self.get_tile_box(tiles[0], level.size)
+            return level.get_tile(tiles[0]).crop((box[0] - tile_box[0], box[1] - tile_box[1],
+                                                  box[2] - tile_box[0], box[3] - tile_box[1]))
+        region = None
+        for tile in tiles:
+            image = level.get_tile(tile)
+            if region is None:
+                region = Image.new(image.mode, (box[2] - box[0], box[3] - box[1]))
+            tile_box = self.get_tile_box(tile, level.size)
+            region.paste(image, (tile_box[0] - box[0], tile_box[1] - box[1]))
+        return region
+
+
+class LayerPanel(ElementBase):
+    """
+    A class displaying the layer stack of the image.
+
+    Clicking the header turns layers on or flattens them. In a row, the square toggles
+    the layer, the name selects it for editing, the arrows move it and a right click removes it.
+
+    Attributes:
+    - Inherits attributes from ElementBase.
+    - action: Tuple describing the last requested change of the layers.
+    """
+    def __init__(self, screen, position: tuple, width, height, name="Layers",
+                 color: tuple = (100, 100, 100), selected_color: tuple = (142, 165, 163)):
+        super().__init__(screen, position, name)
+        self.type_name = TypeOfInteraction.LAYERS
+        self.rect = pygame.Rect(position[0], position[1], width, height)
+        self.color = color
+        self.selected_color = selected_color
+        self.text_color = (255, 255, 255)
+        self.row_height = 18
+        self.action = None
+        self.layers = None
+
+    def update(self, image):
+        """
+        Picks the layer stack of the image.
+
+        Args:
+        - image: An instance of IEPImage.
+        """
+        self.layers = image.layers
+
+    def get_rows(self):
+        """
+        Returns the rows of visible layers, the top layer first.
+
+        Returns:
+        - List of (index, rect) pairs.
+        """
+        if self.layers is None:
+            return []
+        rows = []
+        for row, index in enumerate(reversed(range(len(self.layers.layers)))):
+            top = self.rect.y + self.row_height * (row + 1)
+            if top + self.row_height > self.rect.bottom:
+                break
+            rows.append((index, pygame.Rect(self.rect.x, top, self.rect.width, self.row_height)))
+        return rows
+
+    def check_events(self, event, pos, *args, **kwargs):
+        if event.type != pygame.MOUSEBUTTONDOWN or event.button not in (1, 3) or not self.is_hovered(pos):
+            return
+        if pos[1] < self.rect.y + self.row_height:
+            if event.button == 1:
+                self.action = ("flatten",) if self.layers is not None else ("enable",)
+                self.selected = True
+            return
+        for index, rect in self.get_rows():
+            if not rect.collidepoint(pos):
+                continue
+            x = pos[0] - rect.x
+            if event.button == 3:
+                self.action = ("remove", index)
+            elif x < self.row_height:
+                self.action = ("set_enabled", index, not self.layers.layers[index].enabled)
+            elif x > rect.width - self.row_height:
+                self.action = ("move", index, index - 1)
+            elif x > rect.width - 2 * self.row_height:
+                self.action = ("move", index, index + 1)
+            else:
+                self.action = ("select", None if self.layers.selected == index else index)
+            self.selected = True
+
+    def is_hovered(self, mouse_pos):
+        return self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        pygame.draw.rect(self.screen, self.color, self.rect)
+        header = "Layers: on" if self.layers is not None else "Layers: off"
+        self.screen.blit(self.font.render(header, False, self.text_color), (self.rect.x + 3, self.rect.y))
+        for index, rect in self.get_rows():
+            layer = self.layers.layers[index]
+            if index == self.layers.selected:
+                pygame.draw.rect(self.screen, self.selected_color, rect)
+            box = pygame.Rect(rect.x + 3, rect.y + 3, self.row_height - 6, self.row_height - 6)
+            pygame.draw.rect(self.screen, self.text_color, box, 0 if layer.enabled else 1)
+            name = self.font.render(layer.get_name(), False, self.text_color)
+            self.screen.blit(name, (rect.x + self.row_height, rect.y),
+                             area=pygame.Rect(0, 0, rect.width - 3 * self.row_height, self.row_height))
+            self.screen.blit(self.font.render("^", False, self.text_color), (rect.right - 2 * self.row_height + 4, rect.y))
+            self.screen.blit(self.font.render("v", False, self.text_color), (rect.right - self.row_height + 4, rect.y))
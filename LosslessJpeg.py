@@ -0,0 +1,155 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from PIL import Image
+from Commands import Crop, Transpose
+
+# jpegtran options performing the operations of Transpose. jpegtran rotates clockwise.
+JPEGTRAN_OPTIONS = {"flip_left_right": ["-flip", "horizontal"],
+                    "flip_top_bottom": ["-flip", "vertical"],
+                    "rotate_90": ["-rotate", "270"],
+                    "rotate_180": ["-rotate", "180"],
+                    "rotate_270": ["-rotate", "90"],
+                    "transpose": ["-transpose"],
+                    "transverse": ["-transverse"]}
+
+# Operations exchanging the width and the height of the image.
+SWAPPING_OPERATIONS = ("rotate_90", "rotate_270", "transpose", "transverse")
+
+_PROBE = Image.frombytes("L", (3, 2), bytes(range(6)))
+_missing_reported = False
+
+
+def compose_transposes(operations):
+    """
+    Reduces consecutive flips and rotations to a single one.
+
+    Args:
+    - operations: List of Transpose operations, executed in order.
+
+    Returns:
+    - The operation doing the same, or None if they cancel out.
+    """
+    probe = _PROBE
+    for operation in operations:
+        probe = Transpose(operation).execute(probe)
+    if probe.tobytes() == _PROBE.tobytes() and probe.size == _PROBE.size:
+        return None
+    for operation in Transpose.OPERATIONS:
+        candidate = Transpose(operation).execute(_PROBE)
+        if candidate.size == probe.size and candidate.tobytes() == probe.tobytes():
+            return operation
+    return None
+
+
+def plan_lossless_steps(steps, size, block):
+    """
+    Converts the steps leading to an image into jpegtran calls.
+
+    Args:
+    - steps: The (command, selection) pairs leading to the image.
+    - size: The size of the source image.
+    - block: Width and height of the blocks of the JPEG source (its iMCU).
+
+    Returns:
+    - A tuple of the list of jpegtran options for every call and the size of the result, or
+      None if a step cannot be done without decoding the image.
+    """
+    calls = []
+    pending = []
+
+    def flush():
+        operation = compose_transposes(pending)
+        pending.clear()
+        if operation is not None:
+            calls.append(JPEGTRAN_OPTIONS[operation])
+
+    for command, _ in steps:
+        if isinstance(command, Transpose):
+            pending.append(command.operation)
+            if command.operation in SWAPPING_OPERATIONS:
+                size = size[1], size[0]
+                block = block[1], block[0]
+        elif isinstance(command, Crop):
+            left, top, right, bottom = command.get_box(size)
+            if (left, top, right, bottom) == (0, 0) + size:
+                continue
+            # jpegtran moves the corner of a crop to the block containing it.
+            if left % block[0] or top % block[1]:
+                return None
+            flush()
+            size = right - left, bottom - top
+            calls.append(["-crop", f"{size[0]}x{size[1]}+{left}+{top}"])
+        else:
+            return None
+    flush()
+    return calls, size
+
+
+def save_lossless_jpeg(source, path, steps):
+    """
+    Saves a JPEG edited only by crops, flips and rotations without decoding and encoding it
+    again, so its quality does not drop. The blocks of the source are moved by jpegtran.
+
+    Args:
+    - source: The file path of the JPEG source.
+    - path: The file path to save the image.
+    - steps: The (command, selection) pairs leading to the image.
+
+    Returns:
+    - True if the image was saved, False if it has to be encoded again.
+    """
+    global _missing_reported
+    try:
+        with Image.open(source) as image:
+            if image.format != "JPEG":
+                return False
+            size = image.size
+            layer = getattr(image, "layer", None) or [(None, 1, 1, None)]
+            block = 8 * max(h for _, h, _, _ in layer), 8 * max(v for _, _, v, _ in layer)
+    except OSError:
+        return False
+    plan = plan_lossless_steps(steps, size, block)
+    if plan is None:
+        return False
+    calls, size = plan
+    if calls and shutil.which("jpegtran") is None:
+        if not _missing_reported:
+            _missing_reported = True
+            print("jpegtran was not found, JPEGs are encoded again.")
+        return False
+    directory = os.path.dirname(os.path.abspath(path))
+    temporaries = []
+    try:
+        current = source
+        for options in calls:
+            descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=directory)
+            os.close(descriptor)
+            temporaries.append(temporary)
+            # The EXIF data is dropped like when the JPEG is encoded again: its orientation tag
+            # would turn the transformed pixels once more.
+            subprocess.run(["jpegtran", "-copy", "comments", "-perfect", *options, "-outfile", temporary, current],
+                           check=True, capture_output=True, timeout=120)
+            current = temporary
+        if not calls:
+            descriptor, temporary = tempfile.mkstemp(suffix=".part", dir=directory)
+            os.close(descriptor)
+            temporaries.append(temporary)
+            shutil.copyfile(source, temporary)
+            current = temporary
+        with Image.open(current) as result:
+            if result.size != size:
+                print(f"jpegtran made an image of {result.size} instead of {size}, the JPEG is encoded again.")
+                return False
+        os.replace(current, path)
+        return True
+    except (OSError, subprocess.SubprocessError) as e:
+        stderr = getattr(e, "stderr", None)
+        detail = stderr.decode(errors="replace").strip() if stderr else e
+        print(f"The JPEG could not be transformed losslessly, it is encoded again: {detail}")
+        return False
+    finally:
+        for temporary in temporaries:
+            if os.path.exists(temporary):
+                os.remove(temporary)
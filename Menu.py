@@ -39,6 +39,39 @@ class CommandMenu:
         """
         self._sections[element] = command
 
+    def items(self):
+        """
+        Returns the sections of the menu with their associated commands.
+
+        Returns:
+        - A view of (section, command) pairs.
+        """
+        return self._sections.items()
+
+    def get_command(self, section):
+        """
+        Returns the command associated with a section.
+
+        Args:
+        - section: A section of the menu.
+        """
+        return self._sections[section]
+
+    def get_hovered_section(self, pos):
+        """
+        Finds the section hovered by the mouse.
+
+        Args:
+        - pos: The position of the mouse.
+
+        Returns:
+        - The hovered section or None.
+        """
+        for section in self._sections:
+            if section.is_hovered(pos):
+                return section
+        return None
+
     def update(self, image: IEPImage):
         """
         Updates elements in the menu and executes commands if ready.
@@ -66,8 +99,9 @@ class Section(ElementBase):
     - ready: Indicates if there was a change in the section.
     - value_type: The type of value the section holds.
     - return_elements: Dictionary storing return elements.
+    - submit_all: Indicates if values of all elements are returned when any of them is confirmed.
     """
-    def __init__(self, screen, position, name, elements: list, value_type: ElementType):
+    def __init__(self, screen, position, name, elements: list, value_type: ElementType, submit_all=False):
         super().__init__(screen, position, name)
         self.elements: list = elements
         self.name = name
@@ -75,6 +109,7 @@ class Section(ElementBase):
         self.ready = False
         self.value_type = value_type
         self.return_elements = {}
+        self.submit_all = submit_all
 
         # Text information
         self.text_descr_color = (255, 255, 255)
@@ -108,6 +143,15 @@ class Section(ElementBase):
         for i in self.elements:
             i.check_events(event, mouse_pos)
 
+    def is_hovered(self, mouse_pos):
+        """
+        Checks if the mouse is hovering over any element of the section.
+
+        Args:
+        - mouse_pos: The position of the mouse.
+        """
+        return any(i.is_hovered(mouse_pos) for i in self.elements)
+
     def update(self):
         """Updates the section's elements."""
         for i in self.elements:
@@ -115,6 +159,9 @@ class Section(ElementBase):
                 if self.value_type == ElementType.NUMERIC_VALUE:
                     self.return_elements[i.name] = i.value
                 self.ready = True
+        if self.ready and self.submit_all:
+            for i in self.elements:
+                self.return_elements[i.name] = i.value
 
     def change_to_not_ready(self):
         """Resets the section to not ready state."""
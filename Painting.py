@@ -0,0 +1,196 @@
+import math
+import pygame
+from PIL import Image, ImageDraw
+from InterfaceElement import ElementBase
+from Selection import RegionDelta
+
+
+class BrushStroke:
+    """
+    A class representing a stroke of a round brush or eraser being painted.
+
+    The stroke paints into a private copy of the image, so the image seen by the rest of
+    the application does not change until the stroke ends. Touched tiles are tracked so the
+    finished stroke is stored as a delta of those tiles only.
+
+    Attributes:
+    - source: The PIL image before the stroke. It is never modified.
+    - image: The PIL image the stroke is painted into.
+    - color: The pixel value written by the brush, in the mode of the image.
+    - radius: The radius of the brush in image pixels.
+    - tile_size: Width and height of the tiles the change is stored in.
+    - tiles: Set of (column, row) tiles touched by the stroke.
+    - last_point: The last painted point, or None before the first point.
+    """
+    def __init__(self, source, color, radius, erase=False, tile_size=64):
+        self.source = source
+        self.image = source.copy()
+        self.color = self.get_pixel_value(source.mode, color, erase)
+        self.radius = max(0, radius)
+        self.tile_size = tile_size
+        self.tiles = set()
+        self.last_point = None
+        self._draw = ImageDraw.Draw(self.image)
+
+    @staticmethod
+    def get_pixel_value(mode, color, erase):
+        """
+        Converts a brush color to a pixel value of an image mode.
+
+        Args:
+        - mode: The mode of the image.
+        - color: The (r, g, b) color of the brush.
+        - erase: If True, returns transparent pixels, or white for images without alpha.
+
+        Returns:
+        - The pixel value.
+        """
+        if erase:
+            rgba = (0, 0, 0, 0) if "A" in Image.new(mode, (1, 1)).getbands() else (255, 255, 255, 255)
+        else:
+            rgba = tuple(color) + (255,)
+        return Image.new("RGBA", (1, 1), rgba).convert(mode).getpixel((0, 0))
+
+    def add_point(self, point):
+        """
+        Paints the segment from the last point to a new point.
+
+        Args:
+        - point: The new point in image pixels.
+
+        Returns:
+        - The (left, top, right, bottom) box of the changed pixels, clipped to the image.
+        """
+        start = self.last_point if self.last_point is not None else point
+        self.last_point = point
+        radius = self.radius
+        if start != point:
+            self._draw.line([start, point], fill=self.color, width=2 * radius + 1)
+        for center in (start, point):
+            self._draw.ellipse((center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius),
+                               fill=self.color)
+        self._mark_tiles(start, point)
+        return (max(0, min(start[0], point[0]) - radius - 1), max(0, min(start[1], point[1]) - radius - 1),
+                min(self.image.width, max(start[0], point[0]) + radius + 2),
+                min(self.image.height, max(start[1], point[1]) + radius + 2))
+
+    def _mark_tiles(self, start, end):
+        # Every painted pixel lies within the radius of a point of the segment, and every
+        # point of the segment lies within half a step of a sample.
+        step = self.tile_size / 2
+        length = math.dist(start, end)
+        samples = max(1, math.ceil(length / step))
+        reach = self.radius + 1 + step / 2
+        for index in range(samples + 1):
+            x = start[0] + (end[0] - start[0]) * index / samples
+            y = start[1] + (end[1] - start[1]) * index / samples
+            for column in range(int((x - reach) // self.tile_size), int((x + reach) // self.tile_size) + 1):
+                for row in range(int((y - reach) // self.tile_size), int((y + reach) // self.tile_size) + 1):
+                    self.tiles.add((column, row))
+
+    def finish(self):
+        """
+        Ends the stroke.
+
+        Returns:
+        - The RegionDelta of the tiles changed by the stroke, or None if nothing changed.
+        """
+        patches = []
+        for column, row in sorted(self.tiles, key=lambda tile: (tile[1], tile[0])):
+            box = (max(0, column * self.tile_size), max(0, row * self.tile_size),
+                   min(self.image.width, (column + 1) * self.tile_size),
+                   min(self.image.height, (row + 1) * self.tile_size))
+            if box[2] <= box[0] or box[3] <= box[1]:
+                continue
+            before = self.source.crop(box)
+            after = self.image.crop(box)
+            if before.tobytes() != after.tobytes():
+                patches.append((box, before, after))
+        return RegionDelta(patches) if patches else None
+
+
+class ToolPanel(ElementBase):
+    """
+    A class for choosing the tool used on the canvas and the settings of the brush.
+
+    Attributes:
+    - Inherits attributes from ElementBase.
+    - rect: The area of the panel.
+    - tool: "select", "brush" or "eraser".
+    - radius: The radius of the brush in image pixels.
+    - color: The (r, g, b) color of the brush.
+    - palette: Colors the brush color is chosen from.
+    """
+    TOOLS = ("select", "brush", "eraser")
+
+    def __init__(self, screen, position: tuple, width, height, name="Tools",
+                 color: tuple = (100, 100, 100), selected_color: tuple = (142, 165, 163)):
+        super().__init__(screen, position, name)
+        self.rect = pygame.Rect(position[0], position[1], width, height)
+        self.background_color = color
+        self.selected_color = selected_color
+        self.text_color = (255, 255, 255)
+        self.row_height = height // 3
+        self.tool = "select"
+        self.radius = 8
+        self.color = (0, 0, 0)
+        self.palette = [(0, 0, 0), (255, 255, 255), (220, 40, 40), (40, 180, 60),
+                        (40, 80, 220), (240, 210, 40), (150, 60, 200), (240, 140, 30)]
+
+    def get_tool_rects(self):
+        """Returns (tool, rect) pairs of the tool buttons."""
+        width = self.rect.width // len(self.TOOLS)
+        return [(tool, pygame.Rect(self.rect.x + index * width, self.rect.y, width, self.row_height))
+                for index, tool in enumerate(self.TOOLS)]
+
+    def get_size_rects(self):
+        """Returns the rects of the buttons decreasing and increasing the brush size."""
+        top = self.rect.y + self.row_height
+        return (pygame.Rect(self.rect.x, top, self.row_height, self.row_height),
+                pygame.Rect(self.rect.right - self.row_height, top, self.row_height, self.row_height))
+
+    def get_palette_rects(self):
+        """Returns (color, rect) pairs of the palette."""
+        width = self.rect.width // len(self.palette)
+        top = self.rect.y + 2 * self.row_height
+        return [(color, pygame.Rect(self.rect.x + index * width, top, width, self.row_height))
+                for index, color in enumerate(self.palette)]
+
+    def check_events(self, event, pos, *args, **kwargs):
+        if event.type == pygame.MOUSEWHEEL and self.is_hovered(pos):
+            self.radius = max(0, min(500, self.radius + event.y))
+            return
+        if event.type != pygame.MOUSEBUTTONDOWN or event.button != 1 or not self.is_hovered(pos):
+            return
+        for tool, rect in self.get_tool_rects():
+            if rect.collidepoint(pos):
+                self.tool = tool
+        smaller, larger = self.get_size_rects()
+        if smaller.collidepoint(pos):
+            self.radius = max(0, self.radius - 1 - self.radius // 8)
+        elif larger.collidepoint(pos):
+            self.radius = min(500, self.radius + 1 + self.radius // 8)
+        for color, rect in self.get_palette_rects():
+            if rect.collidepoint(pos):
+                self.color = color
+
+    def is_hovered(self, mouse_pos):
+        return self.rect.collidepoint(mouse_pos)
+
+    def draw(self):
+        pygame.draw.rect(self.screen, self.background_color, self.rect)
+        for tool, rect in self.get_tool_rects():
+            if tool == self.tool:
+                pygame.draw.rect(self.screen, self.selected_color, rect)
+            label = self.font.render(tool.capitalize(), False, self.text_color)
+            self.screen.blit(label, label.get_rect(center=rect.center))
+        smaller, larger = self.get_size_rects()
+        for text, rect in (("-", smaller), ("+", larger)):
+            label = self.font.render(text, False, self.text_color)
+            self.screen.blit(label, label.get_rect(center=rect.center))
+        label = self.font.render(f"Size: {self.radius}", False, self.text_color)
+        self.screen.blit(label, label.get_rect(center=(self.rect.centerx, smaller.centery)))
+        for color, rect in self.get_palette_rects():
+            pygame.draw.rect(self.screen, color, rect.inflate(-4, -4))
+            if color == self.color:
+                pygame.draw.rect(self.screen, self.text_color, rect, 1)
@@ -0,0 +1,151 @@
+from WorkingBuffer import BufferPool
+
+
+def convert_for(command, image):
+    """
+    Returns an image in a mode a command executes on, converting it only if the command
+    does not accept its mode. The image is converted directly to the preferred mode of
+    the command.
+
+    Args:
+    - command: The command to be executed.
+    - image: A PIL image.
+
+    Returns:
+    - The image to execute the command on and the number of conversions made (0 or 1).
+    """
+    if command.accepts(image.mode):
+        return image, 0
+    return image.convert("RGBA" if command.in_place else command.modes[0]), 1
+
+
+def run_command(command, image, pool):
+    """
+    Executes a command on an image in the mode the image already has whenever the command
+    accepts it. Commands working in place write into a pixel array of the pool, and the
+    copy into the array also converts the image to RGBA.
+
+    Args:
+    - command: The command to be executed.
+    - image: A PIL image.
+    - pool: The BufferPool providing the pixel arrays.
+
+    Returns:
+    - The new image and the number of conversions made.
+    """
+    if command.in_place:
+        pixels = pool.acquire_copy(image)
+        command.execute_in_place(pixels)
+        return pool.make_image(pixels), int(image.mode != "RGBA")
+    image, conversions = convert_for(command, image)
+    return command.execute(image), conversions
+
+
+class CommandChain:
+    """
+    A class executing a sequence of commands while tracking the pixel mode of the image.
+
+    The image keeps the mode produced by a command as long as the following commands accept
+    it, and is converted only for a command that does not, directly to the mode that command
+    prefers. Consecutive commands working in place share one pixel array of the pool: the
+    image is converted and copied into it once, and a single image is created at the end.
+
+    Attributes:
+    - commands: The commands executed in order.
+    - pool: The BufferPool providing the pixel arrays of commands working in place.
+    - conversions: Number of conversions made by the last execution.
+    - fused: Number of commands of the last execution that worked on the pixel array of the
+      previous command instead of a new image.
+    - avoided: Number of conversions the last execution saved compared to converting the
+      image to RGBA before and after every command.
+    """
+    def __init__(self, commands, pool=None):
+        self.commands = list(commands)
+        self.pool = pool if pool is not None else BufferPool(0)
+        self.conversions = 0
+        self.fused = 0
+        self.avoided = 0
+
+    def plan(self, mode):
+        """
+        Predicts the conversions of an execution on an image of a given mode.
+
+        Args:
+        - mode: The pixel mode of the input image.
+
+        Returns:
+        - The list of the modes the image is converted to before each command, None where it
+          is not converted, and the pixel mode of the result.
+        """
+        conversions = []
+        for command in self.commands:
+            if command.in_place:
+                conversions.append("RGBA" if mode != "RGBA" else None)
+                mode = "RGBA"
+                continue
+            target = None if command.accepts(mode) else command.modes[0]
+            conversions.append(target)
+            mode = command.get_output_mode(target or mode)
+        return conversions, mode
+
+    def count_unfused_conversions(self, mode):
+        """
+        Counts the conversions made if the image were converted to RGBA before and after
+        every command, as when each command is executed on its own.
+
+        Args:
+        - mode: The pixel mode of the input image.
+
+        Returns:
+        - The number of conversions.
+        """
+        count = int(mode != "RGBA")
+        for command in self.commands:
+            mode = "RGBA"
+            if not command.accepts(mode):
+                count += 1
+                mode = command.modes[0]
+            if command.get_output_mode(mode) != "RGBA":
+                count += 1
+        return count
+
+    def execute(self, image):
+        """
+        Executes the commands on an image.
+
+        Args:
+        - image: A PIL image, which is not modified.
+
+        Returns:
+        - The resulting PIL image.
+        """
+        conversions = fused = 0
+        pixels = None
+        unfused = self.count_unfused_conversions(image.mode)
+        for command in self.commands:
+            if command.in_place:
+                if pixels is None:
+                    conversions += image.mode != "RGBA"
+                    pixels = self.pool.acquire_copy(image)
+                else:
+                    fused += 1
+                command.execute_in_place(pixels)
+                continue
+            if pixels is not None:
+                image = self.pool.make_image(pixels)
+                pixels = None
+            image, converted = convert_for(command, image)
+            conversions += converted
+            image = command.execute(image)
+        if pixels is not None:
+            image = self.pool.make_image(pixels)
+        self.conversions = conversions
+        self.fused = fused
+        self.avoided = unfused - conversions
+        return image
+
+    def report(self):
+        """
+        Returns the counts of the last execution as a dictionary.
+        """
+        return {"conversions": self.conversions, "fused": self.fused, "avoided": self.avoided}
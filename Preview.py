@@ -0,0 +1,340 @@
+import copy
+import threading
+import PIL.Image
+import pygame
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from Boxes import NumericalBox
+from Commands import ElementType
+from FramePacer import report_progress
+from ResultCache import content_hash, image_size_in_bytes
+from Selection import execute_in_selection
+
+
+def pil_to_surface(image):
+    """
+    Converts a PIL image to a Pygame surface.
+
+    Args:
+    - image: A PIL image.
+
+    Returns:
+    - A Pygame surface with the content of the image.
+    """
+    if image.mode not in ("RGBA", "RGB"):
+        image = image.convert("RGBA")
+    return pygame.image.fromstring(image.tobytes(), image.size, image.mode)
+
+
+class PreviewSpeculator:
+    """
+    A class that speculatively computes the results of menu commands on worker threads.
+
+    As soon as a menu is opened, low resolution previews of every toggle section are
+    computed and shown as thumbnails while hovering the section. When the workers are idle,
+    the full resolution result of the hovered section is computed and stored in the result
+    cache of the image, so that applying the command afterwards is instant. Any work on the
+    image cancels the pending speculation.
+
+    Attributes:
+    - executor: Pool of worker threads.
+    - thumbnail_size: Maximum width and height of the previews.
+    - menu: The menu for which previews are computed.
+    - source: The PIL image for which previews are computed.
+    - source_hash: Content hash of the source once known.
+    - generation: Counter invalidating results of cancelled work.
+    - previews: Dictionary mapping sections to their low resolution previews.
+    """
+    def __init__(self, workers, thumbnail_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preview")
+        self.thumbnail_size = thumbnail_size
+        self.menu = None
+        self.source = None
+        self.source_hash = None
+        self.generation = 0
+        self.previews = {}
+        self._surfaces = {}
+        self._futures = []
+        self._full_future = None
+        self._full_requested = set()
+        self._lock = threading.Lock()
+
+    def is_busy(self):
+        """
+        Checks if any speculative work is pending.
+
+        Returns:
+        - True if a worker is computing a preview or a full resolution result.
+        """
+        if self._full_future is not None and not self._full_future.done():
+            return True
+        return any(not future.done() for future in self._futures)
+
+    def cancel(self):
+        """Cancels the pending speculation and discards results of running jobs."""
+        with self._lock:
+            self.generation += 1
+        for future in self._futures:
+            future.cancel()
+        if self._full_future is not None:
+            self._full_future.cancel()
+        self._futures = []
+        self._full_future = None
+        self.source = None
+
+    def shutdown(self):
+        """Cancels the speculation and stops the worker threads."""
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def update(self, menu, image, mouse_pos):
+        """
+        Starts the speculation when the menu or the image changes, and precomputes the
+        full resolution result of the hovered section when the workers are idle.
+
+        Args:
+        - menu: The currently opened CommandMenu or None.
+        - image: An instance of IEPImage.
+        - mouse_pos: The position of the mouse.
+        """
+        if menu is None or image.pil_image is None:
+            return
+        if menu is not self.menu or image.pil_image is not self.source:
+            self._start(menu, image)
+        elif not self.is_busy():
+            section = menu.get_hovered_section(mouse_pos)
+            if section is not None and section in self.previews:
+                self._precompute_full(section, menu.get_command(section), image)
+
+    def draw(self, screen, mouse_pos):
+        """
+        Draws the preview of the hovered section next to the menu.
+
+        Args:
+        - screen: The Pygame screen surface.
+        - mouse_pos: The position of the mouse.
+        """
+        if self.menu is None:
+            return
+        section = self.menu.get_hovered_section(mouse_pos)
+        with self._lock:
+            preview = self.previews.get(section)
+        if preview is None:
+            return
+        surface = self._surfaces.get(section)
+        if surface is None:
+            surface = pil_to_surface(preview)
+            self._surfaces[section] = surface
+        rect = surface.get_rect(topright=(section.pos[0] - 110, section.pos[1]))
+        screen.blit(surface, rect)
+        pygame.draw.rect(screen, (142, 165, 163), rect.inflate(4, 4), 2)
+
+    def _start(self, menu, image):
+        self.cancel()
+        self.menu = menu
+        self.source = image.pil_image
+        self.source_hash = None
+        self.previews = {}
+        self._surfaces = {}
+        self._full_requested = set()
+        generation = self.generation
+        proxy = self.executor.submit(self._make_proxy, self.source)
+        self._futures.append(proxy)
+        for section, command in menu.items():
+            if section.value_type == ElementType.TOGGLE_VALUE:
+                self._futures.append(self.executor.submit(self._compute_preview, generation, section,
+                                                          command, proxy))
+
+    def _make_proxy(self, source):
+        proxy = source.copy()
+        proxy.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        return proxy
+
+    def _compute_preview(self, generation, section, command, proxy):
+        if generation != self.generation:
+            return
+        try:
+            preview = command.execute(proxy.result())
+        except CancelledError:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self.previews[section] = preview
+        report_progress(job="preview")
+
+    def _precompute_full(self, section, command, image):
+        if section in self._full_requested or image.selection is not None:
+            return
+        if image_size_in_bytes(self.source) * 2 > image.result_cache.budget:
+            return
+        self._full_requested.add(section)
+        self._full_future = self.executor.submit(self._compute_full, self.generation, command, image,
+                                                 self.source)
+
+    def _compute_full(self, generation, command, image, source):
+        source_hash = self.source_hash
+        if source_hash is None:
+            source_hash = image.known_content_hash(source) or content_hash(source)
+            with self._lock:
+                if generation != self.generation:
+                    return
+                self.source_hash = source_hash
+            image.remember_content_hash(source, source_hash)
+        key = image.result_cache.make_key(source_hash, command)
+        if generation != self.generation or image.result_cache.contains(key):
+            return
+        result = command.execute(source)
+        if generation == self.generation:
+            image.result_cache.put(key, result)
+            report_progress(job="speculation")
+
+
+class LivePreview:
+    """
+    A class that previews the value typed into a NumericalBox before it is confirmed.
+
+    Rendering is debounced and progressive. Once typing pauses for proxy_delay milliseconds,
+    the command is applied to a copy of the image reduced to its displayed size. Once typing
+    pauses for settle_delay milliseconds, the command is applied at full resolution and the
+    result is stored in the result cache, so confirming the value with Enter is instant.
+    If a part of the image is selected, only that part is rendered, at full resolution.
+    Previews never enter the history of the image.
+
+    Attributes:
+    - executor: Worker thread rendering the previews.
+    - proxy_delay: Milliseconds without typing before the proxy preview is rendered.
+    - settle_delay: Milliseconds without typing before the full resolution preview is rendered.
+    - generation: Counter invalidating results of cancelled work.
+    """
+    def __init__(self, proxy_delay, settle_delay):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-preview")
+        self.proxy_delay = proxy_delay
+        self.settle_delay = settle_delay
+        self.generation = 0
+        self._target = None
+        self._stage = 0
+        self._future = None
+        self._result = None
+        self._proxy = None
+        self._lock = threading.Lock()
+
+    def is_busy(self):
+        """
+        Checks if a preview is waiting to be rendered or is being rendered.
+
+        Returns:
+        - True if the preview needs the main loop to keep running.
+        """
+        if self._future is not None and not self._future.done():
+            return True
+        return self._target is not None and self._stage < 2
+
+    def cancel(self):
+        """Cancels the pending preview and discards results of running jobs."""
+        with self._lock:
+            self.generation += 1
+            self._result = None
+        if self._future is not None:
+            self._future.cancel()
+        self._future = None
+        self._target = None
+        self._stage = 0
+
+    def shutdown(self):
+        """Cancels the preview and stops the worker thread."""
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def update(self, menu, image, canvas):
+        """
+        Schedules rendering of the value being typed and displays finished previews.
+
+        Args:
+        - menu: The currently opened CommandMenu or None.
+        - image: An instance of IEPImage.
+        - canvas: The Canvas displaying the image.
+        """
+        target = self._find_target(menu)
+        if target is None or image.pil_image is None:
+            if self._target is not None:
+                self.cancel()
+            canvas.clear_preview()
+            return
+        section, box, value = target
+        if (section, box.name, value) != self._target:
+            self.cancel()
+            self._target = (section, box.name, value)
+        with self._lock:
+            result, self._result = self._result, None
+        if result is not None:
+            canvas.show_preview(result)
+
+        idle_time = pygame.time.get_ticks() - box.edited_at
+        if self._future is not None and not self._future.done():
+            return
+        data = {element.name: element.value for element in section.elements} if section.submit_all else {}
+        data[box.name] = value
+        command = copy.copy(menu.get_command(section))
+        command.assign_data(data)
+        source = image.pil_image
+        display_size = canvas.get_display_size(source.size)
+        if self._stage == 0 and idle_time >= self.proxy_delay:
+            if image.selection is not None and image.layers is None and not command.geometric:
+                self._stage = 2
+                self._future = self.executor.submit(self._render_selection, self.generation, command, source,
+                                                    image.selection)
+            elif display_size == source.size:
+                self._stage = 2
+                self._future = self.executor.submit(self._render_full, self.generation, command, image, source)
+            else:
+                self._stage = 1
+                self._future = self.executor.submit(self._render_proxy, self.generation, command, source,
+                                                    display_size)
+        elif self._stage == 1 and idle_time >= self.settle_delay:
+            self._stage = 2
+            self._future = self.executor.submit(self._render_full, self.generation, command, image, source)
+
+    @staticmethod
+    def _find_target(menu):
+        if menu is None:
+            return None
+        for section, _ in menu.items():
+            if section.value_type != ElementType.NUMERIC_VALUE:
+                continue
+            for element in section.elements:
+                if isinstance(element, NumericalBox):
+                    value = element.get_pending_value()
+                    if value is not None:
+                        return section, element, value
+        return None
+
+    def _deliver(self, generation, preview):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._result = preview
+        report_progress(job="live preview")
+
+    def _render_proxy(self, generation, command, source, size):
+        proxy = self._proxy
+        if proxy is None or proxy[0] is not source or proxy[1] != size:
+            proxy = (source, size, source.resize(size, resample=PIL.Image.BILINEAR, reducing_gap=2.0))
+            self._proxy = proxy
+        if generation == self.generation:
+            self._deliver(generation, command.execute(proxy[2]))
+
+    def _render_selection(self, generation, command, source, selection):
+        restricted = execute_in_selection(command, source, selection)
+        self._deliver(generation, command.execute(source) if restricted is None else restricted[0])
+
+    def _render_full(self, generation, command, image, source):
+        source_hash = image.known_content_hash(source) or content_hash(source)
+        image.remember_content_hash(source, source_hash)
+        key = image.result_cache.make_key(source_hash, command)
+        result = image.result_cache.get(key)
+        if result is None:
+            if generation != self.generation:
+                return
+            result = command.execute(source)
+            image.result_cache.put(key, result)
+        self._deliver(generation, result)
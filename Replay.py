@@ -0,0 +1,530 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+import numpy as np
+import pygame
+from FramePacer import report_progress
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there.
+    resource = None
+
+
+# Attributes stored for the recorded event types. Other events, such as the progress of
+# background work, are produced by the application itself when it is replayed.
+EVENT_FIELDS = {
+    "MOUSEBUTTONDOWN": ("pos", "button"),
+    "MOUSEBUTTONUP": ("pos", "button"),
+    "MOUSEMOTION": ("pos", "rel", "buttons"),
+    "MOUSEWHEEL": ("x", "y"),
+    "KEYDOWN": ("key", "mod", "unicode", "scancode"),
+    "KEYUP": ("key", "mod", "unicode", "scancode"),
+}
+
+# Session used when no script is given: load an image, apply filters from the menus by
+# clicking and typing values, undo, redo, resize and save. "{image}" is replaced by the
+# path of the image and "{temp}" by a temporary directory.
+DEFAULT_SCRIPT = {
+    "description": "Load, blur, invert, undo, redo, resize and save",
+    "steps": [
+        {"click": [100, 255]},
+        {"dialog": "{image}", "label": "load"},
+        {"click": [100, 455]},
+        {"move": [1400, 300]},
+        {"click": [1400, 775]},
+        {"type": "4"},
+        {"key": "return", "label": "gaussian blur"},
+        {"click": [100, 555]},
+        {"move": [1400, 270]},
+        {"settle": True},
+        {"click": [1400, 270], "label": "inversion"},
+        {"click": [1400, 370], "label": "histogram equalization"},
+        {"click": [1340, 475]},
+        {"type": "80"},
+        {"wait": 700},
+        {"key": "return", "label": "color balance"},
+        {"click": [174, 51], "label": "undo"},
+        {"click": [174, 51], "label": "undo"},
+        {"click": [1326, 51], "label": "redo"},
+        {"click": [100, 355]},
+        {"click": [1345, 175]},
+        {"type": "50"},
+        {"key": "return", "label": "resize"},
+        {"click": [100, 655]},
+        {"dialog": "{temp}/result.png", "label": "save"},
+    ],
+}
+
+
+def encode_event(event):
+    """
+    Converts a Pygame event into a dictionary that can be stored as JSON.
+
+    Args:
+    - event: A Pygame event.
+
+    Returns:
+    - The dictionary, or None if events of this type are not recorded.
+    """
+    name = pygame.event.event_name(event.type).upper()
+    if name not in EVENT_FIELDS:
+        return None
+    encoded = {"type": name}
+    for field in EVENT_FIELDS[name]:
+        if hasattr(event, field):
+            value = getattr(event, field)
+            encoded[field] = list(value) if isinstance(value, tuple) else value
+    return encoded
+
+
+def decode_event(encoded):
+    """
+    Creates the Pygame event stored by encode_event.
+
+    Args:
+    - encoded: Dictionary with the type of the event and its attributes.
+
+    Returns:
+    - A Pygame event.
+    """
+    attributes = {field: tuple(value) if isinstance(value, list) else value
+                  for field, value in encoded.items() if field != "type"}
+    return pygame.event.Event(getattr(pygame, encoded["type"]), attributes)
+
+
+def expand_step(step):
+    """
+    Returns the events of a script step. Besides recorded events, steps may click, move the
+    mouse, type text or press a named key.
+
+    Args:
+    - step: Dictionary describing the step.
+
+    Returns:
+    - A list of Pygame events, empty for steps without events.
+    """
+    events = [decode_event(encoded) for encoded in step.get("events", [])]
+    if "move" in step:
+        events.append(pygame.event.Event(pygame.MOUSEMOTION, pos=tuple(step["move"]), rel=(0, 0), buttons=(0, 0, 0)))
+    if "click" in step:
+        pos = tuple(step["click"])
+        events.append(pygame.event.Event(pygame.MOUSEMOTION, pos=pos, rel=(0, 0), buttons=(0, 0, 0)))
+        events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1))
+        events.append(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=pos, button=1))
+    for character in step.get("type", ""):
+        events.append(pygame.event.Event(pygame.KEYDOWN, key=ord(character), mod=0, unicode=character, scancode=0))
+    if "key" in step:
+        events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.key.key_code(step["key"]), mod=0, unicode="",
+                                         scancode=0))
+    return events
+
+
+def percentiles(values):
+    """
+    Summarizes durations.
+
+    Args:
+    - values: Sequence of durations in seconds.
+
+    Returns:
+    - Dictionary with the number of values and the median, 90th and 99th percentile, maximum
+      and mean in milliseconds.
+    """
+    if not values:
+        return {"count": 0}
+    milliseconds = np.asarray(values) * 1000
+    return {"count": len(values), "p50": float(np.percentile(milliseconds, 50)),
+            "p90": float(np.percentile(milliseconds, 90)), "p99": float(np.percentile(milliseconds, 99)),
+            "max": float(milliseconds.max()), "mean": float(milliseconds.mean())}
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the process in megabytes, or None if it is not known.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class ScriptRecorder:
+    """
+    A class recording the events of an interactive session as a script for ReplayHarness.
+    Frames without events are stored as the time waited until the next events.
+
+    Attributes:
+    - path: The file the script is saved to.
+    - steps: The recorded steps.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        self._last_step = time.perf_counter()
+
+    def _add(self, step):
+        now = time.perf_counter()
+        waited = int((now - self._last_step) * 1000)
+        if waited > 0 and self.steps:
+            self.steps.append({"wait": waited})
+        self.steps.append(step)
+        self._last_step = now
+
+    def record(self, events):
+        """
+        Records the events of a frame.
+
+        Args:
+        - events: A list of Pygame events.
+        """
+        encoded = [encoded for encoded in map(encode_event, events) if encoded is not None]
+        if encoded:
+            self._add({"events": encoded})
+
+    def record_dialog(self, path):
+        """
+        Records the path chosen in a file dialog.
+
+        Args:
+        - path: The chosen path, or "" if no file was chosen.
+        """
+        self._add({"dialog": path})
+
+    def save(self):
+        """Writes the script."""
+        with open(self.path, "w") as file:
+            json.dump({"description": "Recorded session", "steps": self.steps}, file, indent=1)
+        print(f"Recorded {len(self.steps)} steps to {self.path}")
+
+
+class ScriptedDialogs:
+    """
+    A class replacing DialogService during a replay. Requests are answered with the paths
+    given by the dialog steps of the script, in order.
+
+    Attributes:
+    - pending: Callbacks of the requests not answered yet.
+    - answers: Paths not used by a request yet.
+    - listeners: Callables receiving every path after the callback of its request.
+    """
+    def __init__(self):
+        self.pending = deque()
+        self.answers = deque()
+        self.listeners = []
+
+    def ask_open(self, callback, **options):
+        self.pending.append(callback)
+
+    def ask_save(self, callback, **options):
+        self.pending.append(callback)
+
+    def answer(self, path):
+        """
+        Provides the path chosen in the next dialog.
+
+        Args:
+        - path: The path, or "" if no file is chosen.
+        """
+        self.answers.append(path)
+        report_progress(job="dialog")
+
+    def poll(self):
+        while self.pending and self.answers:
+            path = self.answers.popleft()
+            self.pending.popleft()(path)
+            for listener in self.listeners:
+                listener(path)
+
+    def is_busy(self):
+        return bool(self.pending)
+
+    def shutdown(self):
+        pass
+
+
+class ReplayHarness:
+    """
+    A class replaying a script of events on the application and measuring it.
+
+    Every frame is paced by the application as in a real session, only the time spent
+    handling events, updating and rendering counts as frame time. Steps with a label are
+    measured from their first frame until the background work they started has finished.
+
+    Attributes:
+    - app: The ImageEdit application, with its file dialogs answered by the script.
+    - dialogs: The ScriptedDialogs of the application.
+    - max_wait: Longest wait of a script step in milliseconds, so recorded pauses are shortened.
+    - settle_timeout: Longest time in seconds to wait for background work to finish.
+    - frame_times: Durations of the frames in seconds.
+    - command_times: Dictionary mapping command names to their durations in seconds.
+    - step_times: Dictionary mapping step labels to their durations in seconds.
+    """
+    def __init__(self, app, max_wait=1000, settle_timeout=60):
+        self.app = app
+        self.dialogs = ScriptedDialogs()
+        app.dialogs = self.dialogs
+        app.load_elements()
+        self.max_wait = max_wait
+        self.settle_timeout = settle_timeout
+        self.frame_times = []
+        self.command_times = {}
+        self.step_times = {}
+
+    def run_frame(self, events=()):
+        """
+        Runs one frame of the application with the given events added to its events.
+
+        Args:
+        - events: Pygame events of the script.
+        """
+        for event in events:
+            pygame.event.post(event)
+        events = self.app.pacer.get_events()
+        start = time.perf_counter()
+        self.app.run_frame(events)
+        self.frame_times.append(time.perf_counter() - start)
+        documents = self.app.documents.documents + [self.app.image]
+        for document in documents:
+            while document.allocation_log:
+                name, report = document.allocation_log.popleft()
+                self.command_times.setdefault(name, []).append(report["seconds"])
+
+    def is_busy(self):
+        """
+        Checks if the application still works in the background.
+
+        Returns:
+        - True while any busy source of the frame pacer reports work.
+        """
+        return any(source() for source in self.app.pacer.busy_sources)
+
+    def settle(self):
+        """
+        Runs frames until the background work has finished, and one more frame showing
+        its results.
+        """
+        deadline = time.perf_counter() + self.settle_timeout
+        self.run_frame()
+        while self.is_busy() and time.perf_counter() < deadline:
+            self.run_frame()
+        self.run_frame()
+
+    def wait(self, milliseconds):
+        """
+        Runs frames for some time.
+
+        Args:
+        - milliseconds: The time to wait, limited to max_wait.
+        """
+        end = time.perf_counter() + min(milliseconds, self.max_wait) / 1000
+        while time.perf_counter() < end:
+            self.run_frame()
+
+    def run_step(self, step, replacements):
+        """
+        Executes one step of a script.
+
+        Args:
+        - step: Dictionary describing the step.
+        - replacements: Dictionary of placeholders in dialog paths and their values.
+        """
+        start = time.perf_counter()
+        if "dialog" in step:
+            path = step["dialog"]
+            for placeholder, value in replacements.items():
+                path = path.replace(placeholder, value)
+            self.dialogs.answer(path)
+        events = expand_step(step)
+        if events or "dialog" in step:
+            self.run_frame(events)
+        if "wait" in step:
+            self.wait(step["wait"])
+        if step.get("settle") or "label" in step:
+            self.settle()
+        if "label" in step:
+            self.step_times.setdefault(step["label"], []).append(time.perf_counter() - start)
+
+    def replay(self, script, replacements=None):
+        """
+        Replays a script and measures it.
+
+        Args:
+        - script: Dictionary with the list of steps of the script.
+        - replacements: Dictionary of placeholders in dialog paths and their values.
+
+        Returns:
+        - The report of the replay, see report.
+        """
+        start = time.perf_counter()
+        for step in script["steps"]:
+            self.run_step(step, replacements or {})
+        self.settle()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, seconds):
+        """
+        Summarizes the measurements.
+
+        Args:
+        - seconds: Duration of the replay.
+
+        Returns:
+        - Dictionary with the frame time percentiles, the latency of every command and labeled
+          step in milliseconds, the peak resident memory in megabytes and the duration.
+        """
+        return {"frames": percentiles(self.frame_times),
+                "commands": {name: percentiles(times) for name, times in sorted(self.command_times.items())},
+                "steps": {label: percentiles(times) for label, times in self.step_times.items()},
+                "peak_rss_mb": peak_rss(), "seconds": seconds}
+
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Compares the measurements of a replay with a baseline. Frame times and latencies are
+    compared by their median and 90th percentile, which are less noisy than the maximum.
+
+    Args:
+    - report: The report of the replay.
+    - baseline: The report of an earlier replay of the same script.
+    - tolerance: Allowed relative increase, for example 0.2 for 20%.
+
+    Returns:
+    - List of (metric, baseline value, new value, regressed) tuples.
+    """
+    pairs = [("frames", report["frames"], baseline["frames"])]
+    for group in ("commands", "steps"):
+        for name, values in report[group].items():
+            if name in baseline[group]:
+                pairs.append((f"{group}/{name}", values, baseline[group][name]))
+    rows = []
+    for metric, values, old_values in pairs:
+        for statistic in ("p50", "p90"):
+            if statistic in values and statistic in old_values:
+                old, new = old_values[statistic], values[statistic]
+                rows.append((f"{metric} {statistic} [ms]", old, new, new > old * (1 + tolerance)))
+    if report["peak_rss_mb"] is not None and baseline["peak_rss_mb"] is not None:
+        old, new = baseline["peak_rss_mb"], report["peak_rss_mb"]
+        rows.append(("peak RSS [MB]", old, new, new > old * (1 + tolerance)))
+    return rows
+
+
+def print_report(report):
+    """
+    Prints the report of a replay.
+
+    Args:
+    - report: The report returned by ReplayHarness.replay.
+    """
+    frames = report["frames"]
+    print(f"{frames['count']} frames in {report['seconds']:.1f} s")
+    print(f"{'':>26} {'count':>6} {'p50 [ms]':>9} {'p90 [ms]':>9} {'p99 [ms]':>9} {'max [ms]':>9}")
+    rows = [("frame", frames)] + list(report["commands"].items()) + list(report["steps"].items())
+    for name, values in rows:
+        if values["count"]:
+            print(f"{name:>26} {values['count']:>6} {values['p50']:>9.1f} {values['p90']:>9.1f} "
+                  f"{values['p99']:>9.1f} {values['max']:>9.1f}")
+    if report["peak_rss_mb"] is not None:
+        print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+
+
+def record(path):
+    """
+    Runs the application and records the session as a script.
+
+    Args:
+    - path: The file the script is saved to.
+    """
+    from ImageEditProgram import ImageEdit
+    app = ImageEdit()
+    recorder = ScriptRecorder(path)
+    app.dialogs.listeners.append(recorder.record_dialog)
+    app.load_elements()
+    try:
+        app.run_app(recorder)
+    finally:
+        recorder.save()
+
+
+def replay(script, image_path, size, max_wait):
+    """
+    Replays a script without a display, on an application whose journal and caches are kept
+    in a temporary directory.
+
+    Args:
+    - script: Dictionary with the list of steps of the script.
+    - image_path: The image replacing "{image}" in the script, or None to generate one.
+    - size: Width and height of the generated image.
+    - max_wait: Longest wait of a script step in milliseconds.
+
+    Returns:
+    - The report of the replay.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from Benchmarks import make_test_image
+    from ImageEditProgram import ImageEdit
+    from Settings import Settings
+    with tempfile.TemporaryDirectory(prefix="imageedit-replay-") as directory:
+        if image_path is None:
+            image_path = os.path.join(directory, "image.png")
+            make_test_image(*size).save(image_path)
+        settings = Settings()
+        settings.journal_dir = os.path.join(directory, "journal")
+        settings.thumbnail_dir = os.path.join(directory, "thumbnails")
+        settings.decode_cache_dir = os.path.join(directory, "decoded")
+        app = ImageEdit(settings)
+        harness = ReplayHarness(app, max_wait)
+        try:
+            return harness.replay(script, {"{image}": os.path.abspath(image_path), "{temp}": directory})
+        finally:
+            app.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Records sessions of the application and replays them without a "
+                                                 "display, measuring frame times, command latency and memory.")
+    commands = parser.add_subparsers(dest="mode", required=True)
+    record_parser = commands.add_parser("record", help="Run the application and record the session.")
+    record_parser.add_argument("script")
+    replay_parser = commands.add_parser("replay", help="Replay a recorded script, or the default session.")
+    replay_parser.add_argument("script", nargs="?")
+    replay_parser.add_argument("--image", help="Image opened by the script, generated if not given.")
+    replay_parser.add_argument("--width", type=int, default=2000)
+    replay_parser.add_argument("--height", type=int, default=1500)
+    replay_parser.add_argument("--max-wait", type=int, default=1000)
+    replay_parser.add_argument("--output", help="Save the report as JSON, for use as a baseline.")
+    replay_parser.add_argument("--baseline", help="Compare with a report saved by --output.")
+    replay_parser.add_argument("--tolerance", type=float, default=0.2)
+    arguments = parser.parse_args()
+    if arguments.mode == "record":
+        record(arguments.script)
+        return
+    script = DEFAULT_SCRIPT
+    if arguments.script is not None:
+        with open(arguments.script) as file:
+            script = json.load(file)
+    report = replay(script, arguments.image, (arguments.width, arguments.height), arguments.max_wait)
+    print_report(report)
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=1)
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        rows = compare_reports(report, baseline, arguments.tolerance)
+        print(f"{'':>40} {'baseline':>9} {'new':>9}")
+        for metric, old, new, regressed in rows:
+            print(f"{metric:>40} {old:>9.1f} {new:>9.1f}{'  REGRESSION' if regressed else ''}")
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
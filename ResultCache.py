@@ -0,0 +1,149 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from WorkingBuffer import view_pixels
+
+
+def content_hash(image):
+    """
+    Computes a digest identifying the content of an image.
+
+    Args:
+    - image: A PIL image.
+
+    Returns:
+    - A hex digest of the mode, size and pixel data of the image.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    pixels = view_pixels(image)
+    digest.update(pixels.data if pixels is not None else image.tobytes())
+    return digest.hexdigest()
+
+
+def image_size_in_bytes(image):
+    """
+    Estimates the memory used by the pixel data of an image.
+
+    Args:
+    - image: A PIL image.
+
+    Returns:
+    - Number of bytes.
+    """
+    return image.width * image.height * len(image.getbands())
+
+
+class ResultCache:
+    """
+    A least recently used cache of command results keyed by the content of their input.
+
+    Attributes:
+    - budget: Maximum number of bytes of pixel data kept in the cache.
+    - size: Number of bytes currently used.
+    - hits: Number of lookups that found a result.
+    - misses: Number of lookups that did not find a result.
+    - evictions: Number of results removed to stay within the budget.
+    - copies: Indicates if images are copied when stored and returned. Without copies,
+      callers must not modify the images in place. Read-only views of pixel arrays are
+      never copied.
+    """
+    def __init__(self, budget, copies=True):
+        self.budget = budget
+        self.copies = copies
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(input_hash, command):
+        """
+        Builds the key of a command applied to an input.
+
+        Args:
+        - input_hash: Content hash of the input image.
+        - command: The command to be executed.
+
+        Returns:
+        - A hashable key.
+        """
+        return input_hash, type(command).__name__, command.parameters()
+
+    def get(self, key):
+        """
+        Looks up a result.
+
+        Args:
+        - key: The key built by make_key.
+
+        Returns:
+        - The cached image or its copy, or None if there is no result for the key.
+        """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return image.copy() if self.copies and view_pixels(image) is None else image
+
+    def contains(self, key):
+        """
+        Checks if a result is cached without affecting statistics or ordering.
+
+        Args:
+        - key: The key built by make_key.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, image):
+        """
+        Stores a result, evicting the least recently used results if the budget is exceeded.
+        Results bigger than the whole budget are not stored.
+
+        Args:
+        - key: The key built by make_key.
+        - image: The resulting PIL image.
+        """
+        image_size = image_size_in_bytes(image)
+        if image_size > self.budget:
+            return
+        if self.copies and view_pixels(image) is None:
+            image = image.copy()
+        with self._lock:
+            if key in self._entries:
+                self.size -= image_size_in_bytes(self._entries.pop(key))
+            self._entries[key] = image
+            self.size += image_size
+            while self.size > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= image_size_in_bytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all results from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns statistics of the cache.
+
+        Returns:
+        - Dictionary with hits, misses, hit ratio, evictions, entries, size and budget.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "size": self.size,
+                    "budget": self.budget}
@@ -0,0 +1,162 @@
+from PIL import Image, ImageDraw
+
+
+class Selection:
+    """
+    A class representing the part of an image commands are restricted to.
+
+    Attributes:
+    - box: The (left, top, right, bottom) bounding box of the selection in image pixels.
+    - mask: An "L" image of the size of the box weighting every pixel of the box,
+      or None if the whole box is selected.
+    - shape: "rectangle", "ellipse" or "mask", used to draw the outline.
+    """
+    def __init__(self, box, mask=None, shape="rectangle"):
+        self.box = tuple(box)
+        self.mask = mask
+        self.shape = shape
+
+    @classmethod
+    def from_points(cls, start, end, size, ellipse=False):
+        """
+        Creates a selection from two corners, clipped to the image.
+
+        Args:
+        - start: A corner of the selection in image pixels.
+        - end: The opposite corner in image pixels.
+        - size: The size of the image.
+        - ellipse: If True, selects the ellipse inscribed in the rectangle.
+
+        Returns:
+        - A Selection, or None if the clipped selection is empty.
+        """
+        left, right = sorted((start[0], end[0]))
+        top, bottom = sorted((start[1], end[1]))
+        box = (max(0, left), max(0, top), min(size[0], right), min(size[1], bottom))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return None
+        if not ellipse:
+            return cls(box)
+        mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, mask.width - 1, mask.height - 1), fill=255)
+        return cls(box, mask, "ellipse")
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Creates a selection from a mask covering the whole image.
+
+        Args:
+        - mask: An "L" image of the size of the image, non-zero where pixels are selected.
+
+        Returns:
+        - A Selection, or None if the mask is empty.
+        """
+        box = mask.getbbox()
+        if box is None:
+            return None
+        return cls(box, mask.crop(box), "mask")
+
+    def fits(self, size):
+        """
+        Checks if the selection lies inside an image.
+
+        Args:
+        - size: The size of the image.
+        """
+        return self.box[2] <= size[0] and self.box[3] <= size[1]
+
+
+class RegionDelta:
+    """
+    A class representing a change of some regions of an image, stored in the history
+    instead of the whole image.
+
+    Attributes:
+    - patches: List of (box, before, after) tuples holding the (left, top, right, bottom)
+      box of a changed region and the region before and after the change.
+    """
+    def __init__(self, patches):
+        self.patches = patches
+
+    def apply(self, image):
+        """
+        Returns a copy of the image with the change applied.
+
+        Args:
+        - image: The PIL image before the change.
+        """
+        new_image = image.copy()
+        for box, _, after in self.patches:
+            new_image.paste(after, box[:2])
+        return new_image
+
+    def revert(self, image):
+        """
+        Returns a copy of the image with the change reverted.
+
+        Args:
+        - image: The PIL image after the change.
+        """
+        new_image = image.copy()
+        for box, before, _ in self.patches:
+            new_image.paste(before, box[:2])
+        return new_image
+
+    def memory_usage(self):
+        """
+        Returns the number of bytes used by the stored regions.
+        """
+        return sum(region.width * region.height * len(region.getbands())
+                   for _, before, after in self.patches for region in (before, after))
+
+
+def expand_box(box, halo, size):
+    """
+    Expands a box by a halo, clipped to the image.
+
+    Args:
+    - box: The (left, top, right, bottom) box.
+    - halo: Number of pixels added on every side.
+    - size: The size of the image.
+    """
+    return max(0, box[0] - halo), max(0, box[1] - halo), min(size[0], box[2] + halo), min(size[1], box[3] + halo)
+
+
+def execute_in_selection(command, image, selection):
+    """
+    Executes a command only on the selected part of an image.
+
+    The command processes the bounding box of the selection grown by the halo of the
+    command, so pixels near the border of the selection see their real neighbours.
+    Commands needing the whole image process only the bounding box. The result is
+    blended back inside the mask of the selection.
+
+    Args:
+    - command: The command to execute.
+    - image: The PIL image.
+    - selection: The Selection restricting the command.
+
+    Returns:
+    - Tuple of the new PIL image and the RegionDelta of the change, or None if the command
+      changes the size of the image and cannot be restricted to a region.
+    """
+    if command.changes_size:
+        return None
+    box = selection.box
+    halo = command.get_halo()
+    region_box = box if halo is None else expand_box(box, halo, image.size)
+    region = image.crop(region_box)
+    result = command.execute(region)
+    before = image.crop(box)
+    after = result.crop((box[0] - region_box[0], box[1] - region_box[1],
+                         box[2] - region_box[0], box[3] - region_box[1]))
+    if after.mode != image.mode:
+        has_alpha = "A" in after.getbands()
+        after = after.convert(image.mode)
+        if "A" in image.getbands() and not has_alpha:
+            after.putalpha(before.getchannel("A"))
+    if selection.mask is not None:
+        after = Image.composite(after, before, selection.mask)
+    delta = RegionDelta([(box, before, after)])
+    return delta.apply(image), delta
@@ -1,3 +1,6 @@
+import os
+
+
 class Settings:
     """
     Class contains basic setting of the application.
@@ -7,9 +10,55 @@ class Settings:
         - screen_height: window height
         - bg_color: background color
         - canvas_pos: Canvas position
+        - active_fps: frame rate during interaction and background work
+        - idle_fps: frame rate when the application is idle
+        - idle_delay: milliseconds without events before the application becomes idle
+        - result_cache_budget: bytes of pixel data kept in the command result cache
+        - preview_workers: number of worker threads computing speculative previews
+        - preview_size: maximum width and height of preview thumbnails
+        - live_preview_delay: milliseconds without typing before a reduced live preview is rendered
+        - live_preview_settle_delay: milliseconds without typing before a full resolution live preview is rendered
+        - document_memory_budget: bytes of pixel data open documents may keep in memory together
+        - journal_dir: directory of the session journals used for crash recovery
+        - journal_checkpoint_interval: number of commands between checkpoints in the journal
+        - buffer_pool_budget: bytes of unused pixel arrays kept for reuse by commands working in place
+        - animation_workers: number of worker threads editing the frames of animations when they are saved
+        - thumbnail_dir: directory of the thumbnails cached by the image browser
+        - thumbnail_size: maximum width and height of the thumbnails in the image browser
+        - thumbnail_workers: number of worker threads producing thumbnails
+        - decode_cache_dir: directory of the decoded pixels of recently opened files
+        - decode_cache_quota: bytes of disk space the decoded pixels may take, 0 to disable the cache
+        - decode_cache_min_pixels: images with fewer pixels are not kept in the decode cache
+        - batch_port: localhost TCP port of the batch service
+        - batch_workers: number of worker processes executing batch jobs
+        - batch_queue_size: number of batch jobs that may wait for a worker
+        - batch_when_full: "reject" or "block", what the batch service does with a job when its queue is full
     """
     def __init__(self):
         self.screen_width = 1500
         self.screen_height = 950
         self.bg_color = (71, 71, 71)
         self.canvas_pos = (200, 25)
+        self.active_fps = 60
+        self.idle_fps = 4
+        self.idle_delay = 500
+        self.result_cache_budget = 256 * 1024 * 1024
+        self.preview_workers = max(1, (os.cpu_count() or 2) - 1)
+        self.preview_size = 160
+        self.live_preview_delay = 150
+        self.live_preview_settle_delay = 600
+        self.document_memory_budget = 1024 * 1024 * 1024
+        self.journal_dir = os.path.join(os.path.expanduser("~"), ".imageedit", "journal")
+        self.journal_checkpoint_interval = 10
+        self.buffer_pool_budget = 256 * 1024 * 1024
+        self.animation_workers = os.cpu_count() or 1
+        self.thumbnail_dir = os.path.join(os.path.expanduser("~"), ".imageedit", "thumbnails")
+        self.thumbnail_size = 128
+        self.thumbnail_workers = os.cpu_count() or 1
+        self.decode_cache_dir = os.path.join(os.path.expanduser("~"), ".imageedit", "decoded")
+        self.decode_cache_quota = 4 * 1024 * 1024 * 1024
+        self.decode_cache_min_pixels = 4 * 1000 * 1000
+        self.batch_port = 8765
+        self.batch_workers = os.cpu_count() or 1
+        self.batch_queue_size = 64
+        self.batch_when_full = "reject"
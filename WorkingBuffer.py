@@ -0,0 +1,223 @@
+import threading
+import tracemalloc
+import weakref
+import numpy as np
+from PIL import Image
+
+
+# Attribute holding the pixel array of an image created by BufferPool.make_image. Copies made
+# by Pillow do not carry it, as they have their own pixels.
+_PIXELS_ATTRIBUTE = "pool_pixels"
+
+
+def view_pixels(image):
+    """
+    Returns the pixel array a PIL image created by BufferPool.make_image is a view of. The
+    array may be reused once the image is gone, so whoever keeps the array keeps the image.
+
+    Args:
+    - image: A PIL image.
+
+    Returns:
+    - The (height, width, 4) uint8 array sharing the memory of the image, or None if the
+      image is not a view of a pixel array.
+    """
+    return getattr(image, _PIXELS_ATTRIBUTE, None)
+
+
+def copy_into(pixels, image, position=(0, 0)):
+    """
+    Writes the pixels of an image, converted to RGBA, into a pixel array.
+
+    Args:
+    - pixels: A (height, width, 4) uint8 array.
+    - image: A PIL image fitting in the array at the position.
+    - position: The (x, y) position of the upper left corner of the image in the array.
+    """
+    source = view_pixels(image)
+    if source is None:
+        source = np.asarray(image if image.mode == "RGBA" else image.convert("RGBA"))
+    x, y = position
+    np.copyto(pixels[y:y + source.shape[0], x:x + source.shape[1]], source)
+
+
+def apply_lut(channel, lut, rows=64):
+    """
+    Maps the values of an 8-bit channel through a lookup table in place. The image is
+    processed a few rows at a time to keep the temporary index arrays small.
+
+    Args:
+    - channel: 2-D uint8 array, possibly a strided view of one band of an image.
+    - lut: Array of 256 uint8 values.
+    - rows: Number of rows processed at once.
+    """
+    for top in range(0, channel.shape[0], rows):
+        part = channel[top:top + rows]
+        np.take(lut, part, out=part, mode="clip")
+
+
+class BufferPool:
+    """
+    A class providing contiguous RGBA pixel arrays for commands working in place, and
+    recycling the arrays of images that are no longer used.
+
+    Images created from the arrays are read-only views sharing their memory. They are
+    shared with the history, the preview workers and the journal, so an array is never
+    modified once it is visible as an image. Every image holds the lease of its array: when
+    the image is garbage collected, a finalizer returns the array to the pool for reuse.
+    Code keeping an array returned by view_pixels therefore keeps its image as well.
+
+    Attributes:
+    - budget: Bytes of unused arrays kept for reuse.
+    - allocations: Number of arrays allocated.
+    - reuses: Number of arrays taken from the pool instead of being allocated.
+    - views: Number of images created as views of arrays.
+    """
+    # Pillow counts two images for every image created from a buffer, neither owning pixels.
+    IMAGES_PER_VIEW = 2
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.allocations = 0
+        self.reuses = 0
+        self.views = 0
+        self._free = []
+        self._lock = threading.RLock()
+
+    def acquire(self, size):
+        """
+        Returns a writable pixel array with undefined content. The caller holds it until it
+        is handed to make_image or given back with release.
+
+        Args:
+        - size: The (width, height) of the image.
+
+        Returns:
+        - A C-contiguous (height, width, 4) uint8 array.
+        """
+        shape = (size[1], size[0], 4)
+        with self._lock:
+            for index in range(len(self._free)):
+                pixels = self._free[index]
+                if pixels.shape == shape:
+                    del self._free[index]
+                    self.reuses += 1
+                    return pixels
+            self.allocations += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def acquire_copy(self, image):
+        """
+        Returns a writable pixel array holding the pixels of an image converted to RGBA.
+
+        Args:
+        - image: A PIL image.
+
+        Returns:
+        - A C-contiguous (height, width, 4) uint8 array.
+        """
+        pixels = self.acquire(image.size)
+        copy_into(pixels, image)
+        return pixels
+
+    def make_image(self, pixels):
+        """
+        Creates a read-only PIL image sharing the memory of a pixel array. The array
+        must not be modified afterwards, and returns to the pool once the image is gone.
+
+        Args:
+        - pixels: A C-contiguous (height, width, 4) uint8 array.
+
+        Returns:
+        - An RGBA PIL image.
+        """
+        image = Image.frombuffer("RGBA", (pixels.shape[1], pixels.shape[0]), pixels, "raw", "RGBA", 0, 1)
+        self.views += 1
+        setattr(image, _PIXELS_ATTRIBUTE, pixels)
+        finalizer = weakref.finalize(image, self.release, pixels)
+        finalizer.atexit = False
+        return image
+
+    def release(self, pixels):
+        """
+        Gives an array back for reuse. Nothing may use the array afterwards.
+
+        Args:
+        - pixels: An array returned by acquire, whose images are all gone.
+        """
+        with self._lock:
+            if any(free is pixels for free in self._free):
+                return
+            self._free.append(pixels)
+            while self._free and sum(free.nbytes for free in self._free) > self.budget:
+                self._free.pop(0)
+
+    def stats(self):
+        """
+        Returns the counters of the pool.
+
+        Returns:
+        - Dictionary with allocations, reuses, free arrays and their size in bytes.
+        """
+        with self._lock:
+            return {"allocations": self.allocations, "reuses": self.reuses, "views": self.views,
+                    "free": len(self._free),
+                    "free_bytes": sum(free.nbytes for free in self._free)}
+
+
+class AllocationMonitor:
+    """
+    A context manager counting the image allocations made while it is active.
+
+    Pillow counts every image it creates and the memory blocks it takes for their pixels.
+    Views created by the pool are not counted as images. The counts include allocations made
+    by other threads at the same time, such as preview workers finishing cancelled work.
+    Bytes allocated by NumPy and Python are measured only while tracemalloc is tracing.
+
+    Attributes:
+    - pool: The BufferPool whose allocations are counted.
+    - images: Number of images with their own pixels created by Pillow.
+    - blocks: Number of memory blocks Pillow took for pixels.
+    - buffers: Number of pixel arrays allocated by the pool.
+    - reused: Number of pixel arrays reused from the pool.
+    - peak_bytes: Peak of traced memory above the starting point, or None without tracemalloc.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.images = 0
+        self.blocks = 0
+        self.buffers = 0
+        self.reused = 0
+        self.peak_bytes = None
+
+    @staticmethod
+    def _pillow_counts():
+        stats = Image.core.get_stats()
+        return stats["new_count"], stats["allocated_blocks"] + stats["reused_blocks"]
+
+    def __enter__(self):
+        self._images, self._blocks = self._pillow_counts()
+        self._views = self.pool.views
+        self._buffers = self.pool.allocations
+        self._reused = self.pool.reuses
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._traced = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exception):
+        images, blocks = self._pillow_counts()
+        self.images = images - self._images - self.pool.IMAGES_PER_VIEW * (self.pool.views - self._views)
+        self.blocks = blocks - self._blocks
+        self.buffers = self.pool.allocations - self._buffers
+        self.reused = self.pool.reuses - self._reused
+        if tracemalloc.is_tracing():
+            self.peak_bytes = tracemalloc.get_traced_memory()[1] - self._traced
+        return False
+
+    def report(self):
+        """
+        Returns the counts as a dictionary.
+        """
+        return {"images": self.images, "blocks": self.blocks, "buffers": self.buffers, "reused": self.reused,
+                "peak_bytes": self.peak_bytes}
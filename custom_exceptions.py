@@ -4,3 +4,7 @@ class NoImageError(Exception):
 
 class NoFileSelectedError(Exception):
     """Raise when no file was selected"""
+
+
+class QueueFullError(Exception):
+    """Raise when a job is submitted while the queue of the batch service is full"""